@@ -0,0 +1,56 @@
+"""
+Vectorized groupby aggregations that pandas doesn't have built in.
+"""
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+def group_mode(df, by, columns=None, weights=None):
+    """
+    Gets the most common value of each column for each group, without calling
+    python once per group like groupby(by).agg(lambda x: x.value_counts().index[0]).
+
+    Ties go to the value that appears first within the group (the same as value_counts),
+    and missing values are ignored.  Groups where a column is all missing get NaN.
+
+    df - pandas dataframe
+    by - string; name of column to group by
+    columns - list of strings; columns to get the mode of.  Defaults to all other columns.
+    weights - string or None; name of column with counts for each row (e.g. from pre-aggregated data)
+
+    Returns a dataframe indexed by the sorted groups, with one column per column in columns.
+    """
+    if columns is None:
+        columns = [c for c in df.columns if c not in (by, weights)]
+
+    group_codes, groups = pd.factorize(df[by], sort=True)
+    row_weights = None if weights is None else df[weights].to_numpy()
+
+    modes = {}
+    for col in columns:
+        value_codes, values = pd.factorize(df[col])
+        keep = (group_codes >= 0) & (value_codes >= 0)
+        n_values = max(len(values), 1)
+        # one integer per (group, value) pair
+        pairs = group_codes[keep].astype(np.int64) * n_values + value_codes[keep]
+        mode_codes = np.full(len(groups), -1, dtype=np.int64)
+        if pairs.size > 0:
+            # first is the index of the first row with each pair, for tie-breaking
+            uniques, first, inverse = np.unique(pairs, return_index=True, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=None if row_weights is None else row_weights[keep])
+            pair_groups, pair_values = uniques // n_values, uniques % n_values
+            # sort by group, then highest count, then earliest appearance
+            order = np.lexsort((first, -counts, pair_groups))
+            sorted_groups = pair_groups[order]
+            is_best = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]
+            best = order[is_best]
+            mode_codes[pair_groups[best]] = pair_values[best]
+
+        # -1 codes (no mode) become NaN
+        values = values.array if isinstance(values, pd.Index) else values
+        modes[col] = values.take(mode_codes, allow_fill=True)
+
+    result = pd.DataFrame(modes, index=pd.Index(groups, name=by))
+    return result[columns]
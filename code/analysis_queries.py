@@ -0,0 +1,65 @@
+"""
+SQL for the analysis in data_analysis.py, kept separate so the queries can be
+benchmarked (benchmarks/bench_analysis_queries.py) without running the analysis.
+
+City-level queries read the city_summary rollup (see rollups.py) instead of
+aggregating solar_metrics joined to zipcodes; averages are the stored sums over the
+stored non-null counts.
+
+Queries with a %(cities)s parameter take a tuple of (city_name, state_name) tuples.
+"""
+
+top_zipcodes_by_installs = """
+SELECT SUM(potential_installs) AS potential, zip_code
+FROM solar_metrics
+WHERE potential_installs IS NOT NULL
+GROUP BY zip_code
+ORDER BY potential DESC
+LIMIT 100;
+"""
+
+top_cities_by_installs = """SELECT city_name, state_name, potential_installs_sum AS potential_installs
+FROM city_summary
+WHERE potential_installs_count > 0
+ORDER BY potential_installs DESC
+LIMIT 100;
+"""
+
+bill_by_city = """SELECT city_name, state_name, average_yearly_electric_bill_sum / average_yearly_electric_bill_count AS average_bill
+FROM city_summary
+WHERE average_yearly_electric_bill_count > 0
+AND (city_name, state_name) IN %(cities)s
+LIMIT 100;
+"""
+
+top_cities_by_kw = """SELECT city_name, state_name, kw_median_sum AS solar_potential
+FROM city_summary
+WHERE kw_median_count > 0
+ORDER BY solar_potential DESC
+LIMIT 100;
+"""
+
+income_by_city = """SELECT city_name, state_name, median_income_sum / median_income_count AS average_median_income
+FROM city_summary
+WHERE median_income_count > 0
+AND (city_name, state_name) IN %(cities)s
+ORDER BY average_median_income DESC
+LIMIT 100;
+"""
+
+modules_by_city = """SELECT z.city_name, z.state_name, i.installer_primary_module_manufacturer AS module_manufacturer
+FROM solar_metrics sm
+INNER JOIN zipcodes z
+ON sm.zip_code=z.zip_code
+JOIN installer i
+ON sm.primary_installer_id=i.installer_id
+WHERE (z.city_name, z.state_name) IN %(cities)s;
+"""
+
+# name to (query, whether it takes the cities parameter)
+queries = {'top_zipcodes_by_installs': (top_zipcodes_by_installs, False),
+            'top_cities_by_installs': (top_cities_by_installs, False),
+            'bill_by_city': (bill_by_city, True),
+            'top_cities_by_kw': (top_cities_by_kw, False),
+            'income_by_city': (income_by_city, True),
+            'modules_by_city': (modules_by_city, True)}
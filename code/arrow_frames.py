@@ -0,0 +1,293 @@
+"""
+Arrow tables as the interchange format between pipeline stages.
+
+Stages running in worker processes write their dataframe outputs as uncompressed
+Arrow IPC files and return a FrameRef to each file, instead of pickling the data
+back through a pipe (and unpickling it again for every stage which takes it).  A
+stage taking the output, in whichever process, memory-maps the file: the columns are
+read straight from the page cache without being copied or parsed, and processes
+reading the same output share one copy of it.  Each process converts a file to a
+pandas dataframe only once, and every stage gets its own shallow copy of it, so a
+stage adding or replacing columns of its input doesn't change what the others see.
+Stages mustn't modify the values of an input in place (the arrays may be read-only
+views of the file); they never could rely on that, since thread stages share inputs.
+
+The same Arrow tables feed the Parquet (stage cache) and CSV (S3 staging) writers,
+so writing a frame doesn't go through pandas' own serializers.
+"""
+import os
+import uuid
+import threading
+
+import instrumentation
+from lazy_imports import lazy_module
+
+pd = lazy_module('pandas')
+
+
+# set SOLAR_ARROW_EXCHANGE=0 to pickle the outputs of process stages instead
+EXCHANGE_ENABLED = os.environ.get('SOLAR_ARROW_EXCHANGE', '1') != '0'
+# each run writes its files to a temporary directory in here, removed when the run ends
+EXCHANGE_DIR = os.environ.get('SOLAR_EXCHANGE_DIR', '../data/exchange')
+
+# dataframes already converted from IPC files in this process, by path
+_frames = {}
+_frames_lock = threading.Lock()
+
+
+def to_arrow(df, preserve_index=None):
+    """
+    Converts a pandas dataframe to an Arrow table; Arrow tables are returned as is.
+    Categoricals become dictionary columns, and the dtypes are kept in the table's
+    metadata, so to_pandas gives back the same dtypes.
+
+    df - pandas dataframe or Arrow table
+    preserve_index - boolean or None; None stores a range index as metadata and
+        any other index as columns, False drops the index
+    """
+    import pyarrow as pa
+
+    if isinstance(df, pa.Table):
+        return df
+    return pa.Table.from_pandas(df, preserve_index=preserve_index)
+
+
+def to_pandas(table):
+    """
+    Converts an Arrow table to a pandas dataframe.  Columns are kept as separate
+    blocks, so numeric columns without nulls are views of the table's memory
+    instead of being copied into one 2D block per dtype.
+
+    table - Arrow table
+    """
+    return table.to_pandas(split_blocks=True)
+
+
+def write_ipc(table, path):
+    """
+    Writes an Arrow table to an uncompressed IPC file, which can be memory-mapped.
+    The file appears under its name only once it's complete.
+
+    table - Arrow table
+    path - string; file path
+
+    Returns size of the file in bytes.
+    """
+    import pyarrow as pa
+
+    temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with pa.OSFile(temp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+    return os.path.getsize(path)
+
+
+def read_ipc(path):
+    """
+    Memory-maps an Arrow IPC file written by write_ipc; nothing is copied until a
+    column is converted to something else.
+
+    path - string; file path
+
+    Returns Arrow table.
+    """
+    import pyarrow as pa
+
+    # the table's buffers keep the memory map open
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+class FrameRef:
+    """
+    Reference to a dataframe written to an Arrow IPC file, which is cheap to send to
+    another process.
+    """
+    def __init__(self, path, rows):
+        """
+        path - string; path of the IPC file
+        rows - int; number of rows
+        """
+        self.path = path
+        self.rows = rows
+
+
+    @property
+    def shape(self):
+        # rows are counted in instrumentation.frame_rows without loading the frame
+        return (self.rows,)
+
+
+    def load(self):
+        """
+        Gets the dataframe, converting the file only the first time in each process.
+        Each call returns a new shallow copy, so column changes by one stage don't
+        leak into the others (the column arrays themselves are shared).
+        """
+        with _frames_lock:
+            if self.path not in _frames:
+                with instrumentation.span('read {}'.format(os.path.basename(self.path)), kind='exchange', rows_in=self.rows):
+                    _frames[self.path] = to_pandas(read_ipc(self.path))
+            return _frames[self.path].copy(deep=False)
+
+
+    def __repr__(self):
+        return 'FrameRef({!r}, rows={})'.format(self.path, self.rows)
+
+
+def export_frame(value, directory, name):
+    """
+    Writes a dataframe to an IPC file and gets a FrameRef to it.  Other values, and
+    dataframes Arrow can't hold (e.g. object columns with mixed types), are returned as is.
+
+    value - stage output
+    directory - string; directory for the file
+    name - string; file name without extension
+    """
+    import pyarrow as pa
+
+    if not isinstance(value, pd.DataFrame):
+        return value
+
+    try:
+        table = to_arrow(value)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return value
+
+    path = os.path.join(directory, name + '.arrow')
+    instrumentation.record_bytes(write_ipc(table, path))
+    return FrameRef(path, value.shape[0])
+
+
+def export(value, directory, name):
+    """
+    Exports a stage output: a dataframe, or each dataframe in a tuple, is written to
+    an IPC file and replaced by a FrameRef (see export_frame).
+
+    value - stage output
+    directory - string; directory for the files
+    name - string; stage name, used for the file names
+    """
+    if isinstance(value, tuple):
+        return tuple(export_frame(v, directory, '{}-{}'.format(name, i)) for i, v in enumerate(value))
+
+    return export_frame(value, directory, name)
+
+
+def resolve(value):
+    """
+    Replaces FrameRefs, on their own or in a tuple, with their dataframes.
+
+    value - stage output, possibly from export
+    """
+    if isinstance(value, FrameRef):
+        return value.load()
+    if isinstance(value, tuple):
+        return tuple(resolve(v) for v in value)
+
+    return value
+
+
+def release(directory):
+    """
+    Forgets the dataframes this process loaded from IPC files in a directory.
+
+    directory - string; directory passed to export
+    """
+    prefix = os.path.join(directory, '')
+    with _frames_lock:
+        for path in [p for p in _frames if p.startswith(prefix)]:
+            del _frames[path]
+
+
+def arrow_type(dtype):
+    """
+    Gets the Arrow type to read a csv column as, from a pandas dtype name in
+    frame_schemas.read_dtypes.
+
+    dtype - string; e.g. 'str', 'category', 'float32' or 'Int32'
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    if dtype == 'str':
+        return pa.string()
+    if dtype == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+
+    # nullable integers read the same way; missing values are nulls either way
+    return pa.from_numpy_dtype(np.dtype(dtype.lower()))
+
+
+def read_csvs(files, dtypes, encoding='utf8'):
+    """
+    Reads csv files with the same columns into one Arrow table.  Only the columns in
+    dtypes are read, and the files' record batches are combined without copying.
+
+    files - list of strings; csv paths
+    dtypes - dict of column name to pandas dtype name (see arrow_type)
+    encoding - string; encoding of the files
+
+    Returns Arrow table.
+    """
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    read_options = pa_csv.ReadOptions(encoding=encoding)
+    convert_options = pa_csv.ConvertOptions(column_types={col: arrow_type(d) for col, d in dtypes.items()},
+                                            include_columns=list(dtypes),
+                                            strings_can_be_null=True)
+    return pa.concat_tables([pa_csv.read_csv(fn, read_options=read_options, convert_options=convert_options)
+                            for fn in files])
+
+
+def read_csv_frame(files, dtypes, encoding='utf8'):
+    """
+    Reads csv files with the same columns into one pandas dataframe (see read_csvs),
+    converting from Arrow once.  Categories are sorted, as pd.read_csv sorts them.
+
+    files - list of strings; csv paths
+    dtypes - dict of column name to pandas dtype name (see arrow_type)
+    encoding - string; encoding of the files
+    """
+    df = to_pandas(read_csvs(files, dtypes, encoding=encoding))
+    for col, dtype in dtypes.items():
+        if dtype == 'category':
+            df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+
+    return df
+
+
+def decode_dictionaries(table):
+    """
+    Replaces dictionary (categorical) columns of an Arrow table with their values,
+    for writers which only take plain columns.
+
+    table - Arrow table
+    """
+    import pyarrow as pa
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            column = table.column(i)
+            decoded = pa.chunked_array([chunk.dictionary_decode() for chunk in column.chunks],
+                                        type=field.type.value_type)
+            table = table.set_column(i, field.name, decoded)
+
+    return table
+
+
+def write_csv(table, sink, header=True):
+    """
+    Writes an Arrow table as csv.  Strings are quoted, missing values are empty, and
+    floats are written in their shortest form (0.1 for a float32 0.1).
+
+    table - Arrow table
+    sink - path, or binary file object
+    header - boolean; if True, writes the column names first
+    """
+    import pyarrow.csv as pa_csv
+
+    pa_csv.write_csv(decode_dictionaries(table), sink, write_options=pa_csv.WriteOptions(include_header=header))
@@ -0,0 +1,225 @@
+"""
+Warehouse backends.
+
+The ETL load and the analysis queries go through a backend, so the same schema
+(from sql_queries) and the same SQL can run on the Redshift cluster or on an
+embedded DuckDB database file.  The DuckDB backend needs no cluster or network,
+so the whole pipeline can be run and tested on one machine.
+"""
+import os
+import threading
+from contextlib import contextmanager
+
+import sql_queries as sql_q
+import incremental_load
+import rollups
+import query_cache
+import instrumentation
+from sql_utils import insert_frame, execute, pyformat_to_qmark
+
+
+# set SOLAR_BACKEND=duckdb to use the local database by default
+DEFAULT_BACKEND = os.environ.get('SOLAR_BACKEND', 'redshift')
+LOCAL_DB_PATH = os.environ.get('SOLAR_DUCKDB_PATH', '../data/solar.duckdb')
+
+# duckdb.connect to a file already open in this process races with itself in other threads
+_duckdb_connect_lock = threading.Lock()
+
+
+class Backend:
+    """
+    Base class for warehouse backends.  Subclasses implement connection, cursor and read_sql.
+    """
+    name = None
+    dialect = None
+
+    def __init__(self, state_dir=incremental_load.STATE_DIR):
+        """
+        state_dir - string; directory with hashes from incremental loads of this backend
+        """
+        self.state_dir = state_dir
+
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager yielding a connection in a transaction, committed if the block succeeds.
+        """
+        raise NotImplementedError
+
+
+    def cursor(self, conn):
+        """
+        Gets a cursor from a connection from self.connection().
+        """
+        raise NotImplementedError
+
+
+    def read_sql(self, sql, params=None, dtypes=None):
+        """
+        Runs a query with psycopg2 placeholders (%(name)s or %s) and returns a dataframe.
+
+        sql - string; SQL query
+        params - dict, tuple or None; query parameters
+        dtypes - dict or None; column name to dtype, overriding the types from the database
+        """
+        raise NotImplementedError
+
+
+    def drop_tables(self):
+        with self.connection() as conn:
+            cur = self.cursor(conn)
+            for q in sql_q.drop_table_queries_for(dialect=self.dialect):
+                execute(cur, q)
+
+
+    def create_tables(self):
+        with self.connection() as conn:
+            cur = self.cursor(conn)
+            for q in sql_q.create_table_queries_for(dialect=self.dialect):
+                execute(cur, q)
+
+
+    def load_tables(self, tables):
+        """
+        Recreates the tables and inserts all data, then builds the rollups.
+
+        tables - dict of table name to pandas dataframe with columns in table order
+        """
+        self.drop_tables()
+        self.create_tables()
+        with self.connection() as conn:
+            cur = self.cursor(conn)
+            for table, df in tables.items():
+                insert_frame(cur, table, sql_q.table_columns[table], df)
+
+            with instrumentation.span('rebuild rollups', kind='load'):
+                rollups.rebuild_rollups(cur)
+            query_cache.write_load_version(cur, query_cache.new_load_version())
+
+        # hashes from past incremental loads no longer match the tables
+        incremental_load.clear_state(self.state_dir)
+
+
+    def load_incremental(self, tables):
+        """
+        Loads only changed rows (see incremental_load.py) and refreshes the rollups.
+        Tables are created if they don't exist, and never dropped.
+
+        tables - dict of table name to pandas dataframe with columns in table order
+
+        Returns dict of table name to number of rows written.
+        """
+        self.create_tables()
+        with self.connection() as conn:
+            cur = self.cursor(conn)
+            written = incremental_load.incremental_load(cur, conn, tables, self.state_dir)
+            # the stamp only changes if the data did, so cached analysis results survive no-op loads
+            states = [incremental_load.read_state(table, self.state_dir) for table in tables]
+            query_cache.write_load_version(cur, query_cache.content_load_version(states))
+
+        return written
+
+
+class RedshiftBackend(Backend):
+    """
+    The Redshift cluster, with pooled connections (see warehouse.py).
+    Analysis queries go through the query result cache.
+    """
+    name = 'redshift'
+    dialect = 'redshift'
+
+    @contextmanager
+    def connection(self):
+        import warehouse
+
+        with warehouse.connection() as conn:
+            yield conn
+
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+
+    def read_sql(self, sql, params=None, dtypes=None):
+        return query_cache.read_sql(sql, params, dtypes=dtypes)
+
+
+class DuckDBBackend(Backend):
+    """
+    Embedded DuckDB database in a local file.
+    """
+    name = 'duckdb'
+    dialect = 'duckdb'
+
+    def __init__(self, path=LOCAL_DB_PATH, state_dir=os.path.join(incremental_load.STATE_DIR, 'duckdb')):
+        """
+        path - string; database file (':memory:' for an in-memory database)
+        state_dir - string; directory with hashes from incremental loads of this database
+        """
+        super().__init__(state_dir)
+        self.path = path
+        self._memory_conn = None
+
+
+    def connect(self):
+        import duckdb
+
+        if self.path == ':memory:':
+            # every connect() to ':memory:' would be a new, empty database
+            if self._memory_conn is None:
+                self._memory_conn = duckdb.connect(self.path)
+            return self._memory_conn.cursor()
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with _duckdb_connect_lock:
+            return duckdb.connect(self.path)
+
+
+    @contextmanager
+    def connection(self):
+        conn = self.connect()
+        conn.begin()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+    def cursor(self, conn):
+        # DuckDB connections are also cursors
+        return conn
+
+
+    def read_sql(self, sql, params=None, dtypes=None):
+        with instrumentation.span(instrumentation.statement_name(sql), kind='query', backend=self.name) as s:
+            sql, values = pyformat_to_qmark(sql, params)
+            conn = self.connect()
+            try:
+                df = conn.execute(sql, values).df()
+            finally:
+                conn.close()
+            s.add_rows_out(df.shape[0])
+
+        return df.astype(dtypes) if dtypes else df
+
+
+BACKENDS = {'redshift': RedshiftBackend, 'duckdb': DuckDBBackend}
+
+
+def get_backend(name=DEFAULT_BACKEND, **kwargs):
+    """
+    Makes a backend by name.
+
+    name - string; 'redshift' or 'duckdb'
+    kwargs - keyword arguments for the backend, e.g. path for duckdb
+    """
+    if name not in BACKENDS:
+        raise ValueError('unknown backend {}; should be one of {}'.format(name, list(BACKENDS)))
+
+    return BACKENDS[name](**kwargs)
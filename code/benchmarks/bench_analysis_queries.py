@@ -0,0 +1,126 @@
+"""
+Benchmarks the data_analysis.py queries on tables without any physical design
+(the old DDL) and with the distribution styles, sort keys and encodings from sql_queries.
+
+Copies of the loaded tables are made in two schemas on the cluster, and each query is
+run a few times on both (with the result cache off).  The query plans are also
+checked for steps which redistribute or broadcast rows for joins.
+
+Needs a running cluster with the tables loaded by etl.py.  Run from the code directory:
+python benchmarks/bench_analysis_queries.py
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import warehouse
+import sql_queries as sql_q
+import analysis_queries as aq
+import city_analysis
+
+
+# join steps in Redshift query plans which move rows between slices
+REDISTRIBUTION_STEPS = ('DS_DIST_BOTH', 'DS_DIST_INNER', 'DS_DIST_OUTER',
+                        'DS_BCAST_INNER', 'DS_DIST_ALL_INNER')
+
+# schema name to whether the tables in it have the physical design
+LAYOUTS = {'bench_before': False, 'bench_after': True}
+
+
+def copy_tables(cur, schema, physical):
+    """
+    Recreates the tables in a schema and copies the loaded data into them.
+
+    cur - psycopg2 cursor on a connection with autocommit on (needed for VACUUM)
+    schema - string; name of schema
+    physical - boolean; if True, uses the distribution styles, sort keys and encodings
+    """
+    cur.execute('CREATE SCHEMA IF NOT EXISTS {};'.format(schema))
+    for drop in sql_q.drop_table_queries_for(schema):
+        cur.execute(drop)
+    for create in sql_q.create_table_queries_for(physical=physical, schema=schema):
+        cur.execute(create)
+
+    for table in sql_q.all_tables:
+        columns = ', '.join(table.load_columns)
+        cur.execute('INSERT INTO {0}.{1} ({2}) SELECT {2} FROM public.{1};'.format(schema, table.name, columns))
+        # sort the rows and update statistics, like after a COPY into empty tables
+        cur.execute('VACUUM {}.{} TO 100 PERCENT;'.format(schema, table.name))
+        cur.execute('ANALYZE {}.{};'.format(schema, table.name))
+
+
+def redistribution_steps(cur, query, params):
+    """
+    Gets the steps in the query plan which move rows between slices.
+    """
+    cur.execute('EXPLAIN ' + query, params)
+    plan = '\n'.join(row[0] for row in cur.fetchall())
+    return sorted({step for step in REDISTRIBUTION_STEPS if step in plan})
+
+
+def time_query(cur, query, params, repeats):
+    """
+    Runs a query repeats times (after one run to compile it) and returns the run times.
+    """
+    cur.execute(query, params)
+    cur.fetchall()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def run(repeats=5, keep=False):
+    """
+    Runs the benchmark and prints a table of median run times.
+
+    repeats - int; timed runs of each query on each layout
+    keep - boolean; if True, the benchmark schemas aren't dropped afterwards
+    """
+    conn = warehouse.connect()
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute('SET enable_result_cache_for_session TO off;')
+        cur.execute(aq.top_cities_by_installs)
+        cities = {'cities': tuple((row[0], row[1]) for row in cur.fetchall()[:10])}
+
+        for schema, physical in LAYOUTS.items():
+            print('copying tables into {}...'.format(schema))
+            copy_tables(cur, schema, physical)
+
+        print('{:<26} {:>12} {:>12} {:>8}  redistribution (before -> after)'.format('query', 'before (s)', 'after (s)', 'speedup'))
+        benchmarks = [(name, query, cities if takes_cities else None)
+                        for name, (query, takes_cities) in aq.queries.items()]
+        # all the city metrics and module manufacturers in one query
+        benchmarks.append(('top_cities_one_scan', city_analysis.top_cities_query(modules=True), {'n': 10}))
+        for name, query, params in benchmarks:
+            medians, steps = [], []
+            for schema in LAYOUTS:
+                cur.execute('SET search_path TO {};'.format(schema))
+                medians.append(np.median(time_query(cur, query, params, repeats)))
+                steps.append(','.join(redistribution_steps(cur, query, params)) or 'none')
+
+            print('{:<26} {:>12.3f} {:>12.3f} {:>7.1f}x  {} -> {}'.format(
+                name, medians[0], medians[1], medians[0] / medians[1], steps[0], steps[1]))
+    finally:
+        if not keep:
+            for schema in LAYOUTS:
+                cur.execute('DROP SCHEMA IF EXISTS {} CASCADE;'.format(schema))
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark analysis queries with and without the physical table design')
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs of each query')
+    parser.add_argument('--keep', action='store_true', help="don't drop the benchmark schemas")
+    args = parser.parse_args()
+    run(repeats=args.repeats, keep=args.keep)
@@ -0,0 +1,60 @@
+"""
+Benchmarks group_mode against the groupby/value_counts lambda it replaced.
+
+Run from the code directory:
+python benchmarks/bench_group_mode.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from aggregations import group_mode
+
+
+def make_data(n_rows, n_groups, n_values, seed=42):
+    """
+    Makes LBNL-like data with skewed group and value frequencies.
+
+    n_rows - int; number of rows
+    n_groups - int; number of distinct groups (e.g. installers or zipcodes)
+    n_values - int; number of distinct values (e.g. module manufacturers)
+    seed - int; random seed
+    """
+    rng = np.random.RandomState(seed)
+    groups = np.minimum(rng.zipf(1.3, n_rows), n_groups) - 1
+    values = np.minimum(rng.zipf(1.5, (n_rows, 2)), n_values) - 1
+    return pd.DataFrame({'group': ['g{}'.format(g) for g in groups],
+                        'value_1': ['v{}'.format(v) for v in values[:, 0]],
+                        'value_2': ['v{}'.format(v) for v in values[:, 1]]})
+
+
+def lambda_mode(df):
+    return df.groupby('group').agg(lambda x: x.value_counts().index[0])
+
+
+def time_function(func, df, repeats=3):
+    """
+    Returns best wall time in seconds and the result of func(df).
+    """
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(df)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+if __name__ == '__main__':
+    # roughly the size of the LBNL data (installers) and EIA zipcode data
+    for n_rows, n_groups, n_values in [(100000, 2000, 50), (1500000, 40000, 500)]:
+        df = make_data(n_rows, n_groups, n_values)
+        lambda_time, expected = time_function(lambda_mode, df, repeats=1)
+        vector_time, result = time_function(lambda d: group_mode(d, 'group'), df)
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+        print('{:>9,} rows, {:>6,} groups: lambda {:.3f}s, group_mode {:.3f}s ({:.0f}x faster)'.format(
+            n_rows, df['group'].nunique(), lambda_time, vector_time, lambda_time / vector_time))
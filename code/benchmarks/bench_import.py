@@ -0,0 +1,152 @@
+"""
+Benchmarks the startup time of the ETL modules and command line, and checks that
+they start without credentials and without importing pandas, numpy, database
+drivers or cloud clients, which are only imported when a stage first needs them.
+
+Each case runs in a fresh interpreter, with credentials removed from the
+environment and HOME pointed at an empty directory (so there are no AWS, GCP or
+cluster config files either).
+
+Run from the code directory:
+python benchmarks/bench_import.py --repeats 5 --max-seconds 0.5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# (name, python arguments) for each timed case
+CASES = [('import etl', ['-c', 'import etl']),
+        ('import data_analysis', ['-c', 'import data_analysis']),
+        ('etl.py --help', ['etl.py', '--help'])]
+
+# modules which shouldn't be imported until they're used
+HEAVY_MODULES = ['pandas',
+                'numpy',
+                'pyarrow',
+                'psycopg2',
+                'duckdb',
+                'boto3',
+                'google.cloud.bigquery',
+                'google.cloud.bigquery_storage',
+                'seaborn',
+                'matplotlib']
+
+# environment variables with credentials or pointing at them
+CREDENTIAL_PREFIXES = ('AWS_', 'GOOGLE_', 'GCLOUD_', 'CLOUDSDK_')
+
+CHECK_MODULES = """
+import sys, json
+import etl, data_analysis
+print(json.dumps([m for m in {} if m in sys.modules]))
+"""
+
+
+def clean_env(home):
+    """
+    Copies the environment without credentials, with HOME set to an empty directory.
+    """
+    env = {k: v for k, v in os.environ.items() if not k.startswith(CREDENTIAL_PREFIXES)}
+    env['HOME'] = home
+    # spans aren't written at startup, but don't let a run leave files behind
+    env['SOLAR_INSTRUMENTATION'] = '0'
+    return env
+
+
+def run_python(args, env):
+    """
+    Runs python with arguments in the code directory; raises if it fails.
+
+    Returns wall time in seconds and the completed process.
+    """
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + args, cwd=CODE_DIR, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError('python {} failed:\n{}'.format(' '.join(args), proc.stderr))
+
+    return elapsed, proc
+
+
+def time_cases(env, repeats=5):
+    """
+    Times each case, plus an empty interpreter as a baseline.
+
+    Returns dict of case name to median seconds.
+    """
+    results = {}
+    for name, args in [('python (baseline)', ['-c', 'pass'])] + CASES:
+        results[name] = statistics.median(run_python(args, env)[0] for _ in range(repeats))
+
+    return results
+
+
+def loaded_heavy_modules(env):
+    """
+    Gets the heavy modules imported by importing etl and data_analysis.
+    """
+    _, proc = run_python(['-c', CHECK_MODULES.format(HEAVY_MODULES)], env)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, module='etl', n=10):
+    """
+    Gets the modules taking the most time (including their own imports) when importing a module,
+    from python -X importtime.
+
+    Returns list of (cumulative microseconds, module name), largest first.
+    """
+    _, proc = run_python(['-X', 'importtime', '-c', 'import {}'.format(module)], env)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.strip()))
+
+    return sorted(times, reverse=True)[:n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark startup time of the ETL modules and command line')
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='exit with status 1 if any case takes longer than this (median)')
+    parser.add_argument('--importtime', action='store_true', help='show the slowest imports of etl')
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='solar-bench-home-')
+    try:
+        env = clean_env(home)
+        results = time_cases(env, repeats=args.repeats)
+        for name, seconds in results.items():
+            print('{:<24} {:8.3f}s'.format(name, seconds))
+
+        if args.importtime:
+            print('\nslowest imports of etl (cumulative):')
+            for microseconds, name in slowest_imports(env):
+                print('  {:<40} {:8.3f}s'.format(name, microseconds / 1e6))
+
+        failures = []
+        heavy = loaded_heavy_modules(env)
+        if heavy:
+            failures.append('imported at startup: {}'.format(', '.join(heavy)))
+        if args.max_seconds is not None:
+            failures += ['{} took {:.3f}s'.format(name, seconds)
+                            for name, seconds in results.items() if seconds > args.max_seconds]
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    for failure in failures:
+        print('FAILED: {}'.format(failure))
+    if failures:
+        sys.exit(1)
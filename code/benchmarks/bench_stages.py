@@ -0,0 +1,319 @@
+"""
+Benchmarks each ETL stage on synthetic, production-sized inputs (see fixtures.py),
+with no network or credentials needed.  Records wall time and peak memory per stage,
+appends the results to a history file, and compares them with earlier runs at the
+same scale to catch regressions.
+
+Run from the code directory:
+python benchmarks/bench_stages.py --scale 1 --repeats 3
+"""
+import os
+import sys
+import io
+import gc
+import json
+import time
+import atexit
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+from contextlib import redirect_stdout
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# stage caches and EIA-861 snapshots go to a scratch directory, so every run does the real work
+SCRATCH_DIR = tempfile.mkdtemp(prefix='solar-bench-')
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
+os.environ['SOLAR_CACHE_DIR'] = os.path.join(SCRATCH_DIR, 'cache')
+# spans would add file writes to the timings
+os.environ['SOLAR_INSTRUMENTATION'] = '0'
+
+import etl
+import eia861
+import s3_loader
+import backends
+import data_quality
+import frame_schemas
+from fixtures import make_fixtures
+
+
+HISTORY_FILE = os.environ.get('SOLAR_BENCH_HISTORY', '../data/benchmarks/stage_history.jsonl')
+# number of earlier runs the current run is compared with
+HISTORY_RUNS = 5
+
+
+class FakeS3Client:
+    """
+    Stands in for a boto3 S3 client; keeps uploaded objects in memory.
+    """
+    def __init__(self):
+        self.objects = {}
+
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        self.objects[(bucket, key)] = fileobj.read()
+
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def measure(func, repeats=3, setup=None):
+    """
+    Times a function, then runs it once more with tracemalloc for peak memory
+    (tracemalloc slows allocation-heavy code, so it's kept out of the timed runs).
+
+    func - function with no arguments
+    repeats - int; number of timed runs
+    setup - function or None; called before every run, outside the timing
+
+    Returns dict of timings and peak memory, and the result of the last run.
+    """
+    times = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            result = func()
+        times.append(time.perf_counter() - start)
+        del result
+
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'median_seconds': float(np.median(times)),
+            'min_seconds': min(times),
+            'peak_bytes': peak}, result
+
+
+def clear_eia861_snapshots():
+    for fn in os.listdir(eia861.CACHE_DIR) if os.path.exists(eia861.CACHE_DIR) else []:
+        if fn.startswith('eia861-'):
+            os.remove(os.path.join(eia861.CACHE_DIR, fn))
+
+
+def stage_benchmarks():
+    """
+    Gets the benchmarks in pipeline order.  Each is (name, function taking the dict of
+    earlier results and returning a function to time, name to store the result under
+    or None, setup function or None).
+    """
+    def load_duckdb(results, incremental):
+        path = os.path.join(SCRATCH_DIR, 'bench.duckdb')
+        backend = backends.DuckDBBackend(path=path, state_dir=os.path.join(SCRATCH_DIR, 'duckdb_state'))
+        tables = etl.table_frames(results['merge'], results['zipcodes'], results['eia'], results['lbnl'][0])
+        if incremental:
+            # first load outside the timing, then time a reload where nothing changed
+            backend.load_incremental(tables)
+            return lambda: backend.load_incremental(tables)
+        return lambda: backend.load_tables(tables)
+
+    def warehouse_checks(results):
+        # checks run on freshly loaded tables, loaded outside the timing
+        path = os.path.join(SCRATCH_DIR, 'bench_checks.duckdb')
+        backend = backends.DuckDBBackend(path=path, state_dir=os.path.join(SCRATCH_DIR, 'duckdb_checks_state'))
+        backend.load_tables(etl.table_frames(results['merge'], results['zipcodes'], results['eia'], results['lbnl'][0]))
+        return lambda: data_quality.run_checks(data_quality.WAREHOUSE_CHECKS, backend=backend)
+
+    def stage_s3(results):
+        df = results['merge']
+        return lambda: s3_loader.stage_table(df, 'solar_metrics', 'bench', 8, FakeS3Client())
+
+    return [('extract_zipcode_data', lambda r: lambda: etl.extract_zipcode_data(use_cache=False), 'zipcodes', None),
+            ('load_lbnl_data', lambda r: lambda: etl.load_lbnl_data(r['zipcodes']), None, None),
+            ('extract_lbnl_data', lambda r: lambda: etl.extract_lbnl_data(r['zipcodes'], use_cache=False), 'lbnl', None),
+            ('extract_lbnl_data_streaming',
+                lambda r: lambda: etl.extract_lbnl_data(r['zipcodes'], streaming=True, use_cache=False),
+                None,
+                None),
+            ('load_eia_zipcode_data', lambda r: lambda: etl.load_eia_zipcode_data(r['zipcodes']), None, None),
+            ('read_eia861_sales', lambda r: lambda: eia861.read_eia861_sales(etl.EIA861_FILE), None, None),
+            ('extract_eia_data',
+                lambda r: lambda: etl.extract_eia_data(r['zipcodes'], use_cache=False),
+                'eia',
+                clear_eia861_snapshots),
+            ('extract_acs_data',
+                lambda r: lambda: etl.extract_acs_data(r['zipcodes'], load_csv=True, save_csv=False, use_cache=False),
+                'acs',
+                None),
+            ('extract_psr_data',
+                lambda r: lambda: etl.extract_psr_data(r['zipcodes'], load_csv=True, save_csv=False, use_cache=False),
+                'psr',
+                None),
+            # the csvs through the Arrow batch path, with a FileSource standing in for BigQuery
+            ('extract_acs_data_streaming',
+                lambda r: lambda: etl.extract_acs_data(r['zipcodes'], load_csv=False, save_csv=False, source='files',
+                                                        use_cache=False),
+                None,
+                None),
+            ('extract_psr_data_streaming',
+                lambda r: lambda: etl.extract_psr_data(r['zipcodes'], load_csv=False, save_csv=False, source='files',
+                                                        use_cache=False),
+                None,
+                None),
+            ('merge_data',
+                lambda r: lambda: etl.merge_data(r['psr'], r['acs'], r['lbnl'][1], r['eia'],
+                                                read_csv=False, write_csv=False, use_cache=False),
+                'merge',
+                None),
+            ('zipcode_data_quality_checks',
+                lambda r: lambda: etl.zipcode_data_quality_checks(r['psr'], r['acs'], r['lbnl'][1], r['eia'],
+                                                                r['zipcodes'], r['merge']),
+                None,
+                None),
+            ('stage_table_s3', stage_s3, None, None),
+            ('load_duckdb', lambda r: load_duckdb(r, incremental=False), None, None),
+            ('load_duckdb_incremental', lambda r: load_duckdb(r, incremental=True), None, None),
+            ('warehouse_quality_checks_duckdb', warehouse_checks, None, None)]
+
+
+def run_benchmarks(scale=1.0, repeats=3, stages=None, seed=0):
+    """
+    Runs the stage benchmarks.  Stages not selected still run once (untimed)
+    if later stages need their results.
+
+    scale - float; input size relative to the real data
+    repeats - int; number of timed runs per stage
+    stages - list of strings or None; stages to time (default all)
+    seed - int; random seed for the fixtures
+
+    Returns list of result dicts, one per timed stage.
+    """
+    etl.set_data_dir(make_fixtures(scale=scale, seed=seed))
+    results, records = {}, []
+    for name, make_func, result_name, setup in stage_benchmarks():
+        selected = stages is None or name in stages
+        if not (selected or result_name):
+            continue
+
+        with redirect_stdout(io.StringIO()):
+            func = make_func(results)
+            if not selected:
+                results[result_name] = func()
+                continue
+
+        stats, result = measure(func, repeats=repeats, setup=setup)
+        if result_name is not None:
+            results[result_name] = result
+
+        stats['stage'] = name
+        records.append(stats)
+        print('{:<30} {:>8.3f}s median {:>8.3f}s min {:>9.1f}MB peak'.format(
+            name, stats['median_seconds'], stats['min_seconds'], stats['peak_bytes'] / 1024 ** 2))
+
+    print_memory_report(results)
+    return records
+
+
+def print_memory_report(results):
+    """
+    Prints the memory of each stage's output with the schema dtypes and with pandas' default dtypes.
+    """
+    frames = {}
+    for name, result in results.items():
+        for i, df in enumerate(result if isinstance(result, tuple) else [result]):
+            frames[name if not isinstance(result, tuple) else '{}[{}]'.format(name, i)] = df
+    if not frames:
+        return
+
+    zip_dtype = frame_schemas.zipcode_dtype(results['zipcodes']['Zipcode']) if 'zipcodes' in results else None
+    report = frame_schemas.memory_report(frames, zip_dtype=zip_dtype)
+    print()
+    for frame, r in report.iterrows():
+        print('{:<30} {:>8.1f}MB with default dtypes {:>8.1f}MB compact ({:.0%} smaller)'.format(
+            frame, r['default_dtype_bytes'] / 1024 ** 2, r['bytes'] / 1024 ** 2, r['reduction']))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def read_history(path=HISTORY_FILE):
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(records, scale, path=HISTORY_FILE):
+    """
+    Appends a run's results to the history file, one JSON line per stage.
+    """
+    run = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': git_commit(), 'scale': scale}
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        for r in records:
+            f.write(json.dumps(dict(run, **r)) + '\n')
+
+
+def compare_with_history(records, history, scale, threshold=1.25):
+    """
+    Compares results with the median of the last HISTORY_RUNS runs at the same scale.
+
+    records - list of result dicts from run_benchmarks
+    history - list of result dicts from read_history
+    scale - float; input size of this run
+    threshold - float; ratio of time or peak memory to the earlier median counted as a regression
+
+    Returns list of (stage, metric, ratio) for regressions.
+    """
+    regressions = []
+    for r in records:
+        earlier = [h for h in history if h['stage'] == r['stage'] and h['scale'] == scale][-HISTORY_RUNS:]
+        if not earlier:
+            continue
+
+        for metric in ['median_seconds', 'peak_bytes']:
+            baseline = np.median([h[metric] for h in earlier])
+            ratio = r[metric] / baseline if baseline > 0 else 1.0
+            if ratio > threshold:
+                regressions.append((r['stage'], metric, ratio))
+            print('{:<30} {:<15} {:>6.2f}x of last {} runs'.format(r['stage'], metric, ratio, len(earlier)))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ETL stages on synthetic data')
+    parser.add_argument('--scale', type=float, default=1.0, help='input size relative to the real data')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the fixtures')
+    parser.add_argument('--stages', nargs='+', default=None, help='stages to time (default all)')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown or memory growth ratio counted as a regression')
+    parser.add_argument('--no-history', action='store_true', help="don't append results to the history file")
+    parser.add_argument('--fail-on-regression', action='store_true', help='exit with status 1 on regressions')
+    args = parser.parse_args()
+
+    history = read_history()
+    records = run_benchmarks(scale=args.scale, repeats=args.repeats, stages=args.stages, seed=args.seed)
+    print()
+    regressions = compare_with_history(records, history, args.scale, args.threshold)
+    if not args.no_history:
+        append_history(records, args.scale)
+
+    for stage, metric, ratio in regressions:
+        print('REGRESSION: {} {} is {:.2f}x the recent median'.format(stage, metric, ratio))
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
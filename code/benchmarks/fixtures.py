@@ -0,0 +1,30 @@
+"""
+Synthetic input files for the stage benchmarks (see synthetic_data.py), shaped and
+sized like the real data at scale=1, so the benchmarks run without the downloads
+or network access.
+
+Files are generated once per scale and seed and reused.
+"""
+import os
+
+import synthetic_data
+
+
+FIXTURES_DIR = os.environ.get('SOLAR_BENCH_FIXTURES_DIR', '../data/benchmarks/fixtures')
+
+
+def make_fixtures(scale=1.0, seed=0, fixtures_dir=FIXTURES_DIR):
+    """
+    Writes synthetic input files (if they don't exist yet) and returns their directory.
+
+    scale - float; size relative to the real data
+    seed - int; random seed
+    fixtures_dir - string; directory for generated fixtures
+    """
+    data_dir = os.path.join(fixtures_dir, 'scale-{}-seed-{}'.format(scale, seed))
+    done_file = os.path.join(data_dir, 'done')
+    if not os.path.exists(done_file):
+        synthetic_data.generate(data_dir, scale=scale, seed=seed)
+        open(done_file, 'w').close()
+
+    return data_dir
@@ -0,0 +1,86 @@
+"""
+Per-city analysis metrics in one query.
+
+Instead of one query per metric (and re-filtering to the top cities with an IN list),
+all the metrics for the top N cities are computed from one scan of the city_summary
+rollup, ranked with a window function, and returned as one dataframe with a row per city.
+The most common module manufacturer in each city can be added in the same round trip.
+"""
+import query_cache
+
+
+# metric name to SQL expression over city_summary; averages are stored sums over stored non-null counts
+CITY_METRICS = {'potential_installs': 'potential_installs_sum',
+                'solar_potential': 'kw_median_sum',
+                'average_bill': 'average_yearly_electric_bill_sum / NULLIF(average_yearly_electric_bill_count, 0)',
+                'average_median_income': 'median_income_sum / NULLIF(median_income_count, 0)'}
+
+
+def top_cities_query(rank_by='potential_installs', metrics=None, modules=False):
+    """
+    Makes query for the metrics of the top %(n)s cities.
+
+    rank_by - string; metric (key of CITY_METRICS) to rank cities by, largest first
+    metrics - list of strings or None; metrics to return (default all)
+    modules - boolean; if True, adds the most common module manufacturer of each city's installers
+    """
+    metrics = list(CITY_METRICS) if metrics is None else list(metrics)
+    unknown = [m for m in metrics + [rank_by] if m not in CITY_METRICS]
+    if unknown:
+        raise ValueError('unknown metrics {}; should be from {}'.format(unknown, list(CITY_METRICS)))
+
+    columns = ',\n    '.join('{} AS {}'.format(CITY_METRICS[m], m) for m in metrics)
+    ranked = """SELECT city_name, state_name,
+    {},
+    ROW_NUMBER() OVER (ORDER BY {} DESC NULLS LAST, state_name, city_name) AS city_rank
+    FROM city_summary""".format(columns, CITY_METRICS[rank_by])
+    top = """top_cities AS (
+    SELECT * FROM ({}) ranked
+    WHERE city_rank <= %(n)s
+)""".format(ranked)
+    if not modules:
+        return 'WITH {}\nSELECT * FROM top_cities\nORDER BY city_rank;\n'.format(top)
+
+    # module counts only for installers of the top cities; ties go to the first manufacturer alphabetically
+    return """WITH {},
+module_counts AS (
+    SELECT t.city_name, t.state_name, i.installer_primary_module_manufacturer AS module_manufacturer, COUNT(*) AS installs
+    FROM solar_metrics sm
+    INNER JOIN zipcodes z
+    ON sm.zip_code=z.zip_code
+    INNER JOIN top_cities t
+    ON z.city_name=t.city_name AND z.state_name=t.state_name
+    INNER JOIN installer i
+    ON sm.primary_installer_id=i.installer_id
+    WHERE i.installer_primary_module_manufacturer <> '-9999'
+    GROUP BY t.city_name, t.state_name, i.installer_primary_module_manufacturer
+),
+module_modes AS (
+    SELECT city_name, state_name, module_manufacturer,
+    ROW_NUMBER() OVER (PARTITION BY city_name, state_name ORDER BY installs DESC, module_manufacturer) AS module_rank
+    FROM module_counts
+)
+SELECT t.*, m.module_manufacturer
+FROM top_cities t
+LEFT JOIN module_modes m
+ON t.city_name=m.city_name AND t.state_name=m.state_name AND m.module_rank = 1
+ORDER BY t.city_rank;
+""".format(top)
+
+
+def top_cities(n=10, rank_by='potential_installs', metrics=None, modules=False, read_sql=query_cache.read_sql):
+    """
+    Gets metrics for the top n cities in one query.
+
+    n - int; number of cities
+    rank_by - string; metric (key of CITY_METRICS) to rank cities by, largest first
+    metrics - list of strings or None; metrics to return (default all)
+    modules - boolean; if True, adds the most common module manufacturer of each city's installers
+    read_sql - function taking a query and parameters and returning a dataframe
+
+    Returns pandas dataframe with one row per city in rank order, with columns city_name,
+    state_name, 'city, state', the metrics, city_rank, and module_manufacturer if modules is True.
+    """
+    df = read_sql(top_cities_query(rank_by, metrics, modules), {'n': int(n)})
+    df.insert(2, 'city, state', df['city_name'] + ', ' + df['state_name'])
+    return df
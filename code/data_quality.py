@@ -0,0 +1,368 @@
+"""
+Declarative data quality checks.
+
+Each check (uniqueness of a key, key length, a ceiling on distinct keys, and coverage
+of keys by a reference table) can run two ways: vectorized on the dataframes before
+the load, or as one aggregate SQL query inside the warehouse after the load, so the
+data never has to leave the warehouse.  Checks run in parallel and give a report
+which can be written as JSON, and which raises DataQualityError to gate the load
+if any check with severity 'error' failed.
+
+The pandas checks only hash each column once and do per-value work on the distinct
+keys, so their cost grows with the number of rows, not with the number of rows squared
+or with Python loops over values.
+"""
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+from sql_utils import execute
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+REPORT_DIR = os.environ.get('SOLAR_QUALITY_DIR', '../data/quality')
+# number of zip codes in the US with data
+MAX_ZIPCODES = 41859
+ZIPCODE_LENGTH = 5
+# offending values included in the report for each failed check (pandas checks only)
+N_EXAMPLES = 5
+
+SEVERITIES = ('error', 'warning')
+
+
+class DataQualityError(Exception):
+    """
+    Raised when checks with severity 'error' fail; the QualityReport is the report attribute.
+    """
+    def __init__(self, report):
+        failed = ', '.join(r['name'] for r in report.errors)
+        super().__init__('data quality checks failed: {}'.format(failed))
+        self.report = report
+
+
+def examples(values):
+    """
+    First few offending values, as plain Python values for the JSON report.
+    """
+    return [None if pd.isna(v) else v.item() if isinstance(v, np.generic) else v for v in values[:N_EXAMPLES]]
+
+
+class Check:
+    """
+    Base class for checks.  Subclasses implement check_frames and sql, which both
+    give the number of failures and the number of rows or keys checked.
+    """
+    kind = None
+
+    def __init__(self, table, column, severity='error', name=None):
+        """
+        table - string; dataframe name for pandas checks, or table name for SQL checks
+        column - string; column holding the key
+        severity - string; 'error' fails the report, 'warning' is only reported
+        name - string or None; name in the report (default e.g. 'unique psr.region_name')
+        """
+        if severity not in SEVERITIES:
+            raise ValueError('severity must be one of {}, not {}'.format(SEVERITIES, severity))
+
+        self.table = table
+        self.column = column
+        self.severity = severity
+        self.name = name or '{} {}.{}'.format(self.kind, table, column)
+
+
+    def check_frames(self, frames):
+        """
+        Runs the check on dataframes.
+
+        frames - dict of table name to pandas dataframe
+
+        Returns number of failures, number checked, and list of example offending values.
+        """
+        raise NotImplementedError
+
+
+    def sql(self):
+        """
+        Gets a query returning one row of (failures, checked).
+        """
+        raise NotImplementedError
+
+
+    def check_sql(self, cur):
+        execute(cur, self.sql())
+        failures, checked = cur.fetchone()
+        return int(failures or 0), int(checked or 0), []
+
+
+class Unique(Check):
+    """
+    Non-null keys appear only once.  Failures are the number of repeated rows.
+    """
+    kind = 'unique'
+
+    def check_frames(self, frames):
+        keys = frames[self.table][self.column].dropna()
+        duplicated = keys.duplicated()
+        return int(duplicated.sum()), len(keys), examples(keys[duplicated].unique())
+
+
+    def sql(self):
+        return 'SELECT COUNT({0}) - COUNT(DISTINCT {0}), COUNT(*) FROM {1};'.format(self.column, self.table)
+
+
+class KeyLength(Check):
+    """
+    Keys are strings of a fixed length (and not null).  Failures are the number of rows with other keys.
+    """
+    kind = 'key_length'
+
+    def __init__(self, table, column, length=ZIPCODE_LENGTH, **kwargs):
+        """
+        length - int; length every key should have
+        """
+        super().__init__(table, column, **kwargs)
+        self.length = length
+
+
+    def check_frames(self, frames):
+        keys = frames[self.table][self.column]
+        # lengths are only measured once per distinct key; nulls get code -1
+        codes, uniques = pd.factorize(keys)
+        bad_uniques = np.asarray(pd.Series(uniques, dtype='object').astype(str).str.len() != self.length)
+        bad = codes == -1
+        bad[codes >= 0] = bad_uniques[codes[codes >= 0]]
+        return int(bad.sum()), len(keys), examples(pd.unique(keys[bad].astype('object')))
+
+
+    def sql(self):
+        return ('SELECT COALESCE(SUM(CASE WHEN {0} IS NULL OR LENGTH({0}) <> {1} THEN 1 ELSE 0 END), 0), COUNT(*) '
+                'FROM {2};').format(self.column, self.length, self.table)
+
+
+class DistinctCeiling(Check):
+    """
+    The number of distinct keys across one or more tables is at most a maximum.
+    Failures are the number of keys over the maximum.
+    """
+    kind = 'distinct_ceiling'
+
+    def __init__(self, sources, maximum=MAX_ZIPCODES, **kwargs):
+        """
+        sources - list of (table, column) tuples whose keys are counted together
+        maximum - int; most distinct keys allowed
+        """
+        kwargs.setdefault('name', 'distinct_ceiling {}'.format('+'.join('{}.{}'.format(*s) for s in sources)))
+        super().__init__('+'.join(table for table, _ in sources), '+'.join(column for _, column in sources), **kwargs)
+        self.sources = sources
+        self.maximum = maximum
+
+
+    def check_frames(self, frames):
+        distinct = [pd.Index(np.asarray(frames[table][column].dropna().unique(), dtype='object'))
+                    for table, column in self.sources]
+        n_keys = len(distinct[0].append(distinct[1:]).unique())
+        return max(n_keys - self.maximum, 0), n_keys, []
+
+
+    def sql(self):
+        keys = ' UNION ALL '.join('SELECT {1} AS k FROM {0}'.format(table, column) for table, column in self.sources)
+        return ('SELECT CASE WHEN n > {0} THEN n - {0} ELSE 0 END, n '
+                'FROM (SELECT COUNT(DISTINCT k) AS n FROM ({1}) all_keys) counts;').format(self.maximum, keys)
+
+
+class Coverage(Check):
+    """
+    Every key is also in a reference table (e.g. every zip code is a known zip code).
+    Failures are the number of distinct keys missing from the reference.
+    """
+    kind = 'coverage'
+
+    def __init__(self, table, column, ref_table, ref_column, **kwargs):
+        """
+        ref_table - string; reference dataframe or table name
+        ref_column - string; key column of the reference
+        """
+        kwargs.setdefault('name', 'coverage {}.{} in {}.{}'.format(table, column, ref_table, ref_column))
+        super().__init__(table, column, **kwargs)
+        self.ref_table = ref_table
+        self.ref_column = ref_column
+
+
+    def check_frames(self, frames):
+        keys = pd.Index(frames[self.table][self.column].dropna().unique())
+        missing = ~keys.isin(frames[self.ref_table][self.ref_column].dropna().unique())
+        return int(missing.sum()), len(keys), examples(keys[missing])
+
+
+    def sql(self):
+        return ('SELECT m.failures, a.checked '
+                'FROM (SELECT COUNT(DISTINCT t.{1}) AS failures FROM {0} t '
+                'LEFT JOIN {2} r ON t.{1} = r.{3} '
+                'WHERE r.{3} IS NULL AND t.{1} IS NOT NULL) m '
+                'CROSS JOIN (SELECT COUNT(DISTINCT {1}) AS checked FROM {0}) a;').format(
+                    self.table, self.column, self.ref_table, self.ref_column)
+
+
+# checks on the extracted dataframes, named like the ETL stages, before the load
+FRAME_CHECKS = [KeyLength('psr', 'region_name'),
+                KeyLength('acs', 'geo_id'),
+                KeyLength('lbnl', 'Zip Code'),
+                KeyLength('eia', 'zip'),
+                # project sunroof has a few zip codes twice; the merge keeps both rows
+                Unique('psr', 'region_name', severity='warning'),
+                Unique('acs', 'geo_id'),
+                Unique('lbnl', 'Zip Code'),
+                Unique('eia', 'zip'),
+                DistinctCeiling([('eia', 'zip'), ('lbnl', 'Zip Code'), ('acs', 'geo_id'), ('psr', 'region_name')]),
+                Coverage('merge', 'full_zip', 'zipcodes', 'Zipcode')]
+
+# the same checks on the loaded warehouse tables
+WAREHOUSE_CHECKS = [KeyLength('solar_metrics', 'zip_code'),
+                    KeyLength('zipcodes', 'zip_code'),
+                    KeyLength('utility', 'zip_code'),
+                    Unique('solar_metrics', 'zip_code', severity='warning'),
+                    Unique('zipcodes', 'zip_code'),
+                    Unique('utility', 'zip_code'),
+                    Unique('installer', 'installer_id'),
+                    DistinctCeiling([('solar_metrics', 'zip_code')]),
+                    Coverage('solar_metrics', 'zip_code', 'zipcodes', 'zip_code'),
+                    Coverage('utility', 'zip_code', 'zipcodes', 'zip_code'),
+                    Coverage('solar_metrics', 'primary_installer_id', 'installer', 'installer_id')]
+
+
+class QualityReport:
+    """
+    Results of a set of checks.
+    """
+    def __init__(self, results, mode):
+        """
+        results - list of result dicts, one per check
+        mode - string; 'pandas' or 'sql'
+        """
+        self.results = results
+        self.mode = mode
+        self.run_id = instrumentation.current_run_id()
+        self.created_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+    @property
+    def errors(self):
+        return [r for r in self.results if not r['passed'] and r['severity'] == 'error']
+
+
+    @property
+    def warnings(self):
+        return [r for r in self.results if not r['passed'] and r['severity'] == 'warning']
+
+
+    @property
+    def passed(self):
+        return not self.errors
+
+
+    def to_dict(self):
+        return {'run_id': self.run_id,
+                'created_at': self.created_at,
+                'mode': self.mode,
+                'passed': self.passed,
+                'n_errors': len(self.errors),
+                'n_warnings': len(self.warnings),
+                'checks': self.results}
+
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, default=str)
+
+
+    def write(self, path):
+        """
+        Writes the report as JSON.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+
+    def summary(self):
+        lines = []
+        for r in self.results:
+            if r['passed']:
+                status = 'CHECK PASSED'
+            else:
+                status = 'CHECK FAILED' if r['severity'] == 'error' else 'CHECK WARNING'
+            detail = r['error'] or '{} failures of {} checked'.format(r['failures'], r['checked'])
+            if r['examples']:
+                detail += ', e.g. {}'.format(r['examples'])
+            lines.append('{}: {} ({})'.format(status, r['name'], detail))
+
+        return '\n'.join(lines)
+
+
+    def raise_for_errors(self):
+        """
+        Raises DataQualityError if any check with severity 'error' failed.
+        """
+        if not self.passed:
+            raise DataQualityError(self)
+
+
+def run_check(check, frames=None, backend=None):
+    """
+    Runs one check on dataframes, or with SQL in a backend if frames is None.
+
+    Returns result dict.  A check which can't run (e.g. missing column) fails with the error recorded.
+    """
+    mode = 'pandas' if frames is not None else 'sql'
+    error = None
+    start = time.perf_counter()
+    with instrumentation.span(check.name, kind='check', mode=mode) as s:
+        try:
+            if frames is not None:
+                failures, checked, bad_examples = check.check_frames(frames)
+            else:
+                with backend.connection() as conn:
+                    failures, checked, bad_examples = check.check_sql(backend.cursor(conn))
+        except Exception as e:
+            failures, checked, bad_examples = None, None, []
+            error = '{}: {}'.format(type(e).__name__, e)
+        s.set(failures=failures)
+
+    return {'name': check.name,
+            'kind': check.kind,
+            'table': check.table,
+            'column': check.column,
+            'severity': check.severity,
+            'mode': mode,
+            'passed': error is None and failures == 0,
+            'failures': failures,
+            'checked': checked,
+            'examples': bad_examples,
+            'error': error,
+            'elapsed_seconds': time.perf_counter() - start}
+
+
+def run_checks(checks, frames=None, backend=None, max_workers=4):
+    """
+    Runs checks in parallel, on dataframes or as SQL in a warehouse backend.
+    SQL checks each use their own connection.
+
+    checks - list of Check objects
+    frames - dict of table name to pandas dataframe, or None to run the checks in the backend
+    backend - backends.Backend or None; warehouse with the loaded tables
+    max_workers - int; number of checks run at once
+
+    Returns QualityReport.
+    """
+    if (frames is None) == (backend is None):
+        raise ValueError('pass either frames or backend')
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda c: run_check(c, frames=frames, backend=backend), checks))
+
+    return QualityReport(results, 'pandas' if frames is not None else 'sql')
@@ -0,0 +1,120 @@
+"""
+Loader for the EIA-861 Sales_Ult_Cust workbook.
+
+The workbook has a 3-level header, and we only need a few of the utility
+characteristic columns and the RESIDENTIAL block.  Rather than parsing the whole
+workbook with pd.read_excel, this streams the rows in read-only mode, keeps only the
+needed columns, and saves a typed Parquet snapshot so later runs skip the XLSX parse.
+"""
+import os
+from operator import itemgetter
+
+from stage_cache import CACHE_DIR, hash_file
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+# bump to invalidate existing snapshots if the parsing below changes
+LOADER_VERSION = '1'
+
+UTILITY_COLUMNS = ['Utility Number', 'Utility Name', 'Service Type', 'Ownership']
+RESIDENTIAL_COLUMNS = ['Thousand Dollars', 'Megawatthours', 'Count']
+
+
+def find_columns(header_rows, groups):
+    """
+    Finds column positions from the 3 header rows.
+    The top level labels are merged cells, so only the first column in each group has a value.
+
+    header_rows - list of 3 tuples; the header rows of the sheet
+    groups - dict of top-level label (e.g. 'RESIDENTIAL') to list of bottom-level labels
+
+    Returns list of column positions and list of column names, in the order of groups.
+    """
+    top, _, bottom = header_rows
+    top_filled = []
+    label = None
+    for value in top:
+        if value is not None:
+            label = str(value).strip()
+        top_filled.append(label)
+
+    positions, names = [], []
+    for group, labels in groups.items():
+        for name in labels:
+            matches = [i for i, (t, b) in enumerate(zip(top_filled, bottom))
+                        if t == group and b is not None and str(b).strip() == name]
+            if not matches:
+                raise ValueError('column {} / {} not found in EIA-861 header'.format(group, name))
+            positions.append(matches[0])
+            names.append(name)
+
+    return positions, names
+
+
+def read_eia861_sales(path, sheet_name=None):
+    """
+    Reads the utility characteristics and residential columns from the workbook.
+
+    path - string; path to Sales_Ult_Cust xlsx file
+    sheet_name - string or None; sheet to read (default is the first sheet)
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header_rows = [next(rows) for _ in range(3)]
+        positions, names = find_columns(header_rows, {'Utility Characteristics': UTILITY_COLUMNS,
+                                                    'RESIDENTIAL': RESIDENTIAL_COLUMNS})
+        get_columns = itemgetter(*positions)
+        data = [get_columns(r) for r in rows]
+    finally:
+        workbook.close()
+
+    df = pd.DataFrame(data, columns=names)
+    # read-only mode can return trailing blank rows
+    df.dropna(how='all', inplace=True)
+
+    # missing data seems to be a period
+    for c in RESIDENTIAL_COLUMNS:
+        df[c] = pd.to_numeric(df[c].replace('.', np.nan)).astype('float')
+
+    df['Utility Number'] = pd.to_numeric(df['Utility Number'])
+    for c in ['Utility Name', 'Service Type', 'Ownership']:
+        df[c] = df[c].astype('str').where(df[c].notna())
+
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def load_eia861_sales(path, snapshot_dir=CACHE_DIR, use_snapshot=True):
+    """
+    Loads the needed EIA-861 columns, from a Parquet snapshot if the workbook hasn't changed.
+
+    path - string; path to Sales_Ult_Cust xlsx file
+    snapshot_dir - string; directory for snapshots
+    use_snapshot - boolean; if True, reads/writes the snapshot
+    """
+    if not use_snapshot:
+        return read_eia861_sales(path)
+
+    key = hash_file(path, cache_dir=snapshot_dir)[:20]
+    snapshot = os.path.join(snapshot_dir, 'eia861-v{}-{}.parquet'.format(LOADER_VERSION, key))
+    if os.path.exists(snapshot):
+        return pd.read_parquet(snapshot)
+
+    df = read_eia861_sales(path)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # only keep the snapshot for the current workbook
+    for fn in os.listdir(snapshot_dir):
+        if fn.startswith('eia861-') and fn.endswith('.parquet'):
+            os.remove(os.path.join(snapshot_dir, fn))
+
+    tmp_path = '{}.{}.tmp'.format(snapshot, os.getpid())
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, snapshot)
+    return df
@@ -1,17 +1,106 @@
 import os
+import argparse
 import configparser
 
-import pandas as pd
-import numpy as np
-import psycopg2
-import psycopg2.extras
+import sql_queries as sql_q
+from zipcode_utils import normalize_zipcodes, clean_zipcode_column, join_on_zipcode, ValidZipcodes
+from lbnl_streaming import stream_lbnl_aggregates
+from stage_cache import cached_stage
+from aggregations import group_mode
+from pipeline import Stage, run_stages
+import eia861
+import s3_loader
+import incremental_load
+import warehouse
+import rollups
+import query_cache
+import backends
+import instrumentation
+import data_quality
+import table_sources
+import arrow_frames
+from sql_utils import execute, insert_frame
+from frame_schemas import apply_schema, read_dtypes, zipcode_dtype
+from lazy_imports import lazy_module
 
-# Set up GCP API
-from google.cloud import bigquery
-# Construct a BigQuery client object.
-client = bigquery.Client()
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
 
-import sql_queries as sql_q
+
+# set SOLAR_DATA_DIR to read the input files from another directory, e.g. synthetic data from synthetic_data.py
+DATA_DIR = os.environ.get('SOLAR_DATA_DIR', '../data')
+
+
+def input_paths(data_dir):
+    """
+    Gets the paths of the input files (and the merged data csv) in a data directory.
+
+    data_dir - string; directory with the downloaded datasets
+    """
+    return {'LBNL_FILES': [os.path.join(data_dir, 'TTS_LBNL_public_file_10-Dec-2019_p1.csv'),
+                            os.path.join(data_dir, 'TTS_LBNL_public_file_10-Dec-2019_p2.csv')],
+            'EIA_ZIPCODE_FILES': [os.path.join(data_dir, 'iouzipcodes2017.csv'),
+                                    os.path.join(data_dir, 'noniouzipcodes2017.csv')],
+            'EIA861_FILE': os.path.join(data_dir, 'Sales_Ult_Cust_2018.xlsx'),
+            'ZIPCODE_FILE': os.path.join(data_dir, 'free-zipcode-database-Primary.csv'),
+            'ACS_CSV': os.path.join(data_dir, 'acs_data.csv'),
+            'PSR_CSV': os.path.join(data_dir, 'psr_data.csv'),
+            'SOLAR_METRICS_CSV': os.path.join(data_dir, 'solar_metrics_data.csv')}
+
+
+_paths = input_paths(DATA_DIR)
+LBNL_FILES = _paths['LBNL_FILES']
+EIA_ZIPCODE_FILES = _paths['EIA_ZIPCODE_FILES']
+EIA861_FILE = _paths['EIA861_FILE']
+ZIPCODE_FILE = _paths['ZIPCODE_FILE']
+ACS_CSV = _paths['ACS_CSV']
+PSR_CSV = _paths['PSR_CSV']
+SOLAR_METRICS_CSV = _paths['SOLAR_METRICS_CSV']
+
+UTILITY_COLUMNS = ['zip', 'Utility Name', 'Ownership', 'Service Type']
+
+QUALITY_REPORT_FILE = os.path.join(data_quality.REPORT_DIR, 'quality_report.json')
+WAREHOUSE_QUALITY_REPORT_FILE = os.path.join(data_quality.REPORT_DIR, 'warehouse_quality_report.json')
+
+_bigquery_client = None
+
+
+def set_data_dir(data_dir):
+    """
+    Points the input file paths at another data directory.
+
+    data_dir - string; directory with the datasets, named like the downloaded files
+    """
+    global DATA_DIR
+    DATA_DIR = data_dir
+    globals().update(input_paths(data_dir))
+    # stage processes started with spawn re-import this module
+    os.environ['SOLAR_DATA_DIR'] = data_dir
+
+
+def get_bigquery_client():
+    """
+    Makes BigQuery client object (only once), so etl can be imported without GCP credentials.
+    """
+    global _bigquery_client
+    if _bigquery_client is None:
+        # Set up GCP API
+        from google.cloud import bigquery
+        _bigquery_client = bigquery.Client()
+
+    return _bigquery_client
+
+
+def get_table_source(name=table_sources.DEFAULT_SOURCE):
+    """
+    Makes the source of the ACS and project sunroof tables (see table_sources.py).
+
+    name - string; 'bigquery', or 'files' to read ACS_CSV and PSR_CSV instead (no GCP credentials needed)
+    """
+    if name == 'files':
+        return table_sources.get_source('files', acs_csv=ACS_CSV, psr_csv=PSR_CSV)
+
+    return table_sources.get_source(name)
 
 
 def convert_int_zipcode_to_str(df, col):
@@ -21,8 +110,7 @@ def convert_int_zipcode_to_str(df, col):
     df - pandas dataframe with zipcode int column
     col - string; name of column with zipcodes
     """
-    df[col] = df[col].astype('str')
-    df[col] = df[col].apply(lambda x: x.zfill(5))
+    df[col] = normalize_zipcodes(df[col], truncate=False)
 
 
 def remove_bad_zipcodes(zip_df, df, col):
@@ -34,32 +122,27 @@ def remove_bad_zipcodes(zip_df, df, col):
     df - pandas dataframe to be cleaned
     col - string; column name of zipcode column in df
     """
-    zip_set = set(zip_df['Zipcode'].unique())
-    return df[df[col].isin(zip_set)]
+    # the valid zipcode index is only built once per zip_df
+    return ValidZipcodes.from_zip_df(zip_df).filter(df, col)
 
 
 def load_lbnl_data(zip_df, replace_nans=True, short_zips=True):
     """
-    Loads LBNL solar survey data.
+    Loads the LBNL solar survey columns in the 'lbnl_installs' schema.
 
     zip_df - pandas dataframe with zipcode data for cleaning bad zipcodes
     replace_nans - boolean; if True, replaces -9999 missing value placeholders with np.nan
     short_zips - boolean; if True, makes sure all zip codes are 5-digit
     """
-    df1 = pd.read_csv('../data/TTS_LBNL_public_file_10-Dec-2019_p1.csv', encoding='latin-1', low_memory=False)
-    df2 = pd.read_csv('../data/TTS_LBNL_public_file_10-Dec-2019_p2.csv', encoding='latin-1', low_memory=False)
-    lbnl_df = pd.concat([df1, df2], axis=0)
+    # only the columns in the schema, with installer and manufacturer names as categoricals;
+    # both parts go into one Arrow table, which is converted to pandas once
+    lbnl_df = arrow_frames.read_csv_frame(LBNL_FILES, read_dtypes('lbnl_installs'), encoding='latin-1')
     if replace_nans:
         lbnl_df.replace(-9999, np.nan, inplace=True)
         lbnl_df.replace('-9999', np.nan, inplace=True)
     
-    if short_zips:
-        lbnl_df['Zip Code'] = lbnl_df['Zip Code'].apply(lambda x: x.strip()[:5])
-    
-    # a few zip codes with only 4 digits
-    lbnl_df['Zip Code'] = lbnl_df['Zip Code'].apply(lambda x: x.zfill(5))
-    
-    lbnl_df = remove_bad_zipcodes(zip_df, lbnl_df, 'Zip Code')
+    # a few zip codes with only 4 digits, and some are ZIP+4
+    lbnl_df = clean_zipcode_column(zip_df, lbnl_df, 'Zip Code', truncate=short_zips)
     return lbnl_df
 
 
@@ -69,51 +152,59 @@ def load_eia_zipcode_data(zip_df):
 
     zip_df - pandas dataframe with zipcode data for cleaning bad zipcodes
     """
-    iou_df = pd.read_csv('../data/iouzipcodes2017.csv')
-    noniou_df = pd.read_csv('../data/noniouzipcodes2017.csv')
-    eia_zipcode_df = pd.concat([iou_df, noniou_df], axis=0)
+    # the IOU and non-IOU files are read into one Arrow table
+    eia_zipcode_df = arrow_frames.read_csv_frame(EIA_ZIPCODE_FILES, read_dtypes('eia_zipcodes'))
     
     # zip codes are ints without zero padding
     convert_int_zipcode_to_str(eia_zipcode_df, 'zip')
     eia_zipcode_df = remove_bad_zipcodes(zip_df, eia_zipcode_df, 'zip')
     
-    return eia_zipcode_df
+    return apply_schema(eia_zipcode_df, 'eia_zipcodes', zip_dtype=ValidZipcodes.from_zip_df(zip_df).dtype)
 
 
-def extract_lbnl_data(zip_df):
+@cached_stage(input_files=lambda: LBNL_FILES)
+def extract_lbnl_data(zip_df, streaming=False, chunksize=250000):
     """
     Gets data from LBNL dataset for the installer table and main metrics table.
 
     zip_df - pandas dataframe with zipcode data for cleaning bad zipcodes
+    streaming - boolean; if True, reads only the needed columns in chunks and keeps
+        running aggregates, so memory use stays flat as the LBNL data grows
+    chunksize - int; number of rows per chunk when streaming
     """
-    lbnl_df = load_lbnl_data(zip_df, replace_nans=False)
+    if streaming:
+        manufacturer_modes, installer_modes, lbnl_zip_groups = stream_lbnl_aggregates(zip_df, LBNL_FILES, chunksize=chunksize)
+    else:
+        lbnl_df = load_lbnl_data(zip_df, replace_nans=False)
 
-    # get mode of module manufacturer #1 for each install company
-    # doesn't seem to work when -9999 values are replaced with NaNs
-    manufacturer_modes = lbnl_df[['Installer Name', 'Module Manufacturer #1']].groupby('Installer Name').agg(lambda x: x.value_counts().index[0])
-    manufacturer_modes.reset_index(inplace=True)
-    # dictionary of installer name to ID
-    id_install_dict = {}
-    for i, r in manufacturer_modes.iterrows():
-        id_install_dict[r['Installer Name']] = i
+        # get mode of module manufacturer #1 for each install company
+        # doesn't seem to work when -9999 values are replaced with NaNs
+        manufacturer_modes = group_mode(lbnl_df, 'Installer Name', ['Module Manufacturer #1'])
+        manufacturer_modes.reset_index(inplace=True)
 
-    # get primary installers by zipcode
-    installer_modes = lbnl_df[['Installer Name', 'Zip Code']].groupby('Zip Code').agg(lambda x: x.value_counts().index[0])
+        # get primary installers by zipcode
+        installer_modes = group_mode(lbnl_df, 'Zip Code', ['Installer Name'])
 
-    lbnl_zip_data = lbnl_df[['Battery System', 'Feed-in Tariff (Annual Payment)', 'Zip Code']].copy()
+        # replace makes a new frame, so lbnl_df doesn't need to be copied first
+        lbnl_zip_data = lbnl_df[['Battery System', 'Feed-in Tariff (Annual Payment)', 'Zip Code']].replace(-9999, 0)
+        lbnl_zip_groups = lbnl_zip_data.groupby('Zip Code', observed=True).mean()
+
+    # installer name to ID
+    installer_ids = pd.Series(manufacturer_modes.index, index=manufacturer_modes['Installer Name'].astype('object'))
 
-    lbnl_zip_data.replace(-9999, 0, inplace=True)
-    lbnl_zip_groups = lbnl_zip_data.groupby('Zip Code').mean()
     # merge with most common installer by zip codes
     lbnl_zip_groups = lbnl_zip_groups.merge(installer_modes, left_index=True, right_index=True)
     lbnl_zip_groups = lbnl_zip_groups[~(lbnl_zip_groups.index == '-9999')]
     lbnl_zip_groups.reset_index(inplace=True)
-    lbnl_zip_groups['Installer ID'] = lbnl_zip_groups['Installer Name'].replace(id_install_dict)
-    lbnl_zip_groups['Installer ID'] = lbnl_zip_groups['Installer ID'].astype('int')
+    # names may be categorical, so they're mapped as plain values
+    lbnl_zip_groups['Installer ID'] = lbnl_zip_groups['Installer Name'].astype('object').map(installer_ids).astype('int')
 
-    return manufacturer_modes.reset_index(), lbnl_zip_groups
+    zip_dtype = ValidZipcodes.from_zip_df(zip_df).dtype
+    return (apply_schema(manufacturer_modes.reset_index(), 'installer'),
+            apply_schema(lbnl_zip_groups, 'lbnl', zip_dtype=zip_dtype))
 
 
+@cached_stage(input_files=lambda: EIA_ZIPCODE_FILES + [EIA861_FILE])
 def extract_eia_data(zip_df):
     """
     Extracts data from EIA for main metrics table and utility table.
@@ -124,37 +215,20 @@ def extract_eia_data(zip_df):
     """
     # load zipcode to eiaid/util number data
     eia_zip_df = load_eia_zipcode_data(zip_df)
-    # eia861 report loading
-    eia861_df = pd.read_excel('../data/Sales_Ult_Cust_2018.xlsx', header=[0, 1, 2])
+    # eia861 report loading; only the utility characteristics and residential columns
+    eia861_df = apply_schema(eia861.load_eia861_sales(EIA861_FILE), 'eia861')
 
     # util number here is eiaia in the IOU data
-    # get relevant columns from multiindex dataframe
-    utility_number = eia861_df['Utility Characteristics', 'Unnamed: 1_level_1', 'Utility Number']
-    utility_name = eia861_df['Utility Characteristics', 'Unnamed: 2_level_1', 'Utility Name']
-    service_type = eia861_df['Utility Characteristics', 'Unnamed: 4_level_1', 'Service Type']
-    ownership = eia861_df['Utility Characteristics', 'Unnamed: 7_level_1', 'Ownership']
-    eia_utility_data = pd.concat([utility_number, utility_name, service_type, ownership], axis=1)
-    eia_utility_data.columns = eia_utility_data.columns.droplevel(0).droplevel(0)
+    eia_utility_data = eia861_df[eia861.UTILITY_COLUMNS]
 
     # get residential cost and kwh usage data
-    res_data = eia861_df['RESIDENTIAL'].copy()
-    # drop uppermost level
-    res_data.columns = res_data.columns.droplevel(0)
-
-    # missing data seems to be a period
-    res_data.replace('.', np.nan, inplace=True)
-    for c in res_data.columns:
-        res_data[c] = res_data[c].astype('float')
-
-    util_number_data = pd.DataFrame(utility_number)
-    util_number_data.columns = util_number_data.columns.droplevel(0).droplevel(0)
-    res_data = pd.concat([res_data, utility_number], axis=1)
-    res_data.columns = ['Thousand Dollars', 'Megawatthours', 'Count', 'Utility Number']
+    # missing data (a period in the workbook) is already NaN
+    res_data = eia861_df[eia861.RESIDENTIAL_COLUMNS + ['Utility Number']]
 
     # first join with zipcode data to group by zip
     res_data_zip = res_data.merge(eia_zip_df, left_on='Utility Number', right_on='eiaid')
     # group by zip and get sums of revenues, MWh, and customer count
-    res_data_zip = res_data_zip.groupby('zip').sum()
+    res_data_zip = res_data_zip.groupby('zip', observed=True)[eia861.RESIDENTIAL_COLUMNS].sum()
     # convert revenues to yearly bill and MWh to kWh
     # thousand dollars of revenue divided by customer count
     res_data_zip['average_yearly_bill'] = res_data_zip['Thousand Dollars'] * 1000 / res_data_zip['Count']
@@ -170,7 +244,7 @@ def extract_eia_data(zip_df):
     # combine zipcodes with EIA861 utility data
     eia_util_zipcode = eia_utility_data.merge(eia_zip_df, left_on='Utility Number', right_on='eiaid')
     # get most-common utility name, service type, and ownership by zipcode
-    common_util = eia_util_zipcode[['zip', 'Utility Name', 'Service Type', 'Ownership']].groupby('zip').agg(lambda x: x.value_counts().index[0])
+    common_util = group_mode(eia_util_zipcode, 'zip', ['Utility Name', 'Service Type', 'Ownership'])
 
     eia_861_summary = res_data_zip.merge(common_util, left_index=True, right_index=True)
     # change zip back to a column
@@ -178,27 +252,37 @@ def extract_eia_data(zip_df):
     
     eia_861_summary = remove_bad_zipcodes(zip_df, eia_861_summary, 'zip')
 
-    return eia_861_summary
+    return apply_schema(eia_861_summary, 'eia', zip_dtype=ValidZipcodes.from_zip_df(zip_df).dtype)
 
 
-def extract_acs_data(zip_df, load_csv=True, save_csv=True):
+@cached_stage(input_files=lambda: [ACS_CSV])
+def extract_acs_data(zip_df, load_csv=True, save_csv=True, streaming=True, source=table_sources.DEFAULT_SOURCE):
     """
     Extracts ACS US census data from Google BigQuery.
 
     zip_df - pandas dataframe with zipcode data for cleaning bad zipcodes
     load_csv - boolean; if True, tries to load data from csv
     save_csv - boolean; if True, will save data to csv if downloading anew
+    streaming - boolean; if True, reads Arrow record batches with the BigQuery Storage API
+        and validates zipcodes batch by batch, instead of running a query with pd.read_gbq
+    source - string; table source for streaming (see get_table_source)
     """
     # ACS US census data
     ACS_DB = '`bigquery-public-data`.census_bureau_acs'
     ACS_TABLE = 'zip_codes_2017_5yr'
 
 
-    filename = '../data/acs_data.csv'
+    filename = ACS_CSV
     if load_csv and os.path.exists(filename):
-        acs_df = pd.read_csv(filename)
+        acs_df = pd.read_csv(filename, dtype=read_dtypes('acs'))
         convert_int_zipcode_to_str(acs_df, 'geo_id')
-        return acs_df
+        return apply_schema(acs_df, 'acs', zip_dtype=ValidZipcodes.from_zip_df(zip_df).dtype)
+
+    valid_zips = ValidZipcodes.from_zip_df(zip_df)
+    if streaming:
+        # zipcodes are validated as the batches arrive
+        acs_data = table_sources.read_table(get_table_source(source), table_sources.ACS_SPEC, valid_zips)
+        return save_extract(apply_schema(acs_data, 'acs', zip_dtype=valid_zips.dtype), filename, save_csv)
     
     acs_data_query = f"""SELECT   geo_id,
                         median_age,
@@ -214,29 +298,43 @@ def extract_acs_data(zip_df, load_csv=True, save_csv=True):
     acs_data = pd.read_gbq(acs_data_query)
 
     acs_data = remove_bad_zipcodes(zip_df, acs_data, 'geo_id')
-
-    if save_csv:
-        acs_data.to_csv(filename, index=False)
-    
-    return acs_data
+    return save_extract(apply_schema(acs_data, 'acs', zip_dtype=valid_zips.dtype), filename, save_csv)
 
 
-def extract_psr_data(zip_df, load_csv=True, save_csv=True):
+@cached_stage(input_files=lambda: [PSR_CSV])
+def extract_psr_data(zip_df, load_csv=True, save_csv=True, streaming=True, source=table_sources.DEFAULT_SOURCE):
     """
     Extracts project sunroof data from Google BigQuery.-
 
     zip_df - pandas dataframe with zipcode data for cleaning bad zipcodes
     load_csv - boolean; if True, tries to load data from csv
     save_csv - boolean; if True, will save data to csv if downloading anew
+    streaming - boolean; if True, reads Arrow record batches with the BigQuery Storage API
+        and validates zipcodes batch by batch, instead of running a query with pd.read_gbq
+    source - string; table source for streaming (see get_table_source)
     """
-    PSR_DB = '`bigquery-public-data`.sunroof_solar'
-    PSR_TABLE = 'solar_potential_by_postal_code'
-
-    filename = '../data/psr_data.csv'
+    filename = PSR_CSV
     if load_csv and os.path.exists(filename):
-        df = pd.read_csv(filename)
+        df = pd.read_csv(filename, dtype=read_dtypes('psr'))
         convert_int_zipcode_to_str(df, 'region_name')
-        return df
+        return apply_schema(df, 'psr', zip_dtype=ValidZipcodes.from_zip_df(zip_df).dtype)
+
+    valid_zips = ValidZipcodes.from_zip_df(zip_df)
+    if streaming:
+        # zipcodes are validated as the batches arrive
+        psr_df = drop_small_psr_duplicates(table_sources.read_table(get_table_source(source), table_sources.PSR_SPEC, valid_zips))
+    else:
+        psr_df = valid_zips.filter(drop_small_psr_duplicates(read_psr_query()), 'region_name')
+
+    return save_extract(apply_schema(psr_df, 'psr', zip_dtype=valid_zips.dtype), filename, save_csv)
+
+
+def read_psr_query():
+    """
+    Reads the project sunroof data with a BigQuery query.
+    """
+    PSR_DB = '`bigquery-public-data`.sunroof_solar'
+    PSR_TABLE = 'solar_potential_by_postal_code'
 
     psr_query = f"""SELECT region_name,
                         percent_covered,
@@ -247,8 +345,15 @@ def extract_psr_data(zip_df, load_csv=True, save_csv=True):
                         FROM {PSR_DB}.{PSR_TABLE};
                         """
 
-    psr_df = pd.read_gbq(psr_query)
+    return pd.read_gbq(psr_query)
 
+
+def drop_small_psr_duplicates(psr_df):
+    """
+    Drops the small duplicates of zipcodes in the project sunroof data.
+
+    psr_df - pandas dataframe with project sunroof data
+    """
     # some duplicate zip codes; seems to be one that includes most data and a few extra
     # drop dupes with small pct covered
     # ideally we would add them together, but different columns have to be combined in different ways
@@ -256,45 +361,43 @@ def extract_psr_data(zip_df, load_csv=True, save_csv=True):
     duplicates = psr_df[dupe_idx]
     psr_df = psr_df[~dupe_idx]
     duplicates = duplicates[duplicates['percent_covered'] > 5]
-    psr_df = pd.concat([psr_df, duplicates])
+    return pd.concat([psr_df, duplicates])
 
-    psr_df = remove_bad_zipcodes(zip_df, psr_df, 'region_name')
 
+def save_extract(df, filename, save_csv=True):
+    """
+    Saves extracted data to a csv, so later runs can load it instead of downloading it again.
+
+    df - pandas dataframe
+    filename - string; csv path
+    save_csv - boolean; if False, does nothing
+    """
     if save_csv:
-        psr_df.to_csv(filename, index=False)
+        df.to_csv(filename, index=False)
+        instrumentation.record_bytes(os.path.getsize(filename))
 
-    return psr_df
+    return df
 
 
+@cached_stage(input_files=lambda: [ZIPCODE_FILE])
 def extract_zipcode_data():
     """
     Extracts zipcode, city, state, lat/lng data from zipcode dataset.
     """
-    filename = '../data/free-zipcode-database-Primary.csv'
+    filename = ZIPCODE_FILE
 
-    zip_df = pd.read_csv(filename)
+    cols = ['Zipcode', 'City', 'State', 'Lat', 'Long']
+    zip_df = pd.read_csv(filename, usecols=cols + ['Decommisioned'], dtype=read_dtypes('zipcodes'))
     convert_int_zipcode_to_str(zip_df, 'Zipcode')
 
     # don't use decomissioned zipcodes
     zip_df = zip_df[~zip_df['Decommisioned']]
 
-    cols = ['Zipcode', 'City', 'State', 'Lat', 'Long']
-    return zip_df[cols]
-
-
-def fill_zips(x):
-    if not pd.isna(x['zip']):
-        return x['zip']
-    elif not pd.isna(x['Zip Code']):
-        return x['Zip Code']
-    elif not pd.isna(x['geo_id']):
-        return x['geo_id']
-    elif not pd.isna(x['region_name']):
-        return x['region_name']
-    else:
-        return np.nan
+    # zipcodes are categorical over themselves; every other dataset's zipcodes use the same categories
+    return apply_schema(zip_df[cols], 'zipcodes', zip_dtype=ValidZipcodes(zip_df['Zipcode']).dtype)
 
 
+@cached_stage(input_files=lambda: [SOLAR_METRICS_CSV])
 def merge_data(psr, acs, lbnl, eia, read_csv=True, write_csv=True, how='outer'):
     """
     Combines EIA, ACS, project sunroof, and LBNL datasets in preparation for writing to the database.
@@ -305,34 +408,23 @@ def merge_data(psr, acs, lbnl, eia, read_csv=True, write_csv=True, how='outer'):
     eia - pandas DataFrame with EIA data
     read_csv - boolean; if True, tries to read csv file if exists
     write_csv - boolean; if True, writes final dataframe to csv
-    how - string; type of merge to perform like outer, inner, etc
+    how - string; type of merge to perform: outer, inner, left (EIA zip codes) or right (project sunroof zip codes)
     """
-    filename = '../data/solar_metrics_data.csv'
+    filename = SOLAR_METRICS_CSV
+    # full_zip has the same categories as the zipcodes of the datasets
+    zip_dtype = zipcode_dtype(eia['zip'], lbnl['Zip Code'], acs['geo_id'], psr['region_name'])
     if read_csv and os.path.exists(filename):
-        final_df = pd.read_csv(filename)
-        # columns to convert to nullable integer type
-        cols = ['Installer ID', 
-                'potential_installs',
-                'number_of_panels_total',
-                'occupied_housing_units',
-                'owner_occupied_housing_units',
-                'family_homes',
-                'bachelors_degree_2',
-                'moved_recently']
-        for c in cols:
-            final_df[c] = final_df[c].astype('Int64')
-        
-        return final_df
+        final_df = pd.read_csv(filename, dtype=read_dtypes('solar_metrics'))
+        return apply_schema(final_df, 'solar_metrics', zip_dtype=zip_dtype)
 
     # eia have most zips, followed by lbnl then acs then psr
-    # merge, then make column of zip codes with none missing after each step
-    eia_lbnl = eia.merge(lbnl, left_on='zip', right_on='Zip Code', how=how)
-    eia_lbnl['full_zip'] = eia_lbnl.apply(fill_zips, axis=1)
-    eia_lbnl_acs = eia_lbnl.merge(acs, left_on='full_zip', right_on='geo_id', how=how)
-    eia_lbnl_acs['full_zip'] = eia_lbnl_acs.apply(fill_zips, axis=1)
-    eia_lbnl_acs_psr = eia_lbnl_acs.merge(psr, left_on='full_zip', right_on='region_name', how=how)
-    # combine different zip code columns to make one column with no missing values
-    eia_lbnl_acs_psr['full_zip'] = eia_lbnl_acs_psr.apply(fill_zips, axis=1)
+    # join all four on one zip code index; full_zip has the zip code from whichever dataset has it
+    eia_lbnl_acs_psr = join_on_zipcode([(eia, 'zip'),
+                                        (lbnl, 'Zip Code'),
+                                        (acs, 'geo_id'),
+                                        (psr, 'region_name')],
+                                        how=how,
+                                        key_name='full_zip')
 
     # columns we'll use in the same order as the DB table
     cols_to_use = ['full_zip',
@@ -353,43 +445,22 @@ def merge_data(psr, acs, lbnl, eia, read_csv=True, write_csv=True, how='outer'):
                 'Battery System',
                 'Feed-in Tariff (Annual Payment)']
 
-    final_df = eia_lbnl_acs_psr[cols_to_use]
-    
-    # columns to convert to nullable integer type
-    cols = ['Installer ID', 
-            'potential_installs',
-            'number_of_panels_total',
-            'occupied_housing_units',
-            'owner_occupied_housing_units',
-            'family_homes',
-            'bachelors_degree_2',
-            'moved_recently']
-    for c in cols:
-        final_df[c] = final_df[c].astype('Int64')
+    # full_zip comes out of the join as strings
+    final_df = apply_schema(eia_lbnl_acs_psr[cols_to_use], 'solar_metrics', zip_dtype=zip_dtype)
 
     if write_csv:
         final_df.to_csv(filename, index=False)
+        instrumentation.record_bytes(os.path.getsize(filename))
     
     return final_df
 
 
-def check_zips_len_5(df, zip_list):
-    """
-    Make sure all zip codes have length of 5
-
-    df - pandas dataframe; dataframe with zip codes and other data
-    zip_list - list; list of zip codes as strings
+def zipcode_data_quality_checks(psr_df, acs_df, lbnl_df, eia_df, zip_df, final_df, gate=False, report_file=None):
     """
-    are5 = sum([len(l) == 5 for l in zip_list])
-    return are5 == df.shape[0]
-
-
-def zipcode_data_quality_checks(psr_df, acs_df, lbnl_df, eia_df, zip_df, final_df):
-    """
-    data quality checks: 
-    1. Make sure there are no duplicate zip codes left in individual dfs
-    2. Make sure total number of zips not above max of 42107
-    3. Ensure all zip codes in our data are also in the zipcode dataset. 
+    data quality checks (see data_quality.FRAME_CHECKS):
+    1. Make sure all zip codes are length 5 and there are no duplicate zip codes left in individual dfs
+    2. Make sure total number of zips not above max of 41,859
+    3. Ensure all zip codes in our data are also in the zipcode dataset.
 
     psr_df - pandas dataframe with project sunroof data
     acs_df - pandas dataframe with ACS data
@@ -397,65 +468,48 @@ def zipcode_data_quality_checks(psr_df, acs_df, lbnl_df, eia_df, zip_df, final_d
     eia_df - pandas dataframe with EIA861 data
     zip_df - pandas dataframe with zipcodes, cities, states, lat/lng
     final_df - merged dataframe of the first 4 dataframes (psr, acs, lbnl, eia)
+    gate - boolean; if True, raises DataQualityError if a check with severity 'error' failed
+    report_file - string or None; path to write the JSON report to
+
+    Returns the report as a dict.
     """
-    # check 1 -- make sure no duplicate zip codes in dfs
-    psr_zips = set(psr_df['region_name'].unique())
-    acs_zips = set(acs_df['geo_id'].unique())
-    lbnl_zips = set(lbnl_df['Zip Code'].unique())
-    eia_zips = set(eia_df['zip'].unique())
+    frames = {'psr': psr_df, 'acs': acs_df, 'lbnl': lbnl_df, 'eia': eia_df, 'zipcodes': zip_df, 'merge': final_df}
+    report = data_quality.run_checks(data_quality.FRAME_CHECKS, frames=frames)
+    print(report.summary())
+    if report_file is not None:
+        report.write(report_file)
+    if gate:
+        report.raise_for_errors()
 
-    if not check_zips_len_5(psr_df, psr_zips):
-        print('DATA QUALITY CHECK ERROR:')
-        print('project solar zip codes not all length 5')
-    else:
-        print('CHECK PASSED: project solar zip codes all length 5')
-    if not check_zips_len_5(acs_df, acs_zips):
-        print('DATA QUALITY CHECK ERROR:')
-        print('ACS zip codes not all length 5')
-    else:
-        print('CHECK PASSED: ACS zip codes all length 5')
-    if not check_zips_len_5(lbnl_df, lbnl_zips):
-        print('DATA QUALITY CHECK ERROR:')
-        print('LBNL zip codes not all length 5')
-    else:
-        print('CHECK PASSED: LBNL zip codes all length 5')
-    if not check_zips_len_5(eia_df, eia_zips):
-        print('DATA QUALITY CHECK ERROR:')
-        print('EIA zip codes not all length 5')
-    else:
-        print('CHECK PASSED: EIA zip codes all length 5')
+    return report.to_dict()
 
-    # check 2 -- ensure zip codes does not exceed max number
-    total_zips = len(eia_zips.union(lbnl_zips).union(acs_zips).union(psr_zips))
-    if total_zips > 41859:
-        print('FAILED DATA QUALITY CHECK:')
-        print(f'number of zip codes is {total_zips}; max should be 41,859')
-    else:
-        print('CHECK PASSED: total number of zip codes below maximum')
 
+def warehouse_quality_checks(backend='redshift', gate=False, report_file=None):
+    """
+    Runs the data quality checks as SQL on the loaded tables (see data_quality.WAREHOUSE_CHECKS).
+
+    backend - string; name of backend with the loaded tables
+    gate - boolean; if True, raises DataQualityError if a check with severity 'error' failed
+    report_file - string or None; path to write the JSON report to
 
-    # check 3 -- make sure zipcodes in full dataset are also in zipcode/city/state dataset
-    # from this test I found some zipcodes in the data are erroneous
-    full_zips = set(final_df['full_zip'].unique())
-    zips = set(zip_df['Zipcode'].unique())
-    zipdiff = len(full_zips.difference(zips))
-    if zipdiff > 0:
-        print('FAILED DATA QUALITY CHECK:')
-        print(f'{zipdiff} zipcodes in full dataset not in zipcode dataset')
-    else:
-        print('CHECK PASSED: all zipcodes in full dataset also in zipcode dataset')
+    Returns the report as a dict.
+    """
+    report = data_quality.run_checks(data_quality.WAREHOUSE_CHECKS, backend=backends.get_backend(backend))
+    print(report.summary())
+    if report_file is not None:
+        report.write(report_file)
+    if gate:
+        report.raise_for_errors()
+
+    return report.to_dict()
 
 
 def make_redshift_connection():
     """
     Makes connection to redshift cluster.
     """
-    config = configparser.ConfigParser()
-    # should be connection_filename from infrastructure_as_code.py
-    config_file = os.path.expanduser('~/.aws_config/solar_cluster.cfg')
-    config.read(config_file)
-
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    # connection config is only read once; see warehouse.py for pooled connections
+    conn = warehouse.connect()
     cur = conn.cursor()
 
     return conn, cur
@@ -468,8 +522,7 @@ def drop_tables(cur, conn):
     cur and conn and the curson and connection from the psycopg2 API to the redshift DB.
     """
     for q in sql_q.drop_table_queries:
-        print('executing query: {}'.format(q))
-        cur.execute(q)
+        execute(cur, q)
         conn.commit()
 
 
@@ -480,8 +533,7 @@ def create_tables(cur, conn):
     cur and conn and the curson and connection from the psycopg2 API to the redshift DB.
     """
     for q in sql_q.create_table_queries:
-        print('executing query: {}'.format(q))
-        cur.execute(q)
+        execute(cur, q)
         conn.commit()
     
 
@@ -498,23 +550,10 @@ def insert_data(cur, conn, final_df, zip_df, eia_df, manufacturer_df):
     eia_df - pandas dataframe with EIA-861 report data
     manufacturer_df - pandas dataframe with solar manufacturer data
     """
-    print('inserting solar_metric table data...')
-    psycopg2.extras.execute_values(cur, sql_q.solar_metrics_insert, list(final_df.itertuples(index=False, name=None)))
-    # seems to hang here...maybe just slow
-    conn.commit()
-
-    print('inserting zipcodes table data...')
-    psycopg2.extras.execute_values(cur, sql_q.zipcodes_insert, list(zip_df.itertuples(index=False, name=None)))
-    conn.commit()
-
-    print('inserting utility table data...')
-    utility_df = eia_df[['zip', 'Utility Name', 'Ownership', 'Service Type']]
-    psycopg2.extras.execute_values(cur, sql_q.utility_insert, list(utility_df.itertuples(index=False, name=None)))
-    conn.commit()
-
-    print('inserting installer table data...')
-    psycopg2.extras.execute_values(cur, sql_q.installer_insert, list(manufacturer_df.itertuples(index=False, name=None)))
-    conn.commit()
+    # each insert is recorded as a span with its time and row count (see instrumentation.py)
+    for table, df in table_frames(final_df, zip_df, eia_df, manufacturer_df).items():
+        insert_frame(cur, table, sql_q.table_columns[table], df)
+        conn.commit()
 
 
 def write_csvs_to_s3(final_df, zip_df, eia_df, manufacturer_df, bucket='dend-capstone-ncg'):
@@ -527,11 +566,33 @@ def write_csvs_to_s3(final_df, zip_df, eia_df, manufacturer_df, bucket='dend-cap
     manufacturer_df - pandas dataframe with solar manufacturer data
     bucket - string; bucket name
     """
-    final_df.to_csv(f's3://{bucket}/final_df.csv', index=False)
-    zip_df.to_csv(f's3://{bucket}/zip_df.csv', index=False)
-    utility_df = eia_df[['zip', 'Utility Name', 'Ownership', 'Service Type']]
-    utility_df.to_csv(f's3://{bucket}/utility_df.csv', index=False)
-    manufacturer_df.to_csv(f's3://{bucket}/manufacturer_df.csv', index=False)
+    write_df_to_s3(final_df, 'final_df.csv', bucket=bucket)
+    write_df_to_s3(zip_df, 'zip_df.csv', bucket=bucket)
+    write_df_to_s3(eia_df, 'utility_df.csv', columns=UTILITY_COLUMNS, bucket=bucket)
+    write_df_to_s3(manufacturer_df, 'manufacturer_df.csv', bucket=bucket)
+
+
+def write_df_to_s3(df, filename, columns=None, bucket='dend-capstone-ncg'):
+    """
+    Writes one pandas dataframe to s3 bucket as csv.
+
+    df - pandas dataframe
+    filename - string; name of file in the bucket
+    columns - list of strings or None; columns to write (default all)
+    bucket - string; bucket name
+
+    Returns the s3 path of the file.
+    """
+    import s3fs
+
+    table = arrow_frames.to_arrow(df, preserve_index=False)
+    if columns is not None:
+        table = table.select(columns)
+
+    path = f's3://{bucket}/{filename}'
+    with s3fs.S3FileSystem().open(path, 'wb') as f:
+        arrow_frames.write_csv(table, f)
+    return path
 
 
 def copy_s3_to_redshift(cur, conn, bucket='dend-capstone-ncg'):
@@ -541,65 +602,313 @@ def copy_s3_to_redshift(cur, conn, bucket='dend-capstone-ncg'):
     cur and conn and the curson and connection from the psycopg2 API to the redshift DB.
     bucket - string; bucket name
     """
-    config = configparser.ConfigParser()
-    config_path = os.path.join(os.path.expanduser('~/.aws_config'), 'solar_cluster.cfg')
-    config.read_file(open(config_path))
-
+    iam_role = get_iam_role_arn()
 
     solar_metrics_copy = ("""COPY solar_metrics FROM 's3://{}/final_df.csv'
     credentials 'aws_iam_role={}' IGNOREHEADER 1 CSV;
-    """).format(bucket, config.get('IAM_ROLE', 'ARN'))
+    """).format(bucket, iam_role)
 
-    cur.execute(solar_metrics_copy)
+    execute(cur, solar_metrics_copy)
     conn.commit()
 
     zipcodes_copy = ("""COPY zipcodes FROM 's3://{}/zip_df.csv'
     credentials 'aws_iam_role={}' IGNOREHEADER 1 CSV;
-    """).format(bucket, config.get('IAM_ROLE', 'ARN'))
-    print('executing query:')
-    print(zipcodes_copy)
-
-    cur.execute(zipcodes_copy)
+    """).format(bucket, iam_role)
+    execute(cur, zipcodes_copy)
     conn.commit()
 
     utility_copy = ("""COPY utility FROM 's3://{}/utility_df.csv'
     credentials 'aws_iam_role={}' IGNOREHEADER 1 CSV;
-    """).format(bucket, config.get('IAM_ROLE', 'ARN'))
-    print('executing query:')
-    print(utility_copy)
-
-    cur.execute(utility_copy)
+    """).format(bucket, iam_role)
+    execute(cur, utility_copy)
     conn.commit()
 
     installer_copy = ("""COPY installer FROM 's3://{}/manufacturer_df.csv'
     credentials 'aws_iam_role={}' IGNOREHEADER 1 CSV;
-    """).format(bucket, config.get('IAM_ROLE', 'ARN'))
-    print('executing query:')
-    print(installer_copy)
-
-    cur.execute(installer_copy)
+    """).format(bucket, iam_role)
+    execute(cur, installer_copy)
     conn.commit()
 
 
-if __name__=='__main__':
-    # extracting and transforming data
-    zip_df = extract_zipcode_data()
-    psr_df = extract_psr_data(zip_df, load_csv=True, save_csv=False)
-    acs_df = extract_acs_data(zip_df, load_csv=True, save_csv=False)
-    manufacturer_df, lbnl_df = extract_lbnl_data(zip_df)
-    eia_df = extract_eia_data(zip_df)
+def get_iam_role_arn():
+    """
+    Gets ARN of the IAM role the Redshift cluster uses to read from s3.
+    """
+    config = configparser.ConfigParser()
+    config_path = os.path.join(os.path.expanduser('~/.aws_config'), 'solar_cluster.cfg')
+    config.read_file(open(config_path))
+    return config.get('IAM_ROLE', 'ARN')
 
-    # transforming data
-    final_df = merge_data(psr_df, acs_df, lbnl_df, eia_df, read_csv=True, write_csv=False)
 
-    # quality checks
-    zipcode_data_quality_checks(psr_df, acs_df, lbnl_df, eia_df, zip_df, final_df)
+def get_s3_client():
+    """
+    Makes boto3 S3 client using the default AWS credentials.
+    """
+    import boto3
+    return boto3.client('s3')
 
-    # write data to redshift
-    write_csvs_to_s3(final_df, zip_df, eia_df, manufacturer_df)
 
-    conn, cur = make_redshift_connection()
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-    
-    copy_s3_to_redshift(cur, conn)
\ No newline at end of file
+def get_redshift_slice_count():
+    """
+    Gets number of slices in the Redshift cluster, for splitting staged files.
+    """
+    with warehouse.connection() as conn:
+        return s3_loader.get_slice_count(conn.cursor())
+
+
+def stage_df_to_s3(df, n_slices, table, columns=None, files_per_slice=1, bucket='dend-capstone-ncg', compression='gzip'):
+    """
+    Writes a dataframe to s3 as compressed csv files split across the cluster slices, with a manifest.
+
+    df - pandas dataframe
+    n_slices - int; number of slices in the Redshift cluster
+    table - string; name of the Redshift table the data is for
+    columns - list of strings or None; columns to write (default all)
+    files_per_slice - int; number of files per slice
+    bucket - string; bucket name
+    compression - string or None; 'gzip', 'zstd' or None
+
+    Returns tuple of table name and s3 url of the manifest.
+    """
+    if columns is not None:
+        df = df[columns]
+
+    manifest_url = s3_loader.stage_table(df,
+                                        table,
+                                        bucket,
+                                        n_slices * files_per_slice,
+                                        get_s3_client(),
+                                        compression=compression)
+    return table, manifest_url
+
+
+def copy_staged_to_redshift(staged_tables, compression='gzip'):
+    """
+    Copies staged tables from s3 into Redshift, all tables at the same time.
+
+    staged_tables - list of (table name, manifest url) tuples from stage_df_to_s3
+    compression - string or None; 'gzip', 'zstd' or None
+    """
+    iam_role = get_iam_role_arn()
+    # column lists come from the schema, so the csv column order is checked by COPY
+    statements = {table: s3_loader.copy_statement(table,
+                                                manifest_url,
+                                                iam_role,
+                                                compression=compression,
+                                                columns=sql_q.table_columns[table])
+                    for table, manifest_url in staged_tables}
+    s3_loader.copy_tables_parallel(statements, warehouse.connection)
+
+
+def load_redshift(*staged_tables, compression='gzip'):
+    """
+    Recreates the Redshift tables, copies the staged data into them from s3,
+    and builds the city and state rollup tables.
+
+    staged_tables - (table name, manifest url) tuples from the s3 staging stages
+    compression - string or None; compression of the staged files
+    """
+    with warehouse.connection() as conn:
+        cur = conn.cursor()
+        drop_tables(cur, conn)
+        create_tables(cur, conn)
+    # hashes from past incremental loads no longer match the tables
+    incremental_load.clear_state()
+
+    copy_staged_to_redshift(staged_tables, compression=compression)
+    with warehouse.connection() as conn, instrumentation.span('rebuild rollups', kind='load'):
+        cur = conn.cursor()
+        rollups.rebuild_rollups(cur)
+        # new stamp so cached analysis results from before the reload aren't used
+        query_cache.write_load_version(cur, query_cache.new_load_version())
+
+
+def table_frames(final_df, zip_df, eia_df, manufacturer_df):
+    """
+    Gets the dataframe for each warehouse table, with columns in table order.
+    """
+    return {'solar_metrics': final_df,
+            'zipcodes': zip_df,
+            'utility': eia_df[UTILITY_COLUMNS],
+            'installer': manufacturer_df}
+
+
+def load_backend(final_df, zip_df, eia_df, manufacturer_df, backend='duckdb', incremental=False):
+    """
+    Loads the tables into a warehouse backend (see backends.py) by inserting the dataframes,
+    e.g. into a local DuckDB database.
+
+    final_df - pandas dataframe with all merged data for main fact table
+    zip_df - pandas dataframe with zipcode location data
+    eia_df - pandas dataframe with EIA-861 report data
+    manufacturer_df - pandas dataframe with solar manufacturer data
+    backend - string; name of backend
+    incremental - boolean; if True, only loads changed rows instead of recreating the tables
+
+    Returns dict of table name to number of rows written for incremental loads.
+    """
+    tables = table_frames(final_df, zip_df, eia_df, manufacturer_df)
+    warehouse_backend = backends.get_backend(backend)
+    if incremental:
+        return warehouse_backend.load_incremental(tables)
+
+    warehouse_backend.load_tables(tables)
+
+
+def load_redshift_incremental(final_df, zip_df, eia_df, manufacturer_df):
+    """
+    Loads only rows that changed since the last load into Redshift, in one transaction.
+    Tables are created if they don't exist, and never dropped.
+
+    final_df - pandas dataframe with all merged data for main fact table
+    zip_df - pandas dataframe with zipcode location data
+    eia_df - pandas dataframe with EIA-861 report data
+    manufacturer_df - pandas dataframe with solar manufacturer data
+
+    Returns dict of table name to number of rows written.
+    """
+    return load_backend(final_df, zip_df, eia_df, manufacturer_df, backend='redshift', incremental=True)
+
+
+def build_etl_stages(bucket='dend-capstone-ncg', lbnl_streaming=True, compression='gzip', incremental=False, backend='redshift',
+                        quality_gate=True):
+    """
+    Declares the ETL stages and the stages each one depends on.
+    The four extract stages only depend on the zipcode data, so they run in parallel,
+    and each table is staged in s3 as soon as it's ready.
+
+    bucket - string; bucket name
+    lbnl_streaming - boolean; if True, uses the chunked LBNL extraction
+    compression - string or None; compression of the staged files ('gzip', 'zstd' or None)
+    incremental - boolean; if True, only loads changed rows instead of recreating the tables
+    backend - string; 'redshift', or 'duckdb' to load a local database instead (no s3 staging)
+    quality_gate - boolean; if True, failed data quality checks stop the run, before the load
+        for checks on the dataframes and after it for checks in the warehouse
+    """
+    lbnl_zip_data = ('lbnl', 1)
+    stages = [Stage('zipcodes', extract_zipcode_data),
+                Stage('psr', extract_psr_data, ['zipcodes'], {'load_csv': True, 'save_csv': False}),
+                Stage('acs', extract_acs_data, ['zipcodes'], {'load_csv': True, 'save_csv': False}),
+                Stage('lbnl', extract_lbnl_data, ['zipcodes'], {'streaming': lbnl_streaming}),
+                Stage('eia', extract_eia_data, ['zipcodes']),
+                Stage('merge',
+                        merge_data,
+                        ['psr', 'acs', lbnl_zip_data, 'eia'],
+                        {'read_csv': False, 'write_csv': False},
+                        kind='thread'),
+                Stage('quality_checks',
+                        zipcode_data_quality_checks,
+                        ['psr', 'acs', lbnl_zip_data, 'eia', 'zipcodes', 'merge'],
+                        {'gate': quality_gate, 'report_file': QUALITY_REPORT_FILE},
+                        kind='thread')]
+    warehouse_checks = {'backend': backend, 'gate': quality_gate, 'report_file': WAREHOUSE_QUALITY_REPORT_FILE}
+
+    if backend != 'redshift':
+        stages += [Stage('load_{}'.format(backend),
+                            load_backend,
+                            ['merge', 'zipcodes', 'eia', ('lbnl', 0)],
+                            {'backend': backend, 'incremental': incremental},
+                            kind='thread',
+                            after=['quality_checks']),
+                    Stage('warehouse_checks',
+                            warehouse_quality_checks,
+                            kwargs=warehouse_checks,
+                            kind='thread',
+                            after=['load_{}'.format(backend)])]
+        return stages
+
+    if incremental:
+        stages += [Stage('load_redshift',
+                            load_redshift_incremental,
+                            ['merge', 'zipcodes', 'eia', ('lbnl', 0)],
+                            kind='thread',
+                            after=['quality_checks']),
+                    Stage('warehouse_checks',
+                            warehouse_quality_checks,
+                            kwargs=warehouse_checks,
+                            kind='thread',
+                            after=['load_redshift'])]
+        return stages
+
+    staging = {'bucket': bucket, 'compression': compression}
+    stages += [Stage('slices', get_redshift_slice_count, kind='thread'),
+                Stage('stage_zipcodes',
+                        stage_df_to_s3,
+                        ['zipcodes', 'slices'],
+                        dict(table='zipcodes', **staging),
+                        kind='thread'),
+                Stage('stage_utility',
+                        stage_df_to_s3,
+                        ['eia', 'slices'],
+                        dict(table='utility', columns=UTILITY_COLUMNS, **staging),
+                        kind='thread'),
+                Stage('stage_installer',
+                        stage_df_to_s3,
+                        [('lbnl', 0), 'slices'],
+                        dict(table='installer', **staging),
+                        kind='thread'),
+                Stage('stage_solar_metrics',
+                        stage_df_to_s3,
+                        ['merge', 'slices'],
+                        dict(table='solar_metrics', **staging),
+                        kind='thread'),
+                Stage('load_redshift',
+                        load_redshift,
+                        ['stage_zipcodes', 'stage_utility', 'stage_installer', 'stage_solar_metrics'],
+                        {'compression': compression},
+                        kind='thread',
+                        after=['quality_checks']),
+                Stage('warehouse_checks',
+                        warehouse_quality_checks,
+                        kwargs=warehouse_checks,
+                        kind='thread',
+                        after=['load_redshift'])]
+    return stages
+
+
+def run_etl(bucket='dend-capstone-ncg', max_workers=None, incremental=False, backend='redshift', quality_gate=True):
+    """
+    Runs the full ETL, with independent stages in parallel.
+
+    bucket - string; bucket name
+    max_workers - int or None; number of processes for the extract stages
+    incremental - boolean; if True, only loads changed rows instead of recreating the tables
+    backend - string; 'redshift' or 'duckdb'
+    quality_gate - boolean; if False, failed data quality checks are only reported
+
+    Returns PipelineResult with stage outputs and timings.
+    """
+    stages = build_etl_stages(bucket=bucket, incremental=incremental, backend=backend, quality_gate=quality_gate)
+    # stage and statement spans go to the run's file in SPANS_DIR, and totals to a Prometheus textfile at the end
+    with instrumentation.run('etl'):
+        exchange_dir = arrow_frames.EXCHANGE_DIR if arrow_frames.EXCHANGE_ENABLED else None
+        return run_stages(stages, max_workers=max_workers, exchange_dir=exchange_dir)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Extracts, transforms and loads the solar data into Redshift.')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='only load rows that changed since the last load, without dropping tables')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for the extract stages')
+    parser.add_argument('--backend',
+                        choices=sorted(backends.BACKENDS),
+                        default=backends.DEFAULT_BACKEND,
+                        help='warehouse to load; duckdb loads a local database file (SOLAR_DUCKDB_PATH)')
+    parser.add_argument('--data-dir',
+                        default=None,
+                        help='directory with the input files (default SOLAR_DATA_DIR or ../data), '
+                            'e.g. synthetic data from synthetic_data.py')
+    parser.add_argument('--no-quality-gate',
+                        action='store_true',
+                        help="report failed data quality checks without stopping the load")
+    args = parser.parse_args()
+
+    if args.data_dir:
+        set_data_dir(args.data_dir)
+
+    result = run_etl(max_workers=args.workers,
+                        incremental=args.incremental,
+                        backend=args.backend,
+                        quality_gate=not args.no_quality_gate)
+    print(result.report())
@@ -0,0 +1,442 @@
+"""
+Make-like runner for the etl.py stages, with checkpoints.
+
+Each stage's output is checkpointed after the stage finishes (dataframes as typed
+Parquet, other values like the s3 manifests of staged tables pickled), keyed by a
+fingerprint of the stage's code (its module and every project module that imports),
+keyword arguments, input files and the content of the upstream outputs it takes.  A stage whose checkpoint is still valid is skipped
+without loading anything, and a stage which reruns but gives the same output as
+before doesn't make the stages after it rerun.  So if one source file changes, only
+the stages which depend on it run again, and if the load fails halfway, a rerun only
+repeats the load.
+
+Stages which read or write the warehouse (the slice count, the loads and the
+warehouse checks) always run, since their results can't be checked from a checkpoint.
+
+Run from the code directory, with the same options as etl.py:
+python etl_runner.py --backend duckdb       # runs the stages whose inputs or code changed
+python etl_runner.py --dry-run              # shows which stages would run
+python etl_runner.py --resume               # continues the last run from the stage that failed
+python etl_runner.py --force eia            # reruns eia and every stage after it
+"""
+import os
+import json
+import shutil
+import hashlib
+import argparse
+
+import etl
+import backends
+import instrumentation
+from pipeline import Stage, StageError, check_stages, run_stages
+from stage_cache import META_FILENAME, StageCache, code_fingerprint, hash_file, hash_value
+
+
+CHECKPOINT_DIR = os.environ.get('SOLAR_CHECKPOINT_DIR', '../data/checkpoints')
+# total size of checkpoints before least-recently-used ones are evicted
+MAX_CHECKPOINT_BYTES = int(os.environ.get('SOLAR_CHECKPOINT_MAX_BYTES', 20 * 1024 ** 3))
+# options and status of the last run, for --resume
+LAST_RUN_FILE = 'last_run.json'
+# stages finished in each run, one file per stage
+RUNS_DIR = 'runs'
+# bump to invalidate all checkpoints by hand, e.g. after changing something outside the code directory
+RUNNER_VERSION = '1'
+
+WAREHOUSE_STAGES = {'slices', 'warehouse_checks'} | {'load_{}'.format(b) for b in backends.BACKENDS}
+
+
+def stage_input_files(name):
+    """
+    Gets the input files an etl.py stage reads.
+
+    name - string; stage name from etl.build_etl_stages
+    """
+    files = {'zipcodes': [etl.ZIPCODE_FILE],
+            'psr': [etl.PSR_CSV],
+            'acs': [etl.ACS_CSV],
+            'lbnl': etl.LBNL_FILES,
+            'eia': etl.EIA_ZIPCODE_FILES + [etl.EIA861_FILE]}
+    return files.get(name, [])
+
+
+class StageOutput:
+    """
+    Checkpointed output of a stage, passed on to the stages after it instead of the output itself.
+    The output is only loaded from the checkpoint if a stage which takes it has to run, and
+    isn't pickled along when the handle goes to or from a stage process.
+    """
+    def __init__(self, stage, key, hashes, is_tuple, ran, checkpoint_dir=CHECKPOINT_DIR):
+        """
+        stage - string; stage name
+        key - string; fingerprint the output is checkpointed under
+        hashes - list of strings; content hash of the output, or of each item of a tuple output
+        is_tuple - boolean; whether the stage returned a tuple
+        ran - boolean; True if the stage ran in this run, False if its checkpoint was used
+        checkpoint_dir - string; directory with the checkpoints
+        """
+        self.stage = stage
+        self.key = key
+        self.hashes = hashes
+        self.is_tuple = is_tuple
+        self.ran = ran
+        self.checkpoint_dir = checkpoint_dir
+        self._value = None
+        self._loaded = False
+
+
+    @classmethod
+    def from_meta(cls, meta, ran=False, checkpoint_dir=CHECKPOINT_DIR):
+        return cls(meta['stage'], meta['key'], meta['hashes'], meta['tuple'], ran, checkpoint_dir)
+
+
+    def output_hash(self, index=None):
+        """
+        Gets the content hash of the output, or of one item of a tuple output.
+        """
+        if index is not None:
+            return self.hashes[index]
+        if not self.is_tuple:
+            return self.hashes[0]
+
+        return hashlib.sha256(''.join(self.hashes).encode()).hexdigest()
+
+
+    def __getstate__(self):
+        # sent to and from the stage processes without the value, which the other side reads
+        # from the checkpoint if it needs it, unless the value couldn't be checkpointed
+        state = self.__dict__.copy()
+        store = StageCache(self.checkpoint_dir, MAX_CHECKPOINT_BYTES)
+        if os.path.exists(os.path.join(store.entry_path(self.stage, self.key), META_FILENAME)):
+            state['_value'], state['_loaded'] = None, False
+
+        return state
+
+
+    def set_value(self, value):
+        self._value = value
+        self._loaded = True
+
+
+    @property
+    def value(self):
+        if not self._loaded:
+            store = StageCache(self.checkpoint_dir, MAX_CHECKPOINT_BYTES)
+            if store.meta(self.stage, self.key) is None:
+                raise RuntimeError('checkpoint of stage {} is missing; rerun with --force {}'.format(
+                    self.stage, self.stage))
+            self.set_value(store.get(self.stage, self.key))
+
+        return self._value
+
+
+    def item(self, index=None):
+        """
+        Gets the output, or one item of a tuple output.
+        """
+        return self.value if index is None else self.value[index]
+
+
+def stage_key(name, func, kwargs, inputs, after_outputs):
+    """
+    Gets the fingerprint of a stage from its code, keyword arguments, input files,
+    the content of the upstream outputs it takes, and the fingerprints of the stages
+    it runs after.
+
+    name - string; stage name
+    func - function for the stage
+    kwargs - dict of keyword arguments for func
+    inputs - list of (StageOutput, index or None) tuples, one per positional argument
+    after_outputs - list of StageOutput of stages which must finish first
+    """
+    sha = hashlib.sha256()
+    sha.update(RUNNER_VERSION.encode())
+    sha.update(name.encode())
+    # the stage's module and every project module it imports, so helper and schema changes count
+    sha.update(code_fingerprint(func).encode())
+    for arg, value in sorted(kwargs.items()):
+        sha.update(arg.encode())
+        sha.update(hash_value(value).encode())
+    # only the contents of the files count, so moving the data directory doesn't invalidate anything
+    for fn in stage_input_files(name):
+        sha.update(hash_file(fn).encode())
+    for output, index in inputs:
+        sha.update(output.output_hash(index).encode())
+    for output in after_outputs:
+        sha.update(output.key.encode())
+
+    return sha.hexdigest()
+
+
+def record_finished(output, run_id, checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Records that a stage finished in a run, so --resume can reuse its checkpoint.
+    """
+    run_dir = os.path.join(checkpoint_dir, RUNS_DIR, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    with open(os.path.join(run_dir, '{}.json'.format(output.stage)), 'w') as f:
+        json.dump({'stage': output.stage, 'key': output.key, 'ran': output.ran}, f)
+
+
+def run_stage(*upstream, name=None, func=None, deps=(), kwargs=None, force=False, pinned_key=None, run_id=None,
+                checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Runs one stage unless its checkpoint is still valid, and checkpoints its output.
+
+    upstream - StageOutput of each dependency in deps, then of each stage it runs after
+    name - string; stage name
+    func - function for the stage
+    deps - list of (stage name, index or None) tuples, as in pipeline.Stage
+    kwargs - dict of keyword arguments for func
+    force - boolean; if True, runs the stage even if its checkpoint is valid
+    pinned_key - string or None; checkpoint to use regardless of the fingerprint (for --resume)
+    run_id - string; id of the run, for recording finished stages
+    checkpoint_dir - string; directory with the checkpoints
+
+    Returns StageOutput.
+    """
+    kwargs = kwargs or {}
+    inputs = [(output, index) for output, (_, index) in zip(upstream, deps)]
+    store = StageCache(checkpoint_dir, MAX_CHECKPOINT_BYTES)
+
+    key = pinned_key or stage_key(name, func, kwargs, inputs, upstream[len(deps):])
+    meta = None if force or name in WAREHOUSE_STAGES else store.meta(name, key)
+    with instrumentation.span('checkpoint {}'.format(name), kind='checkpoint') as s:
+        if meta is not None:
+            s.set(skipped=True)
+            output = StageOutput.from_meta(meta, checkpoint_dir=checkpoint_dir)
+        else:
+            # the runner's checkpoints replace the stage's own cache
+            result = getattr(func, 'uncached', func)(*[output.item(index) for output, index in inputs], **kwargs)
+            items = list(result) if isinstance(result, tuple) else [result]
+            hashes = [hash_value(item) for item in items]
+            store.put(name, key, result, extra={'hashes': hashes})
+            output = StageOutput(name, key, hashes, isinstance(result, tuple), True, checkpoint_dir)
+            output.set_value(result)
+
+    record_finished(output, run_id, checkpoint_dir)
+    return output
+
+
+def downstream(stages, names):
+    """
+    Gets the names of stages and every stage which depends on them, directly or not.
+
+    stages - list of pipeline.Stage
+    names - list of strings; stage names
+    """
+    unknown = set(names) - {s.name for s in stages}
+    if unknown:
+        raise ValueError('unknown stages {}; should be from {}'.format(sorted(unknown), [s.name for s in stages]))
+
+    found = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for s in stages:
+            if s.name not in found and s.upstream & found:
+                found.add(s.name)
+                changed = True
+
+    return found
+
+
+def checkpointed_stages(stages, force=(), pinned=None, run_id=None, checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Wraps stages so they pass StageOutputs to each other and skip work with valid checkpoints.
+
+    stages - list of pipeline.Stage
+    force - list of strings; stages to rerun, along with every stage after them
+    pinned - dict of stage name to checkpoint key to reuse, or None
+    run_id - string; id of the run
+    checkpoint_dir - string; directory with the checkpoints
+    """
+    forced = downstream(stages, force)
+    pinned = pinned or {}
+    wrapped = []
+    for s in stages:
+        wrapped.append(Stage(s.name,
+                            run_stage,
+                            [name for name, _ in s.deps] + sorted(s.after),
+                            {'name': s.name,
+                            'func': s.func,
+                            'deps': s.deps,
+                            'kwargs': s.kwargs,
+                            'force': s.name in forced,
+                            'pinned_key': pinned.get(s.name),
+                            'run_id': run_id,
+                            'checkpoint_dir': checkpoint_dir},
+                            kind=s.kind))
+
+    return wrapped
+
+
+def plan(stages, force=(), checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Works out which stages would run, from the checkpoints, without running anything.
+
+    Returns list of (stage name, reason) tuples in the order the stages can run; reason
+    is 'checkpoint' for stages that would be skipped.
+    """
+    check_stages(stages)
+    forced = downstream(stages, force)
+    store = StageCache(checkpoint_dir, MAX_CHECKPOINT_BYTES)
+    outputs, steps = {}, []
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if s.upstream <= set(name for name, _ in steps)]
+        for s in ready:
+            remaining.remove(s)
+            if s.name in forced:
+                reason = 'forced'
+            elif s.name in WAREHOUSE_STAGES:
+                reason = 'always runs'
+            elif not s.upstream <= set(outputs):
+                reason = 'if upstream output changes'
+            else:
+                inputs = [(outputs[name], index) for name, index in s.deps]
+                key = stage_key(s.name, s.func, s.kwargs, inputs, [outputs[name] for name in sorted(s.after)])
+                meta = store.meta(s.name, key)
+                reason = 'checkpoint' if meta is not None else 'inputs or code changed'
+                if meta is not None:
+                    outputs[s.name] = StageOutput.from_meta(meta, checkpoint_dir=checkpoint_dir)
+            steps.append((s.name, reason))
+
+    return steps
+
+
+def read_last_run(checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Reads the options and status of the last run, or None if there wasn't one.
+    """
+    path = os.path.join(checkpoint_dir, LAST_RUN_FILE)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def finished_stages(run_id, checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Gets the checkpoint key of each stage which finished in a run.
+    """
+    run_dir = os.path.join(checkpoint_dir, RUNS_DIR, run_id)
+    if not os.path.exists(run_dir):
+        return {}
+
+    keys = {}
+    for fn in os.listdir(run_dir):
+        with open(os.path.join(run_dir, fn)) as f:
+            record = json.load(f)
+        keys[record['stage']] = record['key']
+
+    return keys
+
+
+def run(options, max_workers=None, force=(), pinned=None, checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Runs the ETL stages with checkpoints, and records the run for --resume.
+
+    options - dict of keyword arguments for etl.build_etl_stages (bucket, incremental, backend, quality_gate)
+    max_workers - int or None; number of processes for the extract stages
+    force - list of strings; stages to rerun, along with every stage after them
+    pinned - dict of stage name to checkpoint key to reuse, or None
+
+    Returns PipelineResult whose outputs are StageOutputs.
+    """
+    stages = etl.build_etl_stages(**options)
+    # unknown stage names fail before the run is recorded
+    downstream(stages, force)
+    status = {'options': options, 'data_dir': etl.DATA_DIR, 'status': 'failed', 'failed_stage': None}
+    with instrumentation.run('etl'):
+        run_id = instrumentation.current_run_id()
+        # only the latest run's records are kept
+        shutil.rmtree(os.path.join(checkpoint_dir, RUNS_DIR), ignore_errors=True)
+        try:
+            result = run_stages(checkpointed_stages(stages, force, pinned, run_id, checkpoint_dir), max_workers=max_workers)
+            status['status'] = 'succeeded'
+            return result
+        except StageError as e:
+            status['failed_stage'] = e.stage_name
+            raise
+        finally:
+            status['run_id'] = run_id
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(os.path.join(checkpoint_dir, LAST_RUN_FILE), 'w') as f:
+                json.dump(status, f, indent=2)
+
+
+def resume(max_workers=None, checkpoint_dir=CHECKPOINT_DIR):
+    """
+    Reruns the last run with its options, reusing the checkpoints of the stages which
+    finished in it even if their inputs changed since, and running the rest from the
+    stage which failed.
+
+    Returns PipelineResult, or None if the last run succeeded.
+    """
+    last_run = read_last_run(checkpoint_dir)
+    if last_run is None:
+        raise ValueError('no run to resume in {}'.format(checkpoint_dir))
+    if last_run['status'] == 'succeeded':
+        return None
+
+    etl.set_data_dir(last_run['data_dir'])
+    pinned = finished_stages(last_run['run_id'], checkpoint_dir)
+    return run(last_run['options'], max_workers=max_workers, pinned=pinned, checkpoint_dir=checkpoint_dir)
+
+
+def stage_report(result):
+    """
+    Returns string listing which stages ran and which used their checkpoints.
+    """
+    lines = ['stages:']
+    for name in sorted(result.timings, key=lambda n: result.timings[n]['start']):
+        lines.append('  {:<28} {}'.format(name, 'ran' if result.outputs[name].ran else 'checkpoint'))
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs the ETL stages whose inputs or code changed, '
+                                                    'with checkpoints after each stage.')
+    parser.add_argument('--incremental',
+                        action='store_true',
+                        help='only load rows that changed since the last load, without dropping tables')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for the extract stages')
+    parser.add_argument('--backend',
+                        choices=sorted(backends.BACKENDS),
+                        default=backends.DEFAULT_BACKEND,
+                        help='warehouse to load; duckdb loads a local database file (SOLAR_DUCKDB_PATH)')
+    parser.add_argument('--data-dir',
+                        default=None,
+                        help='directory with the input files (default SOLAR_DATA_DIR or ../data)')
+    parser.add_argument('--no-quality-gate',
+                        action='store_true',
+                        help="report failed data quality checks without stopping the load")
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='rerun the last run with its options from the stage which failed, '
+                            'reusing the stages which finished')
+    parser.add_argument('--force', nargs='+', default=[], metavar='STAGE',
+                        help='rerun these stages and every stage after them, even with valid checkpoints')
+    parser.add_argument('--dry-run', action='store_true', help='show which stages would run, without running them')
+    args = parser.parse_args()
+
+    if args.data_dir:
+        etl.set_data_dir(args.data_dir)
+
+    options = {'incremental': args.incremental, 'backend': args.backend, 'quality_gate': not args.no_quality_gate}
+    if args.dry_run:
+        for name, reason in plan(etl.build_etl_stages(**options), force=args.force):
+            print('  {:<28} {}'.format(name, 'skip (checkpoint)' if reason == 'checkpoint' else 'run ({})'.format(reason)))
+    elif args.resume:
+        result = resume(max_workers=args.workers)
+        if result is None:
+            print('the last run succeeded; nothing to resume')
+        else:
+            print(result.report())
+            print(stage_report(result))
+    else:
+        result = run(options, max_workers=args.workers, force=args.force)
+        print(result.report())
+        print(stage_report(result))
@@ -0,0 +1,219 @@
+"""
+Column schemas for the in-memory dataframes.
+
+Each frame's columns get the smallest dtype that holds their values: categoricals for
+repeated strings (utility and installer names, states, ownership, service type),
+float32 for measurements, nullable Int32 for counts, and zipcodes as a categorical
+over the valid zipcodes (one small integer code per row instead of a python string).
+The dtypes are used when reading the source files and again on each stage's output,
+so they're kept through the joins in merge_data.
+
+Aggregations (sums and means) still run in float64 before the output is cast, and
+float32 columns are widened through their decimal representation before they're
+written to the warehouse, so 0.1 is stored as 0.1 and not 0.10000000149011612.
+"""
+import instrumentation
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+# zipcode key columns: read as strings, then categorical over the valid zipcodes (see zipcode_utils.ValidZipcodes)
+ZIPCODE = 'zipcode'
+
+SCHEMAS = {'zipcodes': {'Zipcode': ZIPCODE,
+                        'City': 'category',
+                        'State': 'category',
+                        'Lat': 'float32',
+                        'Long': 'float32'},
+            # raw LBNL installs, only the columns used
+            'lbnl_installs': {'Zip Code': ZIPCODE,
+                                'Installer Name': 'category',
+                                'Module Manufacturer #1': 'category',
+                                'Battery System': 'float64',
+                                'Feed-in Tariff (Annual Payment)': 'float64'},
+            'installer': {'index': 'int32',
+                            'Module Manufacturer #1': 'category'},
+            'lbnl': {'Zip Code': ZIPCODE,
+                        'Battery System': 'float32',
+                        'Feed-in Tariff (Annual Payment)': 'float32',
+                        'Installer Name': 'category',
+                        'Installer ID': 'int32'},
+            'eia_zipcodes': {'zip': ZIPCODE,
+                                'eiaid': 'int32',
+                                'utility_name': 'category',
+                                'state': 'category',
+                                'service_type': 'category',
+                                'ownership': 'category',
+                                'comm_rate': 'float32',
+                                'ind_rate': 'float32',
+                                'res_rate': 'float32'},
+            'eia861': {'Utility Number': 'Int32',
+                        'Utility Name': 'category',
+                        'Service Type': 'category',
+                        'Ownership': 'category'},
+            'eia': {'zip': ZIPCODE,
+                    'average_yearly_bill': 'float32',
+                    'average_yearly_kwh': 'float32',
+                    'Utility Name': 'category',
+                    'Service Type': 'category',
+                    'Ownership': 'category'},
+            'acs': {'geo_id': ZIPCODE,
+                    'median_age': 'float32',
+                    'housing_units': 'Int32',
+                    'median_income': 'float32',
+                    'owner_occupied_housing_units': 'Int32',
+                    'occupied_housing_units': 'Int32',
+                    'family_homes': 'Int32',
+                    'bachelors_degree_2': 'Int32',
+                    'moved_recently': 'Int32'},
+            'psr': {'region_name': ZIPCODE,
+                    'percent_covered': 'float32',
+                    'percent_qualified': 'float32',
+                    'number_of_panels_total': 'Int32',
+                    'kw_median': 'float32',
+                    'potential_installs': 'Int32'},
+            'solar_metrics': {'full_zip': ZIPCODE,
+                                'percent_qualified': 'float32',
+                                'number_of_panels_total': 'Int32',
+                                'kw_median': 'float32',
+                                'potential_installs': 'Int32',
+                                'median_income': 'float32',
+                                'median_age': 'float32',
+                                'occupied_housing_units': 'Int32',
+                                'owner_occupied_housing_units': 'Int32',
+                                'family_homes': 'Int32',
+                                'bachelors_degree_2': 'Int32',
+                                'moved_recently': 'Int32',
+                                'average_yearly_bill': 'float32',
+                                'average_yearly_kwh': 'float32',
+                                'Installer ID': 'Int32',
+                                'Battery System': 'float32',
+                                'Feed-in Tariff (Annual Payment)': 'float32'}}
+
+
+def read_dtypes(name):
+    """
+    Gets dtypes for pd.read_csv(dtype=...) from a schema.  Zipcodes are read as strings,
+    so they keep leading zeros, and are normalized afterwards.
+
+    name - string; key of SCHEMAS
+    """
+    return {col: 'str' if dtype == ZIPCODE else dtype for col, dtype in SCHEMAS[name].items()}
+
+
+def zipcode_dtype(*columns):
+    """
+    Gets the categorical dtype of the first zipcode column which has one, or None.
+
+    columns - pandas series of zipcodes
+    """
+    for col in columns:
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            return col.dtype
+
+    return None
+
+
+def default_dtypes(df):
+    """
+    Converts a dataframe to the dtypes pandas would have given it by default
+    (python strings, float64 and int64), to measure what the schema saves.
+    """
+    converted = {}
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            converted[col] = s.astype('object')
+        elif pd.api.types.is_float_dtype(s.dtype):
+            converted[col] = s.astype('float64')
+        elif pd.api.types.is_integer_dtype(s.dtype):
+            converted[col] = s.astype('float64' if s.hasnans else 'int64')
+        else:
+            converted[col] = s
+
+    return pd.DataFrame(converted, index=df.index)
+
+
+def memory_bytes(df, zip_dtype=None):
+    """
+    Gets memory used by a dataframe, including python strings.
+
+    df - pandas dataframe
+    zip_dtype - pandas CategoricalDtype or None; zipcode dtype whose categories aren't
+        counted, since all frames share one copy of them
+    """
+    usage = df.index.memory_usage(deep=True)
+    for col in df.columns:
+        if zip_dtype is not None and df[col].dtype == zip_dtype:
+            usage += df[col].cat.codes.nbytes
+        else:
+            usage += df[col].memory_usage(deep=True, index=False)
+
+    return int(usage)
+
+
+def apply_schema(df, name, zip_dtype=None):
+    """
+    Casts the columns of a dataframe to the dtypes in its schema; columns not in the
+    schema are left alone.  The memory used before and after (see default_dtypes) is
+    recorded as a span.
+
+    df - pandas dataframe
+    name - string; key of SCHEMAS
+    zip_dtype - pandas CategoricalDtype or None; dtype for zipcode columns, e.g.
+        ValidZipcodes.dtype.  If None, zipcodes are left as strings.
+
+    Returns dataframe with the new dtypes.
+    """
+    with instrumentation.span('compact {}'.format(name), kind='schema', rows_in=df.shape[0]) as s:
+        dtypes = {}
+        for col, dtype in SCHEMAS[name].items():
+            if col not in df.columns:
+                continue
+            if dtype == ZIPCODE:
+                dtype = zip_dtype
+            if dtype is not None and df[col].dtype != dtype:
+                dtypes[col] = dtype
+
+        compact = df.astype(dtypes) if dtypes else df
+        if instrumentation.INSTRUMENTATION_ENABLED:
+            s.set(default_dtype_bytes=memory_bytes(default_dtypes(compact)), bytes=memory_bytes(compact, zip_dtype))
+
+    return compact
+
+
+def memory_report(frames, zip_dtype=None):
+    """
+    Gets the memory each dataframe uses with its dtypes and with pandas' default dtypes.
+
+    frames - dict of name to pandas dataframe
+    zip_dtype - pandas CategoricalDtype or None; shared zipcode dtype (see memory_bytes)
+
+    Returns pandas dataframe indexed by name.
+    """
+    rows = []
+    for name, df in frames.items():
+        default, compact = memory_bytes(default_dtypes(df)), memory_bytes(df, zip_dtype)
+        rows.append({'frame': name,
+                    'default_dtype_bytes': default,
+                    'bytes': compact,
+                    'reduction': 1 - compact / default if default else 0.0})
+
+    return pd.DataFrame(rows).set_index('frame')
+
+
+def widen_floats(df):
+    """
+    Converts float32 columns to float64 through their shortest decimal representation,
+    so the warehouse gets the value that was read (0.1) rather than the nearest
+    float32 (0.10000000149011612).
+
+    df - pandas dataframe
+    """
+    float32_columns = [c for c in df.columns if df[c].dtype == np.float32]
+    if not float32_columns:
+        return df
+
+    return df.assign(**{c: df[c].astype('str').astype('float64') for c in float32_columns})
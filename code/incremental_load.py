@@ -0,0 +1,205 @@
+"""
+Incremental (upsert) loading of the warehouse tables.
+
+A content hash of every row is kept from the last successful load.  On the next load
+only rows whose hash changed are written to a staging table, and they replace the
+old rows with delete+insert inside one transaction, so the tables are never empty
+and the load time depends on the size of the change rather than the size of the table.
+"""
+import os
+
+import sql_queries as sql_q
+import rollups
+import instrumentation
+from sql_utils import insert_frame, execute
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+STATE_DIR = os.environ.get('SOLAR_LOAD_STATE_DIR', '../data/load_state')
+
+
+def key_hashes(df, key_col):
+    """
+    Gets one content hash per key, combining the hashes of all rows with that key.
+
+    df - pandas dataframe with columns in table order
+    key_col - string; name of key column in df
+
+    Returns pandas dataframe indexed by key with the uint64 hash and number of rows for each key.
+    """
+    # keys as plain values, so categorical zipcodes aren't grouped over unused categories
+    hashes = pd.DataFrame({'hash': pd.util.hash_pandas_object(df, index=False).values,
+                            'rows': 1},
+                            index=pd.Index(np.asarray(df[key_col]), name='key'))
+    # summing (with wraparound) combines hashes of rows with duplicate keys, independent of row order
+    combined = hashes.groupby(level=0).sum()
+    combined['hash'] = combined['hash'].astype(np.uint64)
+    return combined
+
+
+def diff_hashes(new_hashes, old_hashes):
+    """
+    Compares hashes from this load and the last load.
+
+    new_hashes - pandas dataframe from key_hashes for the new data
+    old_hashes - pandas dataframe from key_hashes from the last load
+
+    Returns index of keys that are new or changed, and index of keys that were removed.
+    """
+    old_aligned = old_hashes['hash'].reindex(new_hashes.index)
+    changed = new_hashes.index[old_aligned.isna().values | (old_aligned.values != new_hashes['hash'].values)]
+    removed = old_hashes.index.difference(new_hashes.index)
+    return changed, removed
+
+
+def state_path(table, state_dir=STATE_DIR):
+    return os.path.join(state_dir, '{}_hashes.parquet'.format(table))
+
+
+def read_state(table, state_dir=STATE_DIR):
+    """
+    Reads key hashes (from key_hashes) from the last load of a table, or None if there aren't any.
+
+    table - string; name of table
+    state_dir - string; directory with hash files
+    """
+    path = state_path(table, state_dir)
+    if not os.path.exists(path):
+        return None
+
+    return pd.read_parquet(path).set_index('key')
+
+
+def write_state(table, hashes, state_dir=STATE_DIR):
+    """
+    Saves key hashes of a table after a successful load.
+
+    table - string; name of table
+    hashes - pandas dataframe from key_hashes
+    state_dir - string; directory with hash files
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    path = state_path(table, state_dir)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    hashes.reset_index().to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def clear_state(state_dir=STATE_DIR):
+    """
+    Removes saved hashes, e.g. after the tables are recreated by a full load,
+    so the next incremental load reloads every table.
+
+    state_dir - string; directory with hash files
+    """
+    for table in sql_q.table_columns:
+        path = state_path(table, state_dir)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def count_rows(cur, table):
+    execute(cur, 'SELECT COUNT(*) FROM {};'.format(table))
+    return cur.fetchone()[0]
+
+
+def upsert_table(cur, table, df, changed_keys, removed_keys, full=False):
+    """
+    Replaces rows of changed keys and deletes rows of removed keys.
+    Doesn't commit, so several tables can be upserted in one transaction.
+
+    cur - psycopg2 cursor or DuckDB connection
+    table - string; name of table
+    df - pandas dataframe with all data for the table, columns in table order
+    changed_keys - pandas index of new or changed keys
+    removed_keys - pandas index of keys to delete
+    full - boolean; if True, all existing rows are deleted first
+    """
+    columns = sql_q.table_columns[table]
+    key = sql_q.table_keys[table]
+    key_col = df.columns[columns.index(key)]
+    column_list = ', '.join(columns)
+    staging = '{}_staging'.format(table)
+    removed = '{}_removed'.format(table)
+
+    execute(cur, 'CREATE TEMP TABLE {} AS SELECT {} FROM {} WHERE 1 = 0;'.format(staging, column_list, table))
+    changed_df = df[df[key_col].isin(changed_keys)]
+    insert_frame(cur, staging, columns, changed_df)
+
+    if full:
+        execute(cur, 'DELETE FROM {};'.format(table))
+    else:
+        execute(cur, 'DELETE FROM {0} USING {1} WHERE {0}.{2} = {1}.{2};'.format(table, staging, key))
+        if len(removed_keys) > 0:
+            execute(cur, 'CREATE TEMP TABLE {} AS SELECT {} FROM {} WHERE 1 = 0;'.format(removed, key, table))
+            insert_frame(cur, removed, [key], pd.DataFrame({key: removed_keys.tolist()}))
+            execute(cur, 'DELETE FROM {0} USING {1} WHERE {0}.{2} = {1}.{2};'.format(table, removed, key))
+            execute(cur, 'DROP TABLE {};'.format(removed))
+
+    execute(cur, 'INSERT INTO {0} ({1}) SELECT {1} FROM {2};'.format(table, column_list, staging))
+    execute(cur, 'DROP TABLE {};'.format(staging))
+    return changed_df.shape[0]
+
+
+def incremental_load(cur, conn, tables, state_dir=STATE_DIR, update_rollups=True):
+    """
+    Loads only new, changed and removed rows of each table, all in one transaction.
+    A table is fully reloaded (still in the same transaction) if there is no saved state
+    for it or its row count doesn't match the saved state, e.g. after the tables were recreated.
+
+    cur and conn and the curson and connection from the psycopg2 API to the redshift DB.
+    tables - dict of table name to pandas dataframe with columns in table order
+    state_dir - string; directory with hash files
+    update_rollups - boolean; if True, the city and state rollups of changed zipcodes are refreshed in the same transaction
+
+    Returns dict of table name to number of rows written.
+    """
+    new_state, written = {}, {}
+    try:
+        plans = {}
+        for table, df in tables.items():
+            key_col = df.columns[sql_q.table_columns[table].index(sql_q.table_keys[table])]
+            hashes = key_hashes(df, key_col)
+            old_hashes = read_state(table, state_dir)
+            full = old_hashes is None or count_rows(cur, table) != old_hashes['rows'].sum()
+            if full:
+                changed, removed = hashes.index, hashes.index[:0]
+            else:
+                changed, removed = diff_hashes(hashes, old_hashes)
+
+            plans[table] = (changed, removed, full)
+            new_state[table] = hashes
+
+        rollup_sources = [t for t in rollups.SOURCE_TABLES if t in plans]
+        full_rollup = any(plans[t][2] for t in rollup_sources)
+        if update_rollups and rollup_sources and not full_rollup:
+            changed_zips = pd.Index([]).append([plans[t][0].append(plans[t][1]) for t in rollup_sources]).unique()
+            rollups.mark_changed_zipcodes(cur, changed_zips.tolist())
+
+        for table, df in tables.items():
+            changed, removed, full = plans[table]
+            with instrumentation.span('upsert {}'.format(table),
+                                    kind='load',
+                                    rows_in=df.shape[0],
+                                    changed_keys=len(changed),
+                                    removed_keys=len(removed),
+                                    full_reload=full) as s:
+                written[table] = upsert_table(cur, table, df, changed, removed, full=full)
+                s.add_rows_out(written[table])
+
+        if update_rollups and rollup_sources:
+            with instrumentation.span('refresh rollups', kind='load', full_rebuild=full_rollup):
+                rollups.refresh_rollups(cur, full=full_rollup)
+
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    for table, hashes in new_state.items():
+        write_state(table, hashes, state_dir)
+
+    return written
@@ -1,15 +1,67 @@
 """
 This creates the AWS RedShift resources for the data warehouse.
+
+Independent provisioning steps run at the same time (the S3 role and opening the
+cluster's port don't depend on each other), the cluster status is polled with
+exponential backoff, and each describe_clusters result is kept until the cluster
+changes.  Each phase is recorded as a span and its time kept in timings.
+The AWS clients can be passed in, e.g. clients made inside moto's mock_aws.
 """
 import os
 import time
 import json
+import configparser
+from concurrent.futures import ThreadPoolExecutor
 
-import pandas as pd
 import boto3
 
+import instrumentation
+
+
+S3_READ_POLICY_ARN = 'arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess'
+
+# waiting on the cluster: seconds before the first poll, growth of the delay after each poll,
+# longest delay, and seconds before giving up
+WAIT_INITIAL_DELAY = 5
+WAIT_BACKOFF = 2
+WAIT_MAX_DELAY = 60
+WAIT_TIMEOUT = 30 * 60
+
+
+def wait_for(condition,
+            description='condition',
+            initial_delay=WAIT_INITIAL_DELAY,
+            backoff=WAIT_BACKOFF,
+            max_delay=WAIT_MAX_DELAY,
+            timeout=WAIT_TIMEOUT,
+            sleep=time.sleep):
+    """
+    Calls condition until it returns True, waiting longer after each call (exponential backoff).
+
+    condition - function with no arguments returning boolean
+    description - string; what is waited for, for the timeout error
+    initial_delay - float; seconds to wait after the first call
+    backoff - float; factor the delay grows by after each call
+    max_delay - float; longest wait between calls
+    timeout - float; seconds before raising TimeoutError
+    sleep - function; waits a number of seconds (e.g. a no-op in tests)
+
+    Returns number of calls made.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+    polls = 0
+    while True:
+        polls += 1
+        if condition():
+            return polls
+
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError('timed out waiting for {} after {} polls'.format(description, polls))
+
+        sleep(delay)
+        delay = min(delay * backoff, max_delay)
 
-import configparser
 
 class redshift_creator:
     """
@@ -19,7 +71,10 @@ class redshift_creator:
                 config_location='~/.aws_config/',
                 config_filename='solar_dwh.cfg',
                 connection_filename='solar_cluster.cfg',
-                s3_access=False
+                s3_access=False,
+                config=None,
+                clients=None,
+                sleep=time.sleep
                 ):
         """
         config_location - string; location of config file
@@ -27,25 +82,36 @@ class redshift_creator:
         connection_filename - string; filename of config file with connection details
         s3_access - boolean; if True, allows S3 read access for Redshift cluster
             (e.g. for importing data)
+        config - configparser.ConfigParser or None; settings to use instead of reading the config file
+        clients - dict or None; boto3 clients/resources to use instead of making them, with keys
+            'ec2', 's3' (resources), 'iam' and 'redshift' (clients), e.g. made inside moto's mock_aws
+        sleep - function; waits a number of seconds between polls of the cluster status
         """
         self.config_location = config_location
         self.config_filename = config_filename
         self.connection_filename = connection_filename
         self.s3_access = s3_access
-        self.set_configs()
-        self.create_api_connections()
+        self.sleep = sleep
+        # latest describe_clusters result for the cluster; see describe_cluster
+        self._cluster = None
+        # seconds taken by each provisioning phase
+        self.timings = {}
+        self.set_configs(config)
+        self.create_api_connections(clients=clients)
 
 
-    def set_configs(self):
+    def set_configs(self, config=None):
         """
         Sets configuration variables from config file.
-        path - string; path to config file
-        fn - string; filename of config file
+
+        config - configparser.ConfigParser or None; if None, the config file is read
         """
-        config = configparser.ConfigParser()
-        # template cfg file is in repo; don't post your api key and secret online
-        config_path = os.path.join(os.path.expanduser(self.config_location), self.config_filename)
-        config.read_file(open(config_path))
+        if config is None:
+            config = configparser.ConfigParser()
+            # template cfg file is in repo; don't post your api key and secret online
+            config_path = os.path.join(os.path.expanduser(self.config_location), self.config_filename)
+            with open(config_path) as f:
+                config.read_file(f)
 
         # API credentials for admin account
         self.KEY                    = config.get("AWS", "KEY")
@@ -66,38 +132,42 @@ class redshift_creator:
             self.DWH_IAM_ROLE_NAME  = config.get("DWH", "DWH_IAM_ROLE_NAME")
 
 
-    def create_api_connections(self, region='us-west-2'):
+    def create_api_connections(self, region='us-west-2', clients=None):
         """
         Create API connections to AWS EC2, IAM and redshift
+
+        clients - dict or None; already made clients/resources by name, which are used as is
         """
-        self.ec2 = boto3.resource('ec2',
-                        region_name=region,
-                            aws_access_key_id=self.KEY,
-                            aws_secret_access_key=self.SECRET
-                            )
+        clients = clients or {}
+        credentials = {'region_name': region,
+                        'aws_access_key_id': self.KEY,
+                        'aws_secret_access_key': self.SECRET}
 
-        self.s3 = boto3.resource('s3',
-                        region_name=region,
-                            aws_access_key_id=self.KEY,
-                            aws_secret_access_key=self.SECRET
-                            )
+        self.ec2 = clients.get('ec2') or boto3.resource('ec2', **credentials)
+        self.s3 = clients.get('s3') or boto3.resource('s3', **credentials)
+        self.iam = clients.get('iam') or boto3.client('iam', **credentials)
+        self.redshift = clients.get('redshift') or boto3.client('redshift', **credentials)
 
-        self.iam = boto3.client('iam',
-                            region_name=region,
-                            aws_access_key_id=self.KEY,
-                            aws_secret_access_key=self.SECRET
-                            )
 
-        self.redshift = boto3.client('redshift',
-                            region_name=region,
-                            aws_access_key_id=self.KEY,
-                            aws_secret_access_key=self.SECRET
-                            )
+    def timed(self, phase, func, *args, **kwargs):
+        """
+        Runs one provisioning phase in a span, and keeps its time in timings.
+
+        phase - string; name of the phase, e.g. 'create_cluster'
+        func - function running the phase; args and kwargs are passed to it
+        """
+        with instrumentation.span(phase, kind='provision', cluster=self.DWH_CLUSTER_IDENTIFIER) as s:
+            result = func(*args, **kwargs)
+
+        self.timings[phase] = s.elapsed
+        return result
 
 
     def create_s3_role(self):
         """
         Creates an IAM role with S3 access for the redshift cluster
+
+        Returns ARN of the role.
         """
         self.dwh_s3_role = self.iam.create_role(
             Path='/',
@@ -110,9 +180,8 @@ class redshift_creator:
                 'Version': '2012-10-17'})
         )
 
-        self.iam.attach_role_policy(RoleName=self.DWH_IAM_ROLE_NAME,
-                       PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
-                      )['ResponseMetadata']['HTTPStatusCode']
+        self.iam.attach_role_policy(RoleName=self.DWH_IAM_ROLE_NAME, PolicyArn=S3_READ_POLICY_ARN)
+        return self.dwh_s3_role['Role']['Arn']
 
 
     def write_connection_cfg(self):
@@ -133,74 +202,115 @@ class redshift_creator:
                 f.write('ARN=' + self.DWH_ROLE_ARN)
 
 
+    def start_cluster(self, iam_roles=None):
+        """
+        Sends the request to create the Redshift cluster (it takes several minutes to become available).
+
+        iam_roles - list of strings or None; ARNs of IAM roles for the cluster
+
+        Returns cluster properties from the response.
+        """
+        response = self.redshift.create_cluster(
+            # add parameters for hardware
+            ClusterType=self.DWH_CLUSTER_TYPE,
+            NodeType=self.DWH_NODE_TYPE,
+            NumberOfNodes=int(self.DWH_NUM_NODES),
+
+            # add parameters for identifiers & credentials
+            DBName=self.DWH_DB,
+            ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER,
+            MasterUsername=self.DWH_DB_USER,
+            MasterUserPassword=self.DWH_DB_PASSWORD,
+
+            # add parameter for role (to allow s3 access)
+            IamRoles=iam_roles or []
+        )
+        self._cluster = response['Cluster']
+        return self._cluster
+
+
     def create_redshift_cluster(self):
         """
         Creates Redshift cluster.  Writes new .cfg file with details for connecting via psycopg2.
+        Raises the error of the first phase which fails.
+
+        The IAM role (if s3_access) and the security group rule are made at the same time;
+        the cluster is requested as soon as its role exists.
+
+        Returns dict of phase name to seconds taken.
         """
-        iam_roles = []
-        # get IAM ARN for creating cluster
+        self.timings = {}
+        # a failed phase raises (after its span is recorded with the error), and no .cfg file is written
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            connections = pool.submit(self.timed, 'enable_connections', self.enable_connections)
+            iam_roles = []
+            # get IAM ARN for creating cluster
+            if self.s3_access:
+                iam_roles.append(self.timed('create_s3_role', self.create_s3_role))
+
+            self.timed('create_cluster', self.start_cluster, iam_roles)
+            self.timed('wait_until_available', self.wait_until_cluster_ready)
+            connections.result()
+
+        self.get_endpoint()
         if self.s3_access:
-            self.create_s3_role()
-            s3_role_arn = self.iam.get_role(RoleName=self.DWH_IAM_ROLE_NAME)['Role']['Arn']
-            iam_roles.append(s3_role_arn)
+            self.get_iam_role()
+
+        self.write_connection_cfg()
+        return self.timings
 
-        try:
-            response = self.redshift.create_cluster(        
-                # add parameters for hardware
-                ClusterType=self.DWH_CLUSTER_TYPE,
-                NodeType=self.DWH_NODE_TYPE,
-                NumberOfNodes=int(self.DWH_NUM_NODES),
-
-                # add parameters for identifiers & credentials
-                DBName=self.DWH_DB,
-                ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER,
-                MasterUsername=self.DWH_DB_USER,
-                MasterUserPassword=self.DWH_DB_PASSWORD,
-                
-                # add parameter for role (to allow s3 access)
-                IamRoles=iam_roles 
-            )
-            self.wait_until_cluster_ready()
-            self.get_endpoint()
-            self.enable_connections()
-            if self.s3_access:
-                self.get_iam_role()
 
-            self.write_connection_cfg()
-        except Exception as e:
-            print(e)
+    def describe_cluster(self, refresh=False):
+        """
+        Gets the cluster properties from describe_clusters.  The last result is reused
+        unless refresh is True, e.g. when polling for a change of status.
+        """
+        if refresh or self._cluster is None:
+            response = self.redshift.describe_clusters(ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER)
+            self._cluster = response['Clusters'][0]
+
+        return self._cluster
 
 
     def RedshiftProps(self):
         """
         View Redshift cluster status.
         """
-        properties = self.redshift.describe_clusters(ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+        import pandas as pd
+
+        properties = self.describe_cluster(refresh=True)
         keysToShow = ["ClusterIdentifier",
                         "NodeType",
                         "ClusterStatus",
                         "MasterUsername",
                         "DBName",
                         "Endpoint",
-                        "NumberOfNodes", 
+                        "NumberOfNodes",
                         "VpcId"]
         x = [(k, v) for k,v in properties.items() if k in keysToShow]
         return pd.DataFrame(data=x, columns=["Key", "Value"])
 
 
-    def wait_until_cluster_ready(self):
+    def cluster_ready(self):
         """
-        Waits until Redshift cluster status is 'available'.
+        Checks (with a new describe_clusters call) whether the cluster is available
+        and all its IAM roles are in sync.
         """
-        print('waiting for cluster to become available...')
-        while True:
-            df = self.RedshiftProps()
-            available = (df[df['Key'] == 'ClusterStatus']['Value'].iloc[0] == 'available')
-            if available:
-                print('cluster ready.')
-                break
+        properties = self.describe_cluster(refresh=True)
+        roles_in_sync = all(r['ApplyStatus'] == 'in-sync' for r in properties.get('IamRoles', []))
+        return properties['ClusterStatus'] == 'available' and roles_in_sync
 
-            time.sleep(0.5)
+
+    def wait_until_cluster_ready(self, **kwargs):
+        """
+        Waits until Redshift cluster status is 'available', polling with exponential backoff.
+
+        kwargs - passed to wait_for, e.g. initial_delay or timeout
+
+        Returns number of describe_clusters calls made.
+        """
+        kwargs.setdefault('sleep', self.sleep)
+        return wait_for(self.cluster_ready, description='cluster {}'.format(self.DWH_CLUSTER_IDENTIFIER), **kwargs)
 
 
     def get_endpoint(self):
@@ -208,29 +318,37 @@ class redshift_creator:
         Get host address for DB, necessary for connecting to DB.
         The endpoint is the host address used for psycopg2.
         """
-        properties = self.redshift.describe_clusters(ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-        self.DWH_ENDPOINT = properties['Endpoint']['Address']
-    
+        self.DWH_ENDPOINT = self.describe_cluster()['Endpoint']['Address']
+
 
     def get_iam_role(self):
         """
         Gets IAM role for copying from S3 buckets.
         """
-        properties = self.redshift.describe_clusters(ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-        self.DWH_ROLE_ARN = properties['IamRoles'][0]['IamRoleArn']
+        self.DWH_ROLE_ARN = self.describe_cluster()['IamRoles'][0]['IamRoleArn']
+
+
+    def default_vpc_id(self):
+        """
+        Gets the id of the default VPC, where the cluster is created.
+        """
+        vpcs = list(self.ec2.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]))
+        return vpcs[0].id
 
 
-    def enable_connections(self, ip='0.0.0.0/0'):
+    def enable_connections(self, ip='0.0.0.0/0', vpc_id=None):
         """
         Open TCP port for access to cluster endpoint.
         ip - string; ip address to allow access from.  0.0.0.0/0 is all IPs.
+        vpc_id - string or None; VPC of the cluster.  By default the default VPC, so this
+            doesn't have to wait for the cluster to exist.
         """
+        from botocore.exceptions import ClientError
+
+        vpc = self.ec2.Vpc(id=vpc_id or self.default_vpc_id())
+        defaultSg = list(vpc.security_groups.filter(Filters=[{'Name': 'group-name', 'Values': ['default']}]))[0]
+
         try:
-            properties = self.redshift.describe_clusters(ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-            vpc = self.ec2.Vpc(id=properties['VpcId'])
-            defaultSg = list(vpc.security_groups.all())[0]
-            print(defaultSg)
-            
             defaultSg.authorize_ingress(
                 GroupName='default',
                 CidrIp=ip,
@@ -238,25 +356,42 @@ class redshift_creator:
                 FromPort=int(self.DWH_PORT),
                 ToPort=int(self.DWH_PORT)
             )
-        except Exception as e:
-            print(e)
+        except ClientError as e:
+            # the port is already open from an earlier cluster; anything else is an error
+            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+                raise
+
+
+    def delete_s3_role(self):
+        """
+        Detaches the S3 policy from the IAM role and deletes the role.
+        """
+        self.iam.detach_role_policy(RoleName=self.DWH_IAM_ROLE_NAME, PolicyArn=S3_READ_POLICY_ARN)
+        self.iam.delete_role(RoleName=self.DWH_IAM_ROLE_NAME)
 
 
     def delete_cluster(self, final_snapshot=False):
         """
-        Deletes Redshift Cluster and IAM role.
+        Deletes Redshift Cluster and IAM role (at the same time).
+
+        Returns dict of phase name to seconds taken.
         """
+        self.timings = {}
         # Function asks if you want a final snapshot, but redshift API asks if you want to skip it
         skip_snapshot = not final_snapshot
-        self.redshift.delete_cluster(ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER,
-                                    SkipFinalClusterSnapshot=skip_snapshot)
-
-        if self.s3_access:
-            self.iam.detach_role_policy(RoleName=self.DWH_IAM_ROLE_NAME,
-                        PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-            self.iam.delete_role(RoleName=self.DWH_IAM_ROLE_NAME)
-        
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            role = pool.submit(self.timed, 'delete_s3_role', self.delete_s3_role) if self.s3_access else None
+            self.timed('delete_cluster',
+                        self.redshift.delete_cluster,
+                        ClusterIdentifier=self.DWH_CLUSTER_IDENTIFIER,
+                        SkipFinalClusterSnapshot=skip_snapshot)
+            if role is not None:
+                role.result()
+
+        self._cluster = None
         # delete config file if exists
         filepath = os.path.expanduser(os.path.join(self.config_location, self.connection_filename))
         if os.path.exists(filepath):
-            os.remove(filepath)
\ No newline at end of file
+            os.remove(filepath)
+
+        return self.timings
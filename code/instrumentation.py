@@ -0,0 +1,400 @@
+"""
+Spans for measuring the ETL stages and warehouse statements.
+
+A span records the wall time of a block of code, how much the process's peak RSS grew
+while it ran, the rows going in and out, and the bytes it wrote.  Spans nest within a
+thread, and bytes written by inner spans count towards the outer ones.
+
+Every finished span is appended to a JSON lines file for the current run, from any
+process, tagged with the run's id; only the files of the latest runs are kept.  At the
+end of a run its spans are summed by kind and name into a Prometheus textfile (for
+node_exporter's textfile collector), so runs can be charted over time.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; peak RSS isn't recorded there
+    resource = None
+
+
+METRICS_DIR = os.environ.get('SOLAR_METRICS_DIR', '../data/metrics')
+# one <run id>.jsonl file of spans per run
+SPANS_DIR = os.environ.get('SOLAR_SPANS_DIR', os.path.join(METRICS_DIR, 'spans'))
+# number of runs whose span files are kept; older ones are removed when a run starts
+MAX_SPAN_RUNS = int(os.environ.get('SOLAR_SPANS_KEEP_RUNS', 100))
+PROMETHEUS_FILE = os.environ.get('SOLAR_PROMETHEUS_FILE', os.path.join(METRICS_DIR, 'solar_etl.prom'))
+# set SOLAR_INSTRUMENTATION=0 to stop writing spans (they are still measured)
+INSTRUMENTATION_ENABLED = os.environ.get('SOLAR_INSTRUMENTATION', '1') != '0'
+# the run id is passed to stage processes through the environment
+RUN_ID_VARIABLE = 'SOLAR_RUN_ID'
+
+METRIC_PREFIX = 'solar_etl'
+
+STATEMENT_TARGET = re.compile(r'\b(?:INTO|FROM|UPDATE|TABLE|SEQUENCE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([\w."]+)', re.IGNORECASE)
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def peak_rss_bytes():
+    """
+    Gets the peak resident set size of this process so far, or None if unknown.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def frame_rows(value):
+    """
+    Counts rows of a dataframe, or of all dataframes in a tuple or list; None for other values.
+    """
+    if isinstance(value, (tuple, list)):
+        counts = [frame_rows(v) for v in value]
+        counts = [c for c in counts if c is not None]
+        return sum(counts) if counts else None
+
+    shape = getattr(value, 'shape', None)
+    if shape:
+        return int(shape[0])
+
+    return None
+
+
+def statement_name(sql):
+    """
+    Short name of a SQL statement for grouping spans, e.g. 'INSERT city_summary'.
+    """
+    words = sql.split(None, 1)
+    if not words:
+        return ''
+
+    verb = words[0].upper()
+    if verb == 'COPY':
+        # COPY table FROM 's3://...'
+        target = re.match(r'\s*COPY\s+([\w."]+)', sql, re.IGNORECASE)
+    else:
+        target = STATEMENT_TARGET.search(sql)
+    return '{} {}'.format(verb, target.group(1)) if target else verb
+
+
+def current_run_id():
+    """
+    Gets the id of the current run, which stage processes inherit from the parent.
+    """
+    run_id = os.environ.get(RUN_ID_VARIABLE)
+    if run_id is None:
+        run_id = start_run()
+
+    return run_id
+
+
+def start_run():
+    """
+    Starts a new run; spans finished from now on (in this process and processes it starts) are tagged with its id.
+
+    Returns the run id.
+    """
+    run_id = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8])
+    os.environ[RUN_ID_VARIABLE] = run_id
+    if INSTRUMENTATION_ENABLED:
+        # room for this run's file
+        prune_span_files(keep=max(MAX_SPAN_RUNS - 1, 0))
+    return run_id
+
+
+def spans_path(run_id, spans_dir=SPANS_DIR):
+    """
+    Gets the path of the JSON lines file with a run's spans.
+    """
+    return os.path.join(spans_dir, '{}.jsonl'.format(run_id))
+
+
+def prune_span_files(keep=MAX_SPAN_RUNS, spans_dir=SPANS_DIR):
+    """
+    Removes span files of all but the keep most recently written runs.
+
+    keep - int; number of runs to keep
+    spans_dir - string; directory with the span files
+    """
+    if not os.path.isdir(spans_dir):
+        return
+
+    files = []
+    for filename in os.listdir(spans_dir):
+        path = os.path.join(spans_dir, filename)
+        try:
+            files.append((os.path.getmtime(path), path))
+        except OSError:
+            # removed by another process in the meantime
+            continue
+
+    for _, path in sorted(files, reverse=True)[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Span:
+    """
+    Measurements of one block of code; see span().
+    """
+    def __init__(self, name, kind, parent=None, rows_in=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_written = 0
+        self.attributes = dict(attributes or {})
+        self.status = 'ok'
+        self.error = None
+        self.start = time.time()
+        self.elapsed = None
+        self.peak_rss_delta = None
+        self._start_counter = time.perf_counter()
+        self._start_peak = peak_rss_bytes()
+
+
+    def add_rows_in(self, rows):
+        self.rows_in = (self.rows_in or 0) + rows
+
+
+    def add_rows_out(self, rows):
+        self.rows_out = (self.rows_out or 0) + rows
+
+
+    def add_bytes(self, n_bytes):
+        """
+        Records bytes written (to files, S3 or the warehouse) during the span.
+        """
+        self.bytes_written += n_bytes
+
+
+    def set(self, **attributes):
+        """
+        Adds attributes (e.g. table name) to the span.
+        """
+        self.attributes.update(attributes)
+
+
+    def finish(self, error=None):
+        self.elapsed = time.perf_counter() - self._start_counter
+        end_peak = peak_rss_bytes()
+        if end_peak is not None and self._start_peak is not None:
+            self.peak_rss_delta = end_peak - self._start_peak
+        if error is not None:
+            self.status = 'error'
+            self.error = '{}: {}'.format(type(error).__name__, error)
+        if self.parent is not None:
+            self.parent.add_bytes(self.bytes_written)
+
+
+    def to_dict(self):
+        return {'run_id': current_run_id(),
+                'span_id': self.span_id,
+                'parent_id': self.parent.span_id if self.parent else None,
+                'name': self.name,
+                'kind': self.kind,
+                'start': self.start,
+                'elapsed_seconds': self.elapsed,
+                'peak_rss_delta_bytes': self.peak_rss_delta,
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'bytes_written': self.bytes_written,
+                'status': self.status,
+                'error': self.error,
+                'pid': os.getpid(),
+                'attributes': self.attributes}
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current_span():
+    """
+    Gets the innermost open span in this thread, or None.
+    """
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def record_bytes(n_bytes):
+    """
+    Adds bytes written to the innermost open span in this thread, if there is one.
+    """
+    current = current_span()
+    if current is not None:
+        current.add_bytes(n_bytes)
+
+
+def write_span(record, path=None):
+    """
+    Appends a finished span to the JSON lines file of its run.
+    """
+    path = path or spans_path(record['run_id'])
+    line = json.dumps(record, default=str) + '\n'
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # one write per line in append mode, so lines from several processes don't interleave
+    with _write_lock, open(path, 'a') as f:
+        f.write(line)
+
+
+@contextmanager
+def span(name, kind='stage', rows_in=None, **attributes):
+    """
+    Context manager measuring a block of code.  Yields the Span, so the block can
+    record rows and bytes.  The span is written even if the block raises.
+
+    name - string; what is being measured, e.g. stage name or statement_name(sql)
+    kind - string; type of span, e.g. 'stage', 'statement', 'query', 'load'
+    rows_in - int or None; rows going in
+    attributes - extra values to record, e.g. table name
+    """
+    stack = _stack()
+    current = Span(name, kind, parent=stack[-1] if stack else None, rows_in=rows_in, attributes=attributes)
+    stack.append(current)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        stack.pop()
+        current.finish(error)
+        if INSTRUMENTATION_ENABLED:
+            write_span(current.to_dict())
+
+
+def read_spans(run_id=None, spans_dir=SPANS_DIR):
+    """
+    Reads spans from the JSON lines files.
+
+    run_id - string or None; only spans from this run, which are all in one file (default all kept runs)
+    spans_dir - string; directory with the span files
+    """
+    if run_id is not None:
+        paths = [spans_path(run_id, spans_dir)]
+    elif os.path.isdir(spans_dir):
+        paths = [os.path.join(spans_dir, fn) for fn in sorted(os.listdir(spans_dir)) if fn.endswith('.jsonl')]
+    else:
+        paths = []
+
+    spans = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            spans += [json.loads(line) for line in f]
+
+    return spans
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(spans, run_start=None, run_end=None, success=None):
+    """
+    Makes Prometheus text exposition of spans summed by kind and name.
+
+    spans - list of span dicts from read_spans
+    run_start - float or None; run start time (seconds since the epoch)
+    run_end - float or None; run end time
+    success - boolean or None; whether the run succeeded
+    """
+    totals = {}
+    for s in spans:
+        key = (s['kind'], s['name'])
+        t = totals.setdefault(key, {'seconds': 0.0, 'count': 0, 'errors': 0, 'rows_in': 0, 'rows_out': 0,
+                                    'bytes_written': 0, 'peak_rss_delta_bytes': 0})
+        t['seconds'] += s['elapsed_seconds'] or 0
+        t['count'] += 1
+        t['errors'] += s['status'] != 'ok'
+        t['rows_in'] += s['rows_in'] or 0
+        t['rows_out'] += s['rows_out'] or 0
+        t['bytes_written'] += s['bytes_written'] or 0
+        t['peak_rss_delta_bytes'] = max(t['peak_rss_delta_bytes'], s['peak_rss_delta_bytes'] or 0)
+
+    metrics = [('seconds', 'Total wall time of spans in the last run'),
+                ('count', 'Number of spans in the last run'),
+                ('errors', 'Number of spans which raised in the last run'),
+                ('rows_in', 'Rows going into spans in the last run'),
+                ('rows_out', 'Rows coming out of spans in the last run'),
+                ('bytes_written', 'Bytes written during spans in the last run'),
+                ('peak_rss_delta_bytes', 'Largest growth of peak RSS during one span in the last run')]
+    lines = []
+    for metric, description in metrics:
+        name = '{}_span_{}'.format(METRIC_PREFIX, metric)
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} gauge'.format(name))
+        for (kind, span_name), t in sorted(totals.items()):
+            lines.append('{}{{kind="{}",name="{}"}} {}'.format(name, escape_label(kind), escape_label(span_name), t[metric]))
+
+    run_metrics = [('last_run_start_timestamp_seconds', 'Start time of the last run', run_start),
+                    ('last_run_duration_seconds', 'Wall time of the last run', None if run_start is None or run_end is None else run_end - run_start),
+                    ('last_run_success', '1 if the last run succeeded', None if success is None else int(success))]
+    for metric, description, value in run_metrics:
+        if value is None:
+            continue
+        name = '{}_{}'.format(METRIC_PREFIX, metric)
+        lines += ['# HELP {} {}'.format(name, description), '# TYPE {} gauge'.format(name), '{} {}'.format(name, value)]
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(run_id, path=PROMETHEUS_FILE, **run_info):
+    """
+    Writes the spans of a run to a Prometheus textfile, replacing it atomically so the
+    collector never reads a partial file.
+
+    run_id - string; id from start_run
+    path - string; output .prom file
+    run_info - run_start, run_end and success for prometheus_text
+    """
+    text = prometheus_text(read_spans(run_id), **run_info)
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def run(name='etl'):
+    """
+    Context manager for one run of the pipeline: starts a run id, wraps the run in a
+    span, and writes the Prometheus textfile at the end, whether or not the run succeeded.
+
+    name - string; name of the run span
+    """
+    run_id = start_run()
+    start = time.time()
+    success = False
+    try:
+        with span(name, kind='run') as run_span:
+            yield run_span
+        success = True
+    finally:
+        if INSTRUMENTATION_ENABLED:
+            write_prometheus(run_id, run_start=start, run_end=time.time(), success=success)
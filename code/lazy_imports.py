@@ -0,0 +1,58 @@
+"""
+Modules imported on first use.
+
+pandas and numpy take most of the time of importing etl, and aren't needed to parse
+the command line, print help, or import the helpers in other scripts.  A module
+from lazy_module stands in for the real one and imports it the first time one of
+its attributes is used, after which it holds all of the real module's attributes,
+so lookups cost the same as on the module itself.
+"""
+import sys
+import types
+import importlib
+import threading
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module which is imported when one of its attributes is first used.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self._lock = threading.Lock()
+
+
+    def _load(self):
+        # stages run in threads, so only one of them may do the import
+        with self._lock:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return module
+
+
+    def __getattr__(self, attr):
+        # only called for attributes not copied over yet, i.e. before the import
+        return getattr(self._load(), attr)
+
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self.__name__)
+
+
+def lazy_module(name):
+    """
+    Gets a module which is imported when first used, e.g. pd = lazy_module('pandas').
+    If the module is already imported, it's returned as is.
+
+    name - string; module name
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+def is_loaded(module):
+    """
+    Checks whether a module from lazy_module has been imported yet.
+    """
+    return not isinstance(module, LazyModule) or '__file__' in module.__dict__
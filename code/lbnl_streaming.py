@@ -0,0 +1,155 @@
+"""
+Chunked, bounded-memory aggregation of the LBNL Tracking the Sun data.
+
+Only the columns needed for the installer and solar_metrics tables are read, and
+running counts/sums are kept instead of the full dataset, so peak memory depends
+on the number of distinct installers and zipcodes rather than the number of installs.
+"""
+from zipcode_utils import normalize_zipcodes, ValidZipcodes
+from aggregations import group_mode
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+
+LBNL_COLUMNS = ['Zip Code',
+                'Installer Name',
+                'Module Manufacturer #1',
+                'Battery System',
+                'Feed-in Tariff (Annual Payment)']
+
+LBNL_MEAN_COLUMNS = ['Battery System', 'Feed-in Tariff (Annual Payment)']
+
+LBNL_DTYPES = {'Zip Code': 'str',
+                'Installer Name': 'str',
+                'Module Manufacturer #1': 'str',
+                'Battery System': 'float64',
+                'Feed-in Tariff (Annual Payment)': 'float64'}
+
+
+class RunningMode:
+    """
+    Keeps running counts of (group, value) pairs to get the most common value per group.
+    Ties go to the value seen first in the group, like value_counts().index[0].
+    """
+    def __init__(self, group_col, value_col):
+        """
+        group_col - string; column to group by
+        value_col - string; column to get most common value of
+        """
+        self.group_col = group_col
+        self.value_col = value_col
+        self.counts = None
+
+
+    def update(self, df, positions):
+        """
+        Adds counts from a chunk of data.
+
+        df - pandas dataframe chunk with group_col and value_col
+        positions - numpy array; row number of each row of df in the full dataset
+        """
+        pairs = pd.DataFrame({self.group_col: df[self.group_col].values,
+                            self.value_col: df[self.value_col].values,
+                            'first': positions})
+        pairs = pairs.dropna(subset=[self.group_col, self.value_col])
+        if self.counts is not None:
+            pairs = pd.concat([self.counts, pairs.assign(count=1)], axis=0)
+        else:
+            pairs = pairs.assign(count=1)
+
+        self.counts = pairs.groupby([self.group_col, self.value_col], sort=False).agg({'count': 'sum', 'first': 'min'})
+        self.counts.reset_index(inplace=True)
+
+
+    def modes(self):
+        """
+        Returns dataframe indexed by group_col (sorted) with the most common value_col.
+        """
+        # in order of first appearance, so ties are broken the same way as the full data
+        counts = self.counts.sort_values('first')
+        return group_mode(counts, self.group_col, [self.value_col], weights='count')
+
+
+class RunningMean:
+    """
+    Keeps running sums and non-missing counts to get the mean of columns per group.
+    """
+    def __init__(self, group_col, value_cols):
+        """
+        group_col - string; column to group by
+        value_cols - list of strings; columns to get means of
+        """
+        self.group_col = group_col
+        self.value_cols = value_cols
+        self.sums = None
+        self.counts = None
+
+
+    def update(self, df):
+        """
+        Adds sums and counts from a chunk of data.
+
+        df - pandas dataframe chunk with group_col and value_cols
+        """
+        groups = df[[self.group_col] + self.value_cols].groupby(self.group_col)
+        sums, counts = groups.sum(), groups.count()
+        if self.sums is None:
+            self.sums, self.counts = sums, counts
+        else:
+            self.sums = self.sums.add(sums, fill_value=0)
+            self.counts = self.counts.add(counts, fill_value=0)
+
+
+    def means(self):
+        """
+        Returns dataframe indexed by group_col (sorted) with means of value_cols.
+        """
+        return (self.sums / self.counts.replace(0, np.nan)).sort_index()
+
+
+def stream_lbnl_aggregates(zip_df, filenames, chunksize=250000, short_zips=True):
+    """
+    Reads the LBNL files in chunks and aggregates them for extract_lbnl_data.
+    Matches load_lbnl_data(zip_df, replace_nans=False) followed by the groupbys.
+
+    zip_df - pandas dataframe with zipcode data for cleaning bad zipcodes
+    filenames - list of strings; LBNL csv files
+    chunksize - int; number of rows to read at a time
+    short_zips - boolean; if True, makes sure all zip codes are 5-digit
+
+    Returns manufacturer_modes (most common module manufacturer by installer),
+    installer_modes (most common installer by zipcode) and zip_means
+    (mean battery system and feed-in tariff by zipcode).
+    """
+    valid_zips = ValidZipcodes.from_zip_df(zip_df)
+    manufacturer_mode = RunningMode('Installer Name', 'Module Manufacturer #1')
+    installer_mode = RunningMode('Zip Code', 'Installer Name')
+    zip_mean = RunningMean('Zip Code', LBNL_MEAN_COLUMNS)
+
+    offset = 0
+    for fn in filenames:
+        reader = pd.read_csv(fn,
+                            encoding='latin-1',
+                            usecols=LBNL_COLUMNS,
+                            dtype=LBNL_DTYPES,
+                            chunksize=chunksize)
+        for chunk in reader:
+            positions = np.arange(offset, offset + chunk.shape[0])
+            offset += chunk.shape[0]
+
+            chunk['Zip Code'] = normalize_zipcodes(chunk['Zip Code'], truncate=short_zips)
+            valid = valid_zips.mask(chunk['Zip Code'])
+            chunk, positions = chunk[valid], positions[valid]
+
+            manufacturer_mode.update(chunk, positions)
+            installer_mode.update(chunk, positions)
+
+            # -9999 is the missing value placeholder
+            zip_mean.update(chunk.replace(-9999, 0))
+
+    manufacturer_modes = manufacturer_mode.modes()
+    manufacturer_modes.reset_index(inplace=True)
+
+    return manufacturer_modes, installer_mode.modes(), zip_mean.means()
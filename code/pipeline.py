@@ -0,0 +1,227 @@
+"""
+Small DAG scheduler for running ETL stages in parallel.
+
+Stages declare which other stages' outputs they take as inputs, and every stage
+whose inputs are ready is started right away in a process pool (CPU-bound stages)
+or a thread pool (I/O-bound stages like S3 uploads).  Wall time of each stage and
+the critical path through the DAG are recorded.
+
+Dataframes returned by process stages can be handed to the stages after them as
+memory-mapped Arrow IPC files instead of being pickled (see arrow_frames.py).
+"""
+import os
+import time
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import instrumentation
+import arrow_frames
+
+
+class StageError(Exception):
+    """
+    Raised when a stage fails; the original exception is the __cause__.
+    """
+    def __init__(self, stage_name):
+        super().__init__('stage {} failed'.format(stage_name))
+        self.stage_name = stage_name
+
+
+class Stage:
+    """
+    One step of the pipeline.
+    """
+    def __init__(self, name, func, deps=(), kwargs=None, kind='process', after=()):
+        """
+        name - string; unique name of the stage
+        func - function to run; must be a module-level function so it can be sent to another process
+        deps - list of stage names, or (stage name, index) tuples to pick one item from a stage
+            returning a tuple; their outputs are passed to func as positional arguments in order
+        kwargs - dict of keyword arguments for func
+        kind - string; 'process' to run in the process pool, 'thread' to run in the thread pool
+        after - list of stage names which must finish first, but whose outputs aren't passed to func
+        """
+        if kind not in ('process', 'thread'):
+            raise ValueError("kind must be 'process' or 'thread', not {}".format(kind))
+
+        self.name = name
+        self.func = func
+        self.deps = [d if isinstance(d, tuple) else (d, None) for d in deps]
+        self.kwargs = kwargs or {}
+        self.kind = kind
+        self.after = set(after)
+
+
+    @property
+    def upstream(self):
+        """
+        Names of the stages this stage depends on.
+        """
+        return {name for name, _ in self.deps} | self.after
+
+
+def _timed_call(name, func, args, kwargs, exchange_dir=None):
+    """
+    Runs func in a span named after the stage (see instrumentation.py), and returns its
+    result with start and end wall-clock times.  Times are taken inside the worker so they
+    don't include time waiting in the pool queue.
+
+    Inputs which are arrow_frames.FrameRefs are loaded first.  If exchange_dir is given,
+    dataframes in the result are written there and returned as FrameRefs.
+    """
+    start = time.time()
+    with instrumentation.span(name, kind='stage', rows_in=instrumentation.frame_rows(list(args))) as s:
+        result = func(*[arrow_frames.resolve(a) for a in args], **kwargs)
+        rows_out = instrumentation.frame_rows(result)
+        if rows_out is not None:
+            s.add_rows_out(rows_out)
+        if exchange_dir is not None:
+            result = arrow_frames.export(result, exchange_dir, name)
+
+    return result, start, time.time()
+
+
+def critical_path(stages, timings):
+    """
+    Gets the chain of dependent stages with the largest total run time.
+
+    stages - list of Stage objects
+    timings - dict of stage name to dict with 'elapsed' seconds
+
+    Returns list of stage names and the total seconds along the path.
+    """
+    by_name = {s.name: s for s in stages}
+    longest = {}
+
+    def path_to(name):
+        if name not in longest:
+            best_path, best_time = [], 0.0
+            for dep in by_name[name].upstream:
+                path, total = path_to(dep)
+                if total > best_time:
+                    best_path, best_time = path, total
+            longest[name] = (best_path + [name], best_time + timings[name]['elapsed'])
+
+        return longest[name]
+
+    paths = [path_to(s.name) for s in stages if s.name in timings]
+    return max(paths, key=lambda p: p[1]) if paths else ([], 0.0)
+
+
+class PipelineResult:
+    """
+    Outputs and timings from running a pipeline.
+    """
+    def __init__(self, stages, outputs, timings, start, end):
+        self.stages = stages
+        self.outputs = outputs
+        self.timings = timings
+        self.wall_time = end - start
+        self.critical_path, self.critical_path_time = critical_path(stages, timings)
+
+
+    def report(self):
+        """
+        Returns string summary of stage wall times and the critical path.
+        """
+        lines = ['stage timings (seconds from pipeline start):']
+        for name, t in sorted(self.timings.items(), key=lambda x: x[1]['start']):
+            lines.append('  {:<28} start {:>8.2f}  end {:>8.2f}  elapsed {:>8.2f}'.format(
+                name, t['start'], t['end'], t['elapsed']))
+
+        lines.append('total wall time: {:.2f}s'.format(self.wall_time))
+        lines.append('critical path ({:.2f}s): {}'.format(self.critical_path_time, ' -> '.join(self.critical_path)))
+        return '\n'.join(lines)
+
+
+def check_stages(stages):
+    """
+    Makes sure stage names are unique, dependencies exist and there are no cycles.
+
+    stages - list of Stage objects
+    """
+    names = [s.name for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError('stage names must be unique')
+
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        missing = s.upstream - set(names)
+        if missing:
+            raise ValueError('stage {} depends on unknown stages {}'.format(s.name, sorted(missing)))
+
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if s.upstream <= done]
+        if not ready:
+            raise ValueError('stages have a dependency cycle: {}'.format(sorted(s.name for s in remaining)))
+        done.update(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in done]
+
+    return by_name
+
+
+def run_stages(stages, max_workers=None, max_threads=4, exchange_dir=None):
+    """
+    Runs stages as soon as their dependencies have finished.
+
+    stages - list of Stage objects
+    max_workers - int or None; number of processes (default is number of CPUs)
+    max_threads - int; number of threads for 'thread' stages
+    exchange_dir - string or None; if given, dataframes returned by 'process' stages are
+        passed on as Arrow IPC files in a temporary directory in here, removed at the end
+
+    Returns PipelineResult with outputs of each stage and timings.
+    """
+    check_stages(stages)
+    outputs, timings, running = {}, {}, {}
+    pending = list(stages)
+    start = time.time()
+    run_dir = None
+    if exchange_dir is not None:
+        os.makedirs(exchange_dir, exist_ok=True)
+        run_dir = tempfile.mkdtemp(prefix='run-', dir=exchange_dir)
+
+    def inputs(stage):
+        args = []
+        for name, index in stage.deps:
+            args.append(outputs[name] if index is None else outputs[name][index])
+        return args
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as processes, ThreadPoolExecutor(max_workers=max_threads) as threads:
+            pools = {'process': processes, 'thread': threads}
+            while pending or running:
+                ready = [s for s in pending if s.upstream <= set(outputs)]
+                for stage in ready:
+                    pending.remove(stage)
+                    # thread stages' outputs are already shared in memory
+                    stage_dir = run_dir if stage.kind == 'process' else None
+                    future = pools[stage.kind].submit(_timed_call, stage.name, stage.func, inputs(stage), stage.kwargs, stage_dir)
+                    running[future] = stage
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        result, stage_start, stage_end = future.result()
+                    except Exception as e:
+                        for f in running:
+                            f.cancel()
+                        raise StageError(stage.name) from e
+
+                    outputs[stage.name] = result
+                    timings[stage.name] = {'start': stage_start - start,
+                                            'end': stage_end - start,
+                                            'elapsed': stage_end - stage_start}
+
+        # the files can be removed once they're mapped (or converted)
+        outputs = {name: arrow_frames.resolve(value) for name, value in outputs.items()}
+    finally:
+        if run_dir is not None:
+            arrow_frames.release(run_dir)
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    return PipelineResult(stages, outputs, timings, start, time.time())
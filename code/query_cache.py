@@ -0,0 +1,188 @@
+"""
+On-disk cache of analysis query results.
+
+Results are keyed by the normalized SQL, the query parameters and the load version
+stamp the ETL writes to the warehouse on every load, so cached results are reused
+until the warehouse is reloaded with different data.  Results are stored as Parquet,
+expire after a TTL, and the least-recently-used results are evicted past a size limit
+(with the same eviction as the stage cache).
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import datetime
+
+import sql_utils
+from stage_cache import CACHE_DIR, META_FILENAME, StageCache, hash_frame
+
+
+QUERY_CACHE_DIR = os.environ.get('SOLAR_QUERY_CACHE_DIR', os.path.join(CACHE_DIR, 'queries'))
+QUERY_CACHE_MAX_BYTES = int(os.environ.get('SOLAR_QUERY_CACHE_MAX_BYTES', 1024 ** 3))
+# seconds before cached results expire, even if the warehouse hasn't been reloaded
+QUERY_CACHE_TTL = float(os.environ.get('SOLAR_QUERY_CACHE_TTL', 7 * 24 * 3600))
+# set SOLAR_QUERY_CACHE=0 to always query the warehouse
+QUERY_CACHE_ENABLED = os.environ.get('SOLAR_QUERY_CACHE', '1') != '0'
+# seconds the load version may be reused before it's read from the warehouse again; by default
+# it's read (one row) for every cached query, so a reload by another process is seen right away
+VERSION_CHECK_SECONDS = float(os.environ.get('SOLAR_QUERY_VERSION_CHECK_SECONDS', 0))
+
+_load_version = {'version': None, 'checked': 0}
+
+
+def normalize_sql(sql):
+    """
+    Normalizes whitespace and the trailing semicolon of a query, so formatting
+    differences don't change the cache key.  Quoted strings are left as is.
+
+    sql - string; SQL query
+    """
+    parts = re.split(r"('(?:[^']|'')*')", sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i])
+
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def query_key(sql, params, version, dtypes=None):
+    """
+    Gets cache key of a query result.
+
+    sql - string; SQL query
+    params - dict, tuple or None; query parameters
+    version - string; load version of the warehouse
+    dtypes - dict or None; dtypes the result is converted to
+    """
+    if isinstance(params, dict):
+        params = sorted(params.items())
+
+    sha = hashlib.sha256()
+    sha.update(normalize_sql(sql).encode())
+    sha.update(repr(params).encode())
+    sha.update(repr(sorted((dtypes or {}).items())).encode())
+    sha.update(str(version).encode())
+    return sha.hexdigest()
+
+
+def new_load_version():
+    """
+    Makes a unique load version stamp, e.g. for a full reload.
+    """
+    return '{:%Y%m%dT%H%M%S}-{}'.format(datetime.datetime.utcnow(), uuid.uuid4().hex[:12])
+
+
+def content_load_version(frames):
+    """
+    Makes a load version stamp from the loaded data, so loads which don't change
+    anything keep the same stamp (and the cached results).
+
+    frames - list of pandas dataframes, e.g. the saved key hashes of each table
+    """
+    sha = hashlib.sha256()
+    for df in frames:
+        sha.update(hash_frame(df).encode())
+
+    return sha.hexdigest()[:32]
+
+
+def write_load_version(cur, version):
+    """
+    Replaces the load version stamp in the warehouse.  Doesn't commit.
+
+    cur - psycopg2 cursor or DuckDB connection
+    version - string; load version stamp
+    """
+    sql_utils.execute(cur, 'DELETE FROM load_version;')
+    sql_utils.execute(cur,
+                    'INSERT INTO load_version (version, loaded_at) VALUES (%s, %s);',
+                    (version, datetime.datetime.utcnow()))
+    # a load in this process must not be hidden by the version read before it
+    _load_version['checked'] = 0
+
+
+def get_load_version(refresh=False):
+    """
+    Gets the load version stamp from the warehouse, reusing it for up to VERSION_CHECK_SECONDS
+    (0 by default, i.e. it's read every time).
+
+    refresh - boolean; if True, always reads the stamp from the warehouse
+    """
+    import psycopg2
+    import warehouse
+
+    if refresh or time.time() - _load_version['checked'] >= VERSION_CHECK_SECONDS:
+        try:
+            df = warehouse.read_sql('SELECT version FROM load_version;')
+        except psycopg2.ProgrammingError:
+            # tables were created before load versions were added
+            df = None
+        _load_version['version'] = df['version'].iloc[0] if df is not None and df.shape[0] > 0 else None
+        _load_version['checked'] = time.time()
+
+    return _load_version['version']
+
+
+class QueryCache(StageCache):
+    """
+    Directory of cached query results, which also expire after a TTL.
+    """
+    def __init__(self, cache_dir=QUERY_CACHE_DIR, max_bytes=QUERY_CACHE_MAX_BYTES, ttl=QUERY_CACHE_TTL):
+        """
+        cache_dir - string; directory to store cached results in
+        max_bytes - int; maximum total size of cached results
+        ttl - float; seconds before a cached result expires
+        """
+        super().__init__(cache_dir, max_bytes)
+        self.ttl = ttl
+
+
+    def get(self, stage, key):
+        """
+        Loads cached result, or returns None if there isn't one or it has expired.
+
+        stage - string; name for the kind of result
+        key - string; key from query_key
+        """
+        path = self.entry_path(stage, key)
+        meta_path = os.path.join(path, META_FILENAME)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                created = json.load(f)['created']
+            if time.time() - created > self.ttl:
+                shutil.rmtree(path, ignore_errors=True)
+                return None
+
+        return super().get(stage, key)
+
+
+def read_sql(sql, params=None, dtypes=None, server_side=False, cache=None):
+    """
+    Runs a query like warehouse.read_sql, but returns the cached result if the same
+    query was run since the warehouse was last loaded.
+
+    sql - string; SQL query with %(name)s or %s placeholders
+    params - dict, tuple or None; query parameters
+    dtypes - dict or None; column name to dtype, overriding the types from the database
+    server_side - boolean; if True, uses a server-side cursor
+    cache - QueryCache or None; cache to use (default is QueryCache())
+    """
+    # imported here so the load version helpers work without psycopg2 (e.g. with the DuckDB backend)
+    import warehouse
+
+    version = get_load_version() if QUERY_CACHE_ENABLED else None
+    # without a version stamp there's no way to tell if results are stale
+    if version is None:
+        return warehouse.read_sql(sql, params, dtypes=dtypes, server_side=server_side)
+
+    cache = cache or QueryCache()
+    key = query_key(sql, params, version, dtypes)
+    df = cache.get('query', key)
+    if df is not None:
+        return df
+
+    df = warehouse.read_sql(sql, params, dtypes=dtypes, server_side=server_side)
+    cache.put('query', key, df)
+    return df
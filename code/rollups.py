@@ -0,0 +1,123 @@
+"""
+City and state summary tables built in the warehouse during the load.
+
+The analysis queries all aggregate solar_metrics joined to zipcodes by city and state.
+These rollups store the sums and non-null counts of those metrics per city and per
+state, so averages can still be computed exactly, and only the cities of zipcodes which
+changed in a load need to be re-aggregated.  State rows are rebuilt from the city rows.
+"""
+import sql_queries as sql_q
+from sql_utils import insert_frame, execute
+from lazy_imports import lazy_module
+
+pd = lazy_module('pandas')
+
+
+# loaded tables whose changes can change the rollups; both are keyed by zip_code
+SOURCE_TABLES = ('solar_metrics', 'zipcodes')
+
+CHANGED_ZIPS = 'rollup_changed_zips'
+AFFECTED_CITIES = 'rollup_affected_cities'
+
+# matches rows in a and b with the same city and state, including cities with missing names
+SAME_CITY = "COALESCE({0}.city_name, '') = COALESCE({1}.city_name, '') AND COALESCE({0}.state_name, '') = COALESCE({1}.state_name, '')"
+
+
+def city_rollup_insert(affected_only=False):
+    """
+    Makes statement which aggregates solar_metrics into city_summary.
+
+    affected_only - boolean; if True, only cities in the affected cities temp table are aggregated
+    """
+    metrics = ',\n'.join('CAST(SUM(sm.{0}) AS DOUBLE PRECISION), COUNT(sm.{0})'.format(m)
+                        for m in sql_q.ROLLUP_METRICS)
+    restrict = ''
+    if affected_only:
+        restrict = 'INNER JOIN (SELECT DISTINCT city_name, state_name FROM {0}) a\nON {1}\n'.format(
+            AFFECTED_CITIES, SAME_CITY.format('z', 'a'))
+
+    return """INSERT INTO city_summary ({})
+SELECT z.city_name, z.state_name, COUNT(DISTINCT sm.zip_code),
+{}
+FROM solar_metrics sm
+INNER JOIN zipcodes z
+ON sm.zip_code=z.zip_code
+{}GROUP BY z.city_name, z.state_name;
+""".format(', '.join(c.name for c in sql_q.city_summary_table.columns), metrics, restrict)
+
+
+def state_rollup_insert(affected_only=False):
+    """
+    Makes statement which aggregates city_summary into state_summary.
+
+    affected_only - boolean; if True, only states in the affected cities temp table are aggregated
+    """
+    metrics = ',\n'.join('SUM({0}_sum), SUM({0}_count)'.format(m) for m in sql_q.ROLLUP_METRICS)
+    restrict = ''
+    if affected_only:
+        restrict = "WHERE COALESCE(state_name, '') IN (SELECT COALESCE(state_name, '') FROM {})\n".format(AFFECTED_CITIES)
+
+    return """INSERT INTO state_summary ({})
+SELECT state_name, COUNT(*), SUM(zip_count),
+{}
+FROM city_summary
+{}GROUP BY state_name;
+""".format(', '.join(c.name for c in sql_q.state_summary_table.columns), metrics, restrict)
+
+
+def mark_changed_zipcodes(cur, zipcodes):
+    """
+    Records zipcodes whose rows are about to be changed or removed, and the cities
+    they belong to before the change.  Must be called before the upserts, in the same transaction.
+
+    cur - psycopg2 cursor or DuckDB connection
+    zipcodes - list-like of zipcode strings
+    """
+    execute(cur, 'CREATE TEMP TABLE {} (zip_code VARCHAR(5));'.format(CHANGED_ZIPS))
+    insert_frame(cur, CHANGED_ZIPS, ['zip_code'], pd.DataFrame({'zip_code': list(zipcodes)}))
+
+    execute(cur, """CREATE TEMP TABLE {} AS
+    SELECT DISTINCT z.city_name, z.state_name
+    FROM zipcodes z
+    INNER JOIN {} c
+    ON z.zip_code=c.zip_code;""".format(AFFECTED_CITIES, CHANGED_ZIPS))
+
+
+def rebuild_rollups(cur):
+    """
+    Recomputes both rollup tables from scratch.  Doesn't commit.
+
+    cur - psycopg2 cursor or DuckDB connection
+    """
+    execute(cur, 'DELETE FROM city_summary;')
+    execute(cur, city_rollup_insert())
+    execute(cur, 'DELETE FROM state_summary;')
+    execute(cur, state_rollup_insert())
+
+
+def refresh_rollups(cur, full=False):
+    """
+    Updates the rollup rows of cities and states with changed zipcodes (recorded with
+    mark_changed_zipcodes before the upserts), or all rows if full is True.  Doesn't commit.
+
+    cur - psycopg2 cursor or DuckDB connection
+    full - boolean; if True, rebuilds the rollups from scratch
+    """
+    execute(cur, 'SELECT COUNT(*) FROM city_summary;')
+    if full or cur.fetchone()[0] == 0:
+        rebuild_rollups(cur)
+    else:
+        # cities the changed zipcodes belong to after the change
+        execute(cur, """INSERT INTO {0} (city_name, state_name)
+        SELECT DISTINCT z.city_name, z.state_name
+        FROM zipcodes z
+        INNER JOIN {1} c
+        ON z.zip_code=c.zip_code;""".format(AFFECTED_CITIES, CHANGED_ZIPS))
+        execute(cur, 'DELETE FROM city_summary USING {0} a WHERE {1};'.format(
+            AFFECTED_CITIES, SAME_CITY.format('city_summary', 'a')))
+        execute(cur, city_rollup_insert(affected_only=True))
+        execute(cur, "DELETE FROM state_summary WHERE COALESCE(state_name, '') IN (SELECT COALESCE(state_name, '') FROM {});".format(AFFECTED_CITIES))
+        execute(cur, state_rollup_insert(affected_only=True))
+
+    execute(cur, 'DROP TABLE IF EXISTS {};'.format(AFFECTED_CITIES))
+    execute(cur, 'DROP TABLE IF EXISTS {};'.format(CHANGED_ZIPS))
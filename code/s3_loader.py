@@ -0,0 +1,216 @@
+"""
+Stages dataframes in S3 as compressed, split CSV files with a manifest, and loads
+them into Redshift with COPY, several tables at a time.
+
+Redshift loads each file of a COPY on one slice, so splitting tables into a multiple
+of the cluster's slice count lets every slice load in parallel.  Files are built and
+compressed in memory and uploaded concurrently (multipart for large parts).  Frames
+are converted to one Arrow table, whose row slices are written by Arrow's csv writer.
+"""
+import io
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+import arrow_frames
+from sql_utils import execute
+from lazy_imports import lazy_module
+
+np = lazy_module('numpy')
+
+
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst', None: ''}
+# parts larger than this are uploaded in concurrent multipart chunks
+MULTIPART_THRESHOLD = 8 * 1024 ** 2
+
+
+def get_slice_count(cur):
+    """
+    Gets number of slices in the Redshift cluster.
+
+    cur - psycopg2 cursor connected to Redshift
+    """
+    execute(cur, 'SELECT COUNT(*) FROM stv_slices;')
+    return cur.fetchone()[0]
+
+
+def compress(data, compression='gzip'):
+    """
+    Compresses bytes.
+
+    data - bytes
+    compression - string or None; 'gzip', 'zstd' (needs the zstandard package) or None
+    """
+    if compression == 'gzip':
+        # level 6 is a good tradeoff of speed and size for csv
+        return gzip.compress(data, compresslevel=6)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif compression is None:
+        return data
+
+    raise ValueError('unknown compression {}'.format(compression))
+
+
+def decompress_stream(fileobj, compression='gzip'):
+    """
+    Wraps a file object so reads return decompressed bytes.
+
+    fileobj - binary file object
+    compression - string or None; 'gzip', 'zstd' or None
+    """
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=fileobj)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+    return fileobj
+
+
+def split_table(table, n_parts):
+    """
+    Splits an Arrow table into n_parts row slices of nearly equal size (without copying).
+
+    table - Arrow table
+    n_parts - int; number of parts
+    """
+    bounds = np.linspace(0, table.num_rows, n_parts + 1).astype(int)
+    return [table.slice(start, end - start) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def csv_part(table, compression='gzip'):
+    """
+    Writes an Arrow table to compressed csv bytes (no header).
+
+    table - Arrow table
+    compression - string or None; 'gzip', 'zstd' or None
+    """
+    import pyarrow as pa
+
+    sink = pa.BufferOutputStream()
+    arrow_frames.write_csv(table, sink, header=False)
+    return compress(sink.getvalue().to_pybytes(), compression)
+
+
+def upload_bytes(s3_client, data, bucket, key):
+    """
+    Uploads bytes from memory to S3, using multipart upload for large data.
+
+    s3_client - boto3 S3 client
+    data - bytes
+    bucket - string; bucket name
+    key - string; object key
+    """
+    from boto3.s3.transfer import TransferConfig
+
+    config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=4)
+    s3_client.upload_fileobj(io.BytesIO(data), bucket, key, Config=config)
+
+
+def stage_table(df, table, bucket, n_files, s3_client, prefix='staging', compression='gzip', max_workers=8):
+    """
+    Writes a dataframe to S3 as n_files compressed csv files and a manifest listing them.
+
+    df - pandas dataframe or Arrow table with columns in the same order as the table
+    table - string; name of the table, used for the S3 keys
+    bucket - string; bucket name
+    n_files - int; number of files, ideally a multiple of the number of slices
+    s3_client - boto3 S3 client
+    prefix - string; key prefix for staged files
+    compression - string or None; 'gzip', 'zstd' or None
+    max_workers - int; number of threads for compressing and uploading
+
+    Returns the S3 url of the manifest.
+    """
+    # dictionaries are decoded once for the whole table, not per part; float32 columns
+    # are written in their shortest form, so they don't need widening first
+    arrow_table = arrow_frames.decode_dictionaries(arrow_frames.to_arrow(df, preserve_index=False))
+    parts = [p for p in split_table(arrow_table, n_files) if p.num_rows > 0]
+    extension = '.csv' + COMPRESSIONS[compression]
+    keys = ['{}/{}/part_{:04d}{}'.format(prefix, table, i, extension) for i in range(len(parts))]
+
+    def write_part(args):
+        part, key = args
+        data = csv_part(part, compression)
+        upload_bytes(s3_client, data, bucket, key)
+        return len(data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sizes = list(executor.map(write_part, zip(parts, keys)))
+
+    manifest = {'entries': [{'url': 's3://{}/{}'.format(bucket, key),
+                            'mandatory': True,
+                            'meta': {'content_length': size}}
+                            for key, size in zip(keys, sizes)]}
+    manifest_key = '{}/{}.manifest'.format(prefix, table)
+    manifest_body = json.dumps(manifest).encode('utf-8')
+    s3_client.put_object(Bucket=bucket, Key=manifest_key, Body=manifest_body)
+    instrumentation.record_bytes(sum(sizes) + len(manifest_body))
+
+    return 's3://{}/{}'.format(bucket, manifest_key)
+
+
+def copy_statement(table, manifest_url, iam_role, compression='gzip', columns=None):
+    """
+    Makes a Redshift COPY statement for a staged table.
+
+    table - string; name of table
+    manifest_url - string; S3 url of manifest
+    iam_role - string; ARN of IAM role with S3 read access
+    compression - string or None; 'gzip', 'zstd' or None
+    columns - list of strings or None; table columns in the order of the csv columns
+    """
+    column_list = ' ({})'.format(', '.join(columns)) if columns else ''
+    compression_option = {'gzip': ' GZIP', 'zstd': ' ZSTD', None: ''}[compression]
+    return ("""COPY {}{} FROM '{}'
+    credentials 'aws_iam_role={}' MANIFEST CSV{};
+    """).format(table, column_list, manifest_url, iam_role, compression_option)
+
+
+def copy_manifest_from_stdin(cur, table, manifest_url, s3_client, compression='gzip', columns=None):
+    """
+    Loads a staged table by streaming the manifest's files through COPY FROM STDIN.
+    This works with any Postgres-compatible database (e.g. a local Postgres for testing),
+    which can't COPY from S3 directly.
+
+    cur - psycopg2 cursor
+    table - string; name of table
+    manifest_url - string; S3 url of manifest
+    s3_client - boto3 S3 client
+    compression - string or None; 'gzip', 'zstd' or None
+    columns - list of strings or None; table columns in the order of the csv columns
+    """
+    bucket, key = manifest_url[len('s3://'):].split('/', 1)
+    manifest = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    column_list = ' ({})'.format(', '.join(columns)) if columns else ''
+    with instrumentation.span('COPY {}'.format(table), kind='statement') as s:
+        for entry in manifest['entries']:
+            part_bucket, part_key = entry['url'][len('s3://'):].split('/', 1)
+            body = s3_client.get_object(Bucket=part_bucket, Key=part_key)['Body']
+            cur.copy_expert('COPY {}{} FROM STDIN WITH (FORMAT csv)'.format(table, column_list),
+                            decompress_stream(body, compression))
+            s.add_rows_out(max(cur.rowcount, 0))
+
+
+def copy_tables_parallel(statements, connection, max_workers=4):
+    """
+    Runs COPY statements at the same time, each on its own connection.
+
+    statements - dict of table name to COPY statement
+    connection - function returning a context manager that yields a connection and
+        commits on exit, like warehouse.connection
+    max_workers - int; number of tables to load at once
+    """
+    def run_copy(item):
+        table, statement = item
+        with connection() as conn:
+            with conn.cursor() as cur:
+                execute(cur, statement)
+
+        return table
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_copy, statements.items()))
@@ -1,97 +1,271 @@
-# drop tables; for resetting the DWH
-solar_metrics_drop = 'DROP TABLE IF EXISTS solar_metrics;'
-zipcodes_drop = 'DROP TABLE IF EXISTS zipcodes;'
-utility_drop = 'DROP TABLE IF EXISTS utility;'
-installer_drop = 'DROP TABLE IF EXISTS installer;'
+"""
+Warehouse schema.
 
+Tables are defined once below, including the physical design for Redshift
+(distribution style, sort keys and column compression encodings), and the DDL,
+insert statements and COPY column lists are all generated from the definitions.
 
-# create tables
-solar_metrics_table_create = """CREATE TABLE IF NOT EXISTS solar_metrics
-(id INT IDENTITY(0, 1) PRIMARY KEY,
-zip_code VARCHAR NOT NULL,
-percent_qualified_bldgs NUMERIC,
-number_potential_panels INT,
-kw_median NUMERIC,
-potential_installs INT,
-median_income NUMERIC,
-median_age NUMERIC,
-occupied_housing_units INT,
-owner_occupied_housing_units INT,
-family_homes INT,
-collegiates INT,
-moved_recently INT,
-average_yearly_electric_bill NUMERIC,
-average_yearly_kwh_used NUMERIC,
-primary_installer_id INT,
-battery_system_fraction NUMERIC,
-mean_annual_feedin_tariff NUMERIC);
+Physical design:
+- solar_metrics, zipcodes and utility are all distributed and sorted on zip_code,
+so the joins between them are collocated on each slice (no redistribution) and can
+be merge joins.
+- installer is small, so a copy is kept on every node (DISTSTYLE ALL) for the join
+on primary_installer_id.
+- sort key columns are left uncompressed (RAW) so range-restricted scans stay cheap,
+numbers use AZ64, low-cardinality strings BYTEDICT and other strings ZSTD.
 """
+from collections import namedtuple
 
-zipcode_table_create = """CREATE TABLE IF NOT EXISTS zipcodes
-(zip_code VARCHAR PRIMARY KEY,
-city_name VARCHAR,
-state_name VARCHAR,
-latitude NUMERIC,
-longitude NUMERIC);
-"""
 
-utility_table_create = """CREATE TABLE IF NOT EXISTS utility
-(zip_code VARCHAR PRIMARY KEY,
-utility_name VARCHAR,
-ownership VARCHAR, 
-service_type VARCHAR);
-"""
+# sql dialects the DDL can be generated for; only redshift has the physical design options
+DIALECTS = ('redshift', 'postgres', 'duckdb')
 
-installer_table_create = """CREATE TABLE IF NOT EXISTS installer
-(installer_id INT PRIMARY KEY,
-installer_name VARCHAR,
-installer_primary_module_manufacturer VARCHAR);
-"""
+# column types which are different in DuckDB; its default NUMERIC precision would round the data
+DUCKDB_TYPES = {'NUMERIC': 'DOUBLE'}
 
-# insert statements
 
-solar_metrics_insert = """INSERT INTO solar_metrics
-(zip_code,
-percent_qualified_bldgs,
-number_potential_panels,
-kw_median,
-potential_installs,
-median_income,
-median_age,
-occupied_housing_units,
-owner_occupied_housing_units,
-family_homes,
-collegiates,
-moved_recently,
-average_yearly_electric_bill,
-average_yearly_kwh_used,
-primary_installer_id,
-battery_system_fraction,
-mean_annual_feedin_tariff)
-VALUES %s;
-"""
+Column = namedtuple('Column', ['name', 'type', 'encode', 'constraint', 'identity'])
+# encode, constraint and identity are optional
+Column.__new__.__defaults__ = (None, '', False)
 
-zipcodes_insert = """INSERT INTO zipcodes
-(zip_code, city_name, state_name, latitude, longitude)
-VALUES %s;
-"""
 
-utility_insert = """INSERT INTO utility
-(zip_code, utility_name, ownership, service_type)
-VALUES %s;
-"""
+class Table:
+    """
+    Definition of a warehouse table.
+    """
+    def __init__(self, name, columns, key=None, diststyle='KEY', distkey=None, sortkey=()):
+        """
+        name - string; name of table
+        columns - list of Column namedtuples
+        key - string or None; column which identifies rows, used for incremental loads
+        diststyle - string; Redshift distribution style ('KEY', 'ALL', 'EVEN' or 'AUTO')
+        distkey - string or None; distribution key column if diststyle is 'KEY'
+        sortkey - list of strings; compound sort key columns
+        """
+        if diststyle == 'KEY' and distkey is None:
+            raise ValueError('table {} has KEY distribution but no distkey'.format(name))
 
-installer_insert = """INSERT INTO installer
-(installer_id, installer_name, installer_primary_module_manufacturer)
-VALUES %s;
-"""
+        self.name = name
+        self.columns = columns
+        self.key = key
+        self.diststyle = diststyle
+        self.distkey = distkey
+        self.sortkey = list(sortkey)
+
+
+    @property
+    def load_columns(self):
+        """
+        Names of columns that are loaded from data (all but identity columns),
+        in the order of the dataframe/csv columns.
+        """
+        return [c.name for c in self.columns if not c.identity]
+
+
+    def sequence_name(self, column):
+        return '{}_{}_seq'.format(self.name, column.name)
+
+
+    def column_sql(self, column, dialect='redshift', physical=True):
+        """
+        Makes the definition of one column for CREATE TABLE.
+        """
+        if dialect == 'duckdb':
+            parts = [column.name, DUCKDB_TYPES.get(column.type, column.type)]
+            # DuckDB has no identity columns, so ids come from a sequence
+            if column.identity:
+                parts.append("DEFAULT nextval('{}')".format(self.sequence_name(column)))
+            # the incremental load deletes changed rows and inserts their new versions in one
+            # transaction, which DuckDB's eagerly checked primary key indexes reject as duplicates,
+            # and solar_metrics can repeat the few project sunroof zipcodes the merge keeps twice;
+            # so only NOT NULL is kept, and uniqueness is left to the warehouse quality checks
+            # (as on Redshift, which doesn't enforce primary keys)
+            if 'NOT NULL' in column.constraint:
+                parts.append('NOT NULL')
+            return ' '.join(parts)
+
+        parts = [column.name, column.type]
+        if column.identity:
+            parts.append('IDENTITY(0, 1)' if dialect == 'redshift' else 'GENERATED BY DEFAULT AS IDENTITY')
+        # column attributes come before constraints in Redshift
+        if dialect == 'redshift' and physical and column.encode:
+            parts.append('ENCODE {}'.format(column.encode))
+        if column.constraint:
+            parts.append(column.constraint)
+
+        return ' '.join(parts)
+
+
+    def create(self, dialect='redshift', physical=True, schema=None):
+        """
+        Makes CREATE TABLE statement.
+
+        dialect - string; one of DIALECTS
+        physical - boolean; if True, includes the distribution style, sort key and encodings (Redshift only)
+        schema - string or None; schema to create the table in (default is the search path)
+        """
+        if dialect not in DIALECTS:
+            raise ValueError('unknown dialect {}; should be one of {}'.format(dialect, DIALECTS))
+
+        name = self.name if schema is None else '{}.{}'.format(schema, self.name)
+        columns = ',\n'.join(self.column_sql(c, dialect, physical) for c in self.columns)
+        statement = 'CREATE TABLE IF NOT EXISTS {}\n({})'.format(name, columns)
+        if dialect == 'redshift' and physical:
+            statement += '\nDISTSTYLE {}'.format(self.diststyle)
+            if self.diststyle == 'KEY':
+                statement += '\nDISTKEY ({})'.format(self.distkey)
+            if self.sortkey:
+                statement += '\nCOMPOUND SORTKEY ({})'.format(', '.join(self.sortkey))
+
+        if dialect == 'duckdb':
+            sequences = ['CREATE SEQUENCE IF NOT EXISTS {} START 0 MINVALUE 0;\n'.format(self.sequence_name(c))
+                        for c in self.columns if c.identity]
+            return ''.join(sequences) + statement + ';\n'
+
+        return statement + ';\n'
+
+
+    def drop(self, schema=None, dialect='redshift'):
+        name = self.name if schema is None else '{}.{}'.format(schema, self.name)
+        statement = 'DROP TABLE IF EXISTS {};'.format(name)
+        if dialect == 'duckdb':
+            statement += ''.join('\nDROP SEQUENCE IF EXISTS {};'.format(self.sequence_name(c))
+                                for c in self.columns if c.identity)
+
+        return statement
+
+
+    def insert(self):
+        """
+        Makes INSERT statement for psycopg2.extras.execute_values.
+        """
+        return 'INSERT INTO {}\n({})\nVALUES %s;\n'.format(self.name, ',\n'.join(self.load_columns))
+
+
+solar_metrics_table = Table('solar_metrics',
+                            [Column('id', 'INT', 'AZ64', 'PRIMARY KEY', identity=True),
+                            Column('zip_code', 'VARCHAR(5)', 'RAW', 'NOT NULL'),
+                            Column('percent_qualified_bldgs', 'NUMERIC', 'AZ64'),
+                            Column('number_potential_panels', 'INT', 'AZ64'),
+                            Column('kw_median', 'NUMERIC', 'AZ64'),
+                            Column('potential_installs', 'INT', 'AZ64'),
+                            Column('median_income', 'NUMERIC', 'AZ64'),
+                            Column('median_age', 'NUMERIC', 'AZ64'),
+                            Column('occupied_housing_units', 'INT', 'AZ64'),
+                            Column('owner_occupied_housing_units', 'INT', 'AZ64'),
+                            Column('family_homes', 'INT', 'AZ64'),
+                            Column('collegiates', 'INT', 'AZ64'),
+                            Column('moved_recently', 'INT', 'AZ64'),
+                            Column('average_yearly_electric_bill', 'NUMERIC', 'AZ64'),
+                            Column('average_yearly_kwh_used', 'NUMERIC', 'AZ64'),
+                            Column('primary_installer_id', 'INT', 'AZ64'),
+                            Column('battery_system_fraction', 'NUMERIC', 'AZ64'),
+                            Column('mean_annual_feedin_tariff', 'NUMERIC', 'AZ64')],
+                            key='zip_code',
+                            distkey='zip_code',
+                            sortkey=['zip_code'])
+
+zipcodes_table = Table('zipcodes',
+                        [Column('zip_code', 'VARCHAR(5)', 'RAW', 'PRIMARY KEY'),
+                        Column('city_name', 'VARCHAR', 'ZSTD'),
+                        Column('state_name', 'VARCHAR', 'BYTEDICT'),
+                        Column('latitude', 'NUMERIC', 'AZ64'),
+                        Column('longitude', 'NUMERIC', 'AZ64')],
+                        key='zip_code',
+                        distkey='zip_code',
+                        sortkey=['zip_code'])
+
+utility_table = Table('utility',
+                        [Column('zip_code', 'VARCHAR(5)', 'RAW', 'PRIMARY KEY'),
+                        Column('utility_name', 'VARCHAR', 'ZSTD'),
+                        Column('ownership', 'VARCHAR', 'BYTEDICT'),
+                        Column('service_type', 'VARCHAR', 'BYTEDICT')],
+                        key='zip_code',
+                        distkey='zip_code',
+                        sortkey=['zip_code'])
+
+installer_table = Table('installer',
+                        [Column('installer_id', 'INT', 'RAW', 'PRIMARY KEY'),
+                        Column('installer_name', 'VARCHAR', 'ZSTD'),
+                        Column('installer_primary_module_manufacturer', 'VARCHAR', 'ZSTD')],
+                        key='installer_id',
+                        diststyle='ALL',
+                        sortkey=['installer_id'])
+
+# tables loaded from the ETL data
+tables = [solar_metrics_table, zipcodes_table, utility_table, installer_table]
+
+
+# solar_metrics columns summarized by city and state in the rollup tables (see rollups.py).
+# Sums and non-null counts are stored so averages can be computed, and state rows can be
+# rebuilt from city rows.
+ROLLUP_METRICS = ['potential_installs', 'kw_median', 'average_yearly_electric_bill', 'median_income']
+
+rollup_metric_columns = [Column('{}_{}'.format(metric, stat), column_type, encode)
+                        for metric in ROLLUP_METRICS
+                        for stat, column_type, encode in [('sum', 'DOUBLE PRECISION', 'ZSTD'),
+                                                        ('count', 'INT', 'AZ64')]]
+
+city_summary_table = Table('city_summary',
+                            [Column('city_name', 'VARCHAR', 'RAW'),
+                            Column('state_name', 'VARCHAR', 'RAW'),
+                            Column('zip_count', 'INT', 'AZ64')] + rollup_metric_columns,
+                            diststyle='ALL',
+                            sortkey=['state_name', 'city_name'])
+
+state_summary_table = Table('state_summary',
+                            [Column('state_name', 'VARCHAR', 'RAW'),
+                            Column('city_count', 'INT', 'AZ64'),
+                            Column('zip_count', 'INT', 'AZ64')] + rollup_metric_columns,
+                            diststyle='ALL',
+                            sortkey=['state_name'])
+
+# tables built in the warehouse from the loaded tables
+rollup_tables = [city_summary_table, state_summary_table]
+
+# one row identifying the current contents of the warehouse, written by each load;
+# cached analysis query results are keyed by it (see query_cache.py)
+load_version_table = Table('load_version',
+                            [Column('version', 'VARCHAR(64)', 'RAW', 'NOT NULL'),
+                            Column('loaded_at', 'TIMESTAMP', 'RAW')],
+                            diststyle='ALL')
+
+all_tables = tables + rollup_tables + [load_version_table]
+
+
+def create_table_queries_for(dialect='redshift', physical=True, schema=None):
+    """
+    Makes CREATE TABLE statements for all tables.
+
+    dialect - string; one of DIALECTS
+    physical - boolean; if True, includes the Redshift distribution style, sort keys and encodings
+    schema - string or None; schema to create the tables in
+    """
+    return [t.create(dialect, physical, schema) for t in all_tables]
+
+
+def drop_table_queries_for(schema=None, dialect='redshift'):
+    return [t.drop(schema, dialect) for t in all_tables]
+
+
+# drop tables; for resetting the DWH
+drop_table_queries = drop_table_queries_for()
+solar_metrics_drop, zipcodes_drop, utility_drop, installer_drop = [t.drop() for t in tables]
+
+# create tables
+create_table_queries = create_table_queries_for()
+(solar_metrics_table_create,
+    zipcode_table_create,
+    utility_table_create,
+    installer_table_create) = [t.create() for t in tables]
+
+# insert statements
+solar_metrics_insert, zipcodes_insert, utility_insert, installer_insert = [t.insert() for t in tables]
+
+# columns of each table in the order of the dataframe/csv columns (for inserts and COPY column lists),
+# and the key used for incremental loads
+solar_metrics_columns, zipcodes_columns, utility_columns, installer_columns = [t.load_columns for t in tables]
 
-drop_table_queries = [solar_metrics_drop,
-                    zipcodes_drop,
-                    utility_drop,
-                    installer_drop]
+table_columns = {t.name: t.load_columns for t in tables}
 
-create_table_queries = [solar_metrics_table_create,
-                        zipcode_table_create,
-                        utility_table_create,
-                        installer_table_create]
+table_keys = {t.name: t.key for t in tables}
@@ -0,0 +1,110 @@
+"""
+Helpers for running the same SQL on psycopg2 (Redshift/Postgres) and DuckDB connections.
+"""
+import re
+
+import instrumentation
+from frame_schemas import widen_floats
+
+
+PYFORMAT_PARAM = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def is_duckdb(cur):
+    """
+    Checks if a cursor is a DuckDB connection (which is also its own cursor).
+    """
+    return 'duckdb' in type(cur).__module__
+
+
+def frame_to_rows(df):
+    """
+    Converts dataframe to list of tuples for psycopg2, with missing values as None.
+
+    df - pandas dataframe
+    """
+    return list(df.astype('object').where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def pyformat_to_qmark(sql, params=None):
+    """
+    Converts a query with psycopg2 placeholders (%(name)s or %s) to ? placeholders for DuckDB.
+    Tuples are expanded like psycopg2 does, so "IN %(cities)s" with a tuple of
+    (city, state) tuples becomes "IN ((?, ?), (?, ?), ...)".
+
+    sql - string; SQL query
+    params - dict, tuple, list or None; query parameters
+
+    Returns converted query and list of parameter values.
+    """
+    values = []
+    positional = iter(params) if isinstance(params, (tuple, list)) else None
+
+    def placeholder(value):
+        if isinstance(value, tuple):
+            return '({})'.format(', '.join(placeholder(v) for v in value))
+        values.append(value)
+        return '?'
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1) is not None:
+            return placeholder(params[match.group(1)])
+        return placeholder(next(positional))
+
+    if params is None:
+        return sql.replace('%%', '%'), []
+
+    return PYFORMAT_PARAM.sub(replace, sql), values
+
+
+def insert_frame(cur, table, columns, df):
+    """
+    Inserts all rows of a dataframe into a table.  Doesn't commit.
+
+    cur - psycopg2 cursor or DuckDB connection
+    table - string; name of table
+    columns - list of strings; table columns in the order of the dataframe columns
+    df - pandas dataframe
+    """
+    if df.shape[0] == 0:
+        return
+
+    column_list = ', '.join(columns)
+    df = widen_floats(df)
+    with instrumentation.span('INSERT {}'.format(table), kind='statement', rows_in=df.shape[0]) as s:
+        if is_duckdb(cur):
+            # DuckDB scans the dataframe directly
+            view = '{}_frame'.format(table)
+            cur.register(view, df.set_axis(columns, axis=1))
+            try:
+                cur.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2};'.format(table, column_list, view))
+            finally:
+                cur.unregister(view)
+        else:
+            import psycopg2.extras
+
+            psycopg2.extras.execute_values(cur,
+                                            'INSERT INTO {} ({}) VALUES %s;'.format(table, column_list),
+                                            frame_to_rows(df))
+        s.add_rows_out(df.shape[0])
+
+
+def execute(cur, sql, params=None):
+    """
+    Runs a statement with psycopg2 placeholders on a psycopg2 cursor or DuckDB connection,
+    recording it as a span (see instrumentation.py).
+
+    cur - psycopg2 cursor or DuckDB connection
+    sql - string; SQL statement with %(name)s or %s placeholders
+    params - dict, tuple or None; parameters
+    """
+    with instrumentation.span(instrumentation.statement_name(sql), kind='statement') as s:
+        if is_duckdb(cur):
+            cur.execute(*pyformat_to_qmark(sql, params))
+        else:
+            cur.execute(sql, params)
+            # number of rows inserted, deleted, copied or selected; -1 if unknown
+            if cur.rowcount >= 0:
+                s.add_rows_out(cur.rowcount)
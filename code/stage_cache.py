@@ -0,0 +1,390 @@
+"""
+Fingerprinted Parquet cache for the extract/transform stages in etl.py.
+
+Each cached stage result is keyed by a hash of the stage's input files, its
+arguments (dataframes are hashed by content) and its code, i.e. its module and every
+project module that imports, directly or indirectly (helpers, schemas, aggregations),
+so cached results are invalidated automatically when any of those change.  Results are
+stored as typed Parquet files, so dtypes like nullable Int64 survive a rerun.
+"""
+import os
+import ast
+import json
+import time
+import pickle
+import shutil
+import hashlib
+import inspect
+import warnings
+import functools
+
+import instrumentation
+import arrow_frames
+from lazy_imports import lazy_module
+
+pd = lazy_module('pandas')
+pq = lazy_module('pyarrow.parquet')
+
+
+CACHE_DIR = os.environ.get('SOLAR_CACHE_DIR', '../data/cache')
+# total size of cached results before least-recently-used entries are evicted
+MAX_CACHE_BYTES = int(os.environ.get('SOLAR_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+# set SOLAR_CACHE=0 to turn off stage caching
+CACHE_ENABLED = os.environ.get('SOLAR_CACHE', '1') != '0'
+
+FILE_HASH_INDEX = 'file_hashes.json'
+META_FILENAME = 'meta.json'
+
+
+def hash_file(path, cache_dir=CACHE_DIR, blocksize=2 ** 20):
+    """
+    Gets sha256 hash of a file's contents.
+    Hashes are memoized by path, size and modification time so large files
+    are only read again when they change.
+
+    path - string; path to file
+    cache_dir - string; directory with the memoized hashes
+    blocksize - int; bytes to read at a time
+    """
+    if not os.path.exists(path):
+        return 'missing'
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    index_path = os.path.join(cache_dir, FILE_HASH_INDEX)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    entry = index.get(path)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+
+    index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = index_path + '.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+    return sha.hexdigest()
+
+
+def hash_frame(df):
+    """
+    Gets sha256 hash of a pandas dataframe's contents, index, columns and dtypes.
+
+    df - pandas dataframe or series
+    """
+    sha = hashlib.sha256()
+    if isinstance(df, pd.DataFrame):
+        sha.update(repr(list(df.columns)).encode())
+        sha.update(repr(list(df.dtypes.astype('str'))).encode())
+    else:
+        sha.update(repr((df.name, str(df.dtype))).encode())
+
+    sha.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return sha.hexdigest()
+
+
+def hash_value(value):
+    """
+    Gets sha256 hash of a stage argument.
+
+    value - dataframe, series, or anything with a stable repr (strings, numbers, booleans)
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return hash_frame(value)
+
+    return hashlib.sha256(repr(value).encode()).hexdigest()
+
+
+def write_result(value, path):
+    """
+    Writes one stage result: dataframes as Parquet (through Arrow), other values pickled.
+
+    path - string; path without extension
+
+    Returns filename written.
+    """
+    if isinstance(value, pd.DataFrame):
+        path += '.parquet'
+        pq.write_table(arrow_frames.to_arrow(value), path)
+    else:
+        path += '.pickle'
+        with open(path, 'wb') as f:
+            pickle.dump(value, f)
+
+    return os.path.basename(path)
+
+
+def read_result(path):
+    """
+    Reads one stage result written by write_result.
+    """
+    if path.endswith('.parquet'):
+        return arrow_frames.to_pandas(pq.read_table(path))
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class StageCache:
+    """
+    Directory of cached stage results with least-recently-used eviction by total size.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        """
+        cache_dir - string; directory to store cached results in
+        max_bytes - int; maximum total size of cached results
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+
+    def entry_path(self, stage, key):
+        return os.path.join(self.cache_dir, '{}-{}'.format(stage, key[:20]))
+
+
+    def meta(self, stage, key):
+        """
+        Gets the metadata of a cached result without loading it, or None if there isn't one.
+
+        stage - string; name of stage
+        key - string; fingerprint of stage inputs and code
+        """
+        meta_path = os.path.join(self.entry_path(stage, key), META_FILENAME)
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        if meta['key'] != key:
+            return None
+
+        # modification time of the metadata is used as last access time for eviction
+        os.utime(meta_path)
+        return meta
+
+
+    def get(self, stage, key):
+        """
+        Loads cached result, or returns None if there isn't one.
+
+        stage - string; name of stage
+        key - string; fingerprint of stage inputs and code
+        """
+        meta = self.meta(stage, key)
+        if meta is None:
+            return None
+
+        path = self.entry_path(stage, key)
+        results = [read_result(os.path.join(path, fn)) for fn in meta['files']]
+        if meta['tuple']:
+            return tuple(results)
+
+        return results[0]
+
+
+    def put(self, stage, key, result, extra=None):
+        """
+        Stores result of a stage.  Dataframes are stored as Parquet, and other values
+        (e.g. the s3 keys of staged files) are pickled.  Results with dataframes that
+        can't be stored as Parquet are skipped.
+
+        stage - string; name of stage
+        key - string; fingerprint of stage inputs and code
+        result - pandas dataframe or other value, or tuple of them
+        extra - dict or None; more metadata to store, see meta()
+        """
+        frames = list(result) if isinstance(result, tuple) else [result]
+        path = self.entry_path(stage, key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        files = []
+        try:
+            for i, value in enumerate(frames):
+                files.append(write_result(value, os.path.join(tmp_path, str(i))))
+        except (ValueError, TypeError, ImportError) as e:
+            # e.g. object columns with mixed types, which Arrow can't store
+            reason = '{}: {}'.format(type(e).__name__, e)
+            current = instrumentation.current_span()
+            if current is not None:
+                current.set(cache_skipped=reason)
+            warnings.warn('not caching {} results: {}'.format(stage, reason), RuntimeWarning)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        meta = {'stage': stage,
+                'key': key,
+                'files': files,
+                'tuple': isinstance(result, tuple),
+                'created': time.time()}
+        meta.update(extra or {})
+        with open(os.path.join(tmp_path, META_FILENAME), 'w') as f:
+            json.dump(meta, f)
+
+        instrumentation.record_bytes(sum(os.path.getsize(os.path.join(tmp_path, fn)) for fn in os.listdir(tmp_path)))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self.evict()
+
+
+    def entries(self):
+        """
+        Lists cached entries as (path, last access time, size in bytes) tuples.
+        """
+        if not os.path.exists(self.cache_dir):
+            return []
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(path, META_FILENAME)
+            if not os.path.exists(meta_path):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+            entries.append((path, os.path.getmtime(meta_path), size))
+
+        return entries
+
+
+    def evict(self):
+        """
+        Removes least-recently-used entries until the cache is under max_bytes.
+        """
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        total = sum(e[2] for e in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+    def clear(self):
+        """
+        Removes all cached results.
+        """
+        for path, _, _ in self.entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def project_modules(path, found=None):
+    """
+    Gets the paths of a module in the code directory and of every module in the same
+    directory it imports, directly or indirectly (including imports inside functions).
+
+    path - string; absolute path of a module
+    found - set of paths already visited
+    """
+    found = set() if found is None else found
+    if path in found:
+        return found
+
+    found.add(path)
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+
+    code_dir = os.path.dirname(path)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+
+        for name in names:
+            module_path = os.path.join(code_dir, name.split('.')[0] + '.py')
+            if os.path.exists(module_path):
+                project_modules(module_path, found)
+
+    return found
+
+
+def code_fingerprint(func):
+    """
+    Gets sha256 hash of the code a stage runs: the source of the function's module and
+    of every project module it imports (see project_modules), so changing a helper or
+    a schema changes the fingerprint of every stage which could use it.
+
+    func - function for the stage
+    """
+    sha = hashlib.sha256()
+    sha.update(func.__qualname__.encode())
+    module_path = os.path.abspath(inspect.getsourcefile(inspect.unwrap(func)))
+    for path in sorted(project_modules(module_path)):
+        sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+
+    return sha.hexdigest()
+
+
+def stage_fingerprint(func, version, input_files, bound_args, cache_dir=CACHE_DIR):
+    """
+    Gets fingerprint of a stage from its code (see code_fingerprint), version, input files and arguments.
+
+    func - function for the stage
+    version - string; stage version, bump to invalidate cached results by hand
+    input_files - list of strings; files the stage reads
+    bound_args - dict of argument name to value
+    cache_dir - string; directory with the memoized file hashes
+    """
+    sha = hashlib.sha256()
+    sha.update(str(version).encode())
+    sha.update(code_fingerprint(func).encode())
+    for fn in input_files:
+        sha.update(fn.encode())
+        sha.update(hash_file(fn, cache_dir=cache_dir).encode())
+    for name, value in sorted(bound_args.items()):
+        sha.update(name.encode())
+        sha.update(hash_value(value).encode())
+
+    return sha.hexdigest()
+
+
+def cached_stage(version='1', input_files=()):
+    """
+    Decorator which caches the dataframe(s) returned by an ETL stage.
+    The decorated function takes an extra keyword argument, use_cache (default True).
+
+    version - string; stage version, bump to invalidate cached results by hand
+    input_files - list of strings, or function returning a list of strings; files the stage reads
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, use_cache=True, **kwargs):
+            if not (use_cache and CACHE_ENABLED):
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            files = input_files() if callable(input_files) else input_files
+            key = stage_fingerprint(func, version, files, bound.arguments)
+
+            cache = StageCache()
+            result = cache.get(func.__name__, key)
+            if result is not None:
+                return result
+
+            result = func(*args, **kwargs)
+            cache.put(func.__name__, key, result)
+            return result
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
@@ -0,0 +1,558 @@
+"""
+Synthetic versions of the five input datasets, at any scale.
+
+Files are written with the same names, columns and quirks as the downloaded data
+(-9999 placeholders and 4-digit/ZIP+4 zipcodes in the LBNL data, int zipcodes in the
+EIA and zipcode files, the 3-level header of the EIA-861 workbook, duplicate
+region_name rows in project sunroof), so etl.py can run on them unchanged:
+
+python synthetic_data.py --scale 10
+python etl.py --backend duckdb --data-dir ../data/synthetic/scale-10.0-seed-0
+
+Installers, module manufacturers, utilities and the zipcodes of installs follow
+Zipf distributions, so a few of them have most of the rows, like the real data.
+Rows are generated with numpy in chunks, in parallel processes, and every chunk has
+its own random stream, so the output only depends on the seed and scale.
+
+There are only so many 5-digit zipcodes, so above scale 1 the zipcode, ACS and
+project sunroof data grow until they run out of zipcodes, and the LBNL and EIA
+data get more rows per zipcode.
+"""
+import os
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from etl import input_paths
+
+
+# approximate sizes of the real datasets (scale=1)
+N_ZIPCODES = 42000
+N_LBNL_ROWS = 1600000
+N_INSTALLERS = 5000
+N_MANUFACTURERS = 300
+N_INVERTER_MANUFACTURERS = 150
+N_UTILITIES = 3300
+N_IOU_ROWS = 30000
+N_NONIOU_ROWS = 50000
+
+# zipcodes above this are never valid, so they can be used for bad zipcodes
+MAX_ZIPCODE = 99950
+# share of zipcodes in the ACS and project sunroof data
+ACS_COVERAGE = 0.78
+PSR_COVERAGE = 0.27
+# share of utilities which are investor-owned
+IOU_SHARE = 0.06
+
+STATES = ['AK', 'AL', 'AR', 'AZ', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI', 'IA', 'ID', 'IL', 'IN',
+        'KS', 'KY', 'LA', 'MA', 'MD', 'ME', 'MI', 'MN', 'MO', 'MS', 'MT', 'NC', 'ND', 'NE', 'NH', 'NJ',
+        'NM', 'NV', 'NY', 'OH', 'OK', 'OR', 'PA', 'PR', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VA', 'VT',
+        'WA', 'WI', 'WV', 'WY']
+NAME_PREFIXES = ['SPRING', 'OAK', 'RIVER', 'LAKE', 'FAIR', 'GREEN', 'MAPLE', 'CEDAR', 'PINE', 'WEST',
+                'EAST', 'NORTH', 'SOUTH', 'MILL', 'ROCK', 'SAND', 'HILL', 'BROOK', 'ELM', 'WOOD',
+                'CLEAR', 'MOUNT', 'HAVEN', 'GLEN', 'BRIGHT']
+NAME_SUFFIXES = ['FIELD', 'VILLE', 'TON', 'BURG', 'PORT', ' CITY', ' SPRINGS', 'DALE', 'WOOD', 'FORD',
+                'VIEW', ' FALLS', 'MONT', ' HEIGHTS', 'LAND']
+DATA_PROVIDERS = ['California Public Utilities Commission', 'Massachusetts Clean Energy Center',
+                'New York State Energy Research and Development Authority', 'Arizona Public Service',
+                'New Jersey Clean Energy Program', 'Oregon Energy Trust', 'Colorado Energy Office',
+                'Connecticut Green Bank', 'Texas Utilities', 'Utah Office of Energy Development']
+
+LBNL_COLUMNS = ['Data Provider',
+                'System ID (From Data Provider)',
+                'System ID (Tracking the Sun)',
+                'Installation Date',
+                'System Size',
+                'Total Installed Price',
+                'Appraised Value Flag',
+                'Sales Tax Cost',
+                'Rebate or Grant',
+                'Performance-Based Incentive (Annual Payment)',
+                'Feed-in Tariff (Annual Payment)',
+                'Customer Segment',
+                'New Construction',
+                'Tracking',
+                'Ground Mounted',
+                'Battery System',
+                'Zip Code',
+                'City',
+                'State',
+                'Utility Service Territory',
+                'Third-Party Owned',
+                'Installer Name',
+                'Self-Installed',
+                'Azimuth #1',
+                'Tilt #1',
+                'Module Manufacturer #1',
+                'Module Quantity #1',
+                'Inverter Manufacturer #1']
+
+EIA861_UTILITY_COLUMNS = ['Data Year', 'Utility Number', 'Utility Name', 'Part', 'Service Type',
+                        'Data Type', 'State', 'Ownership', 'BA Code']
+EIA861_SECTORS = ['RESIDENTIAL', 'COMMERCIAL', 'INDUSTRIAL', 'TRANSPORTATION', 'TOTAL']
+
+NONIOU_OWNERSHIP = ['Cooperative', 'Municipal', 'Political Subdivision', 'State', 'Federal', 'Retail Power Marketer']
+
+
+def scaled(n, scale, minimum=10):
+    return max(int(round(n * scale)), minimum)
+
+
+def zipf_cdf(n, a):
+    """
+    Cumulative probabilities of a Zipf distribution over n ranks.
+
+    n - int; number of values
+    a - float; exponent, larger is more skewed
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** a
+    return np.cumsum(weights) / weights.sum()
+
+
+def zipf_sample(rng, cdf, size):
+    """
+    Draws ranks (0 is the most common) from a Zipf distribution.
+
+    rng - numpy Generator
+    cdf - numpy array from zipf_cdf
+    size - int; number of values to draw
+    """
+    return np.minimum(np.searchsorted(cdf, rng.random(size), side='right'), len(cdf) - 1)
+
+
+def with_sentinels(rng, values, share, sentinel=-9999):
+    """
+    Replaces a share of values with the missing value placeholder.
+    """
+    return np.where(rng.random(len(values)) < share, sentinel, values)
+
+
+def write_csv(df, path, header=True):
+    """
+    Writes a dataframe to csv without the index, with pyarrow's csv writer if this
+    version of pyarrow has one (it's about 10x faster than pandas).
+    """
+    try:
+        import pyarrow
+        from pyarrow.csv import write_csv as arrow_write_csv, WriteOptions
+    except ImportError:
+        df.to_csv(path, index=False, header=header)
+        return
+
+    arrow_write_csv(pyarrow.Table.from_pandas(df, preserve_index=False), path,
+                    write_options=WriteOptions(include_header=header))
+
+
+def place_names(n, rng):
+    """
+    Makes n city or utility style names, shuffled.  Names repeat with a number once
+    the prefix/suffix combinations run out.
+    """
+    base = np.array([p + s for p in NAME_PREFIXES for s in NAME_SUFFIXES], dtype='object')
+    names = base[np.arange(n) % len(base)]
+    repeat = np.arange(n) // len(base)
+    names = np.where(repeat > 0, names + ' ' + (repeat + 1).astype('str').astype('object'), names)
+    return names[rng.permutation(n)]
+
+
+def make_zipcodes(rng, scale):
+    """
+    Makes the free zipcode database: zipcodes grouped into cities of Zipf-distributed
+    size, each city in one state.
+
+    Returns the zipcode dataframe (as written to csv).
+    """
+    n = min(scaled(N_ZIPCODES, scale), MAX_ZIPCODE - 501)
+    zipcodes = np.sort(rng.choice(np.arange(501, MAX_ZIPCODE), n, replace=False))
+
+    n_cities = max(n // 3, 1)
+    city_states = np.array(STATES, dtype='object')[zipf_sample(rng, zipf_cdf(len(STATES), 0.6), n_cities)]
+    # most zipcodes are in a few large cities
+    city = zipf_sample(rng, zipf_cdf(n_cities, 0.5), n)
+    city_names = place_names(n_cities, rng)
+
+    zip_type = np.array(['STANDARD', 'PO BOX', 'UNIQUE', 'MILITARY'], dtype='object')[
+        np.searchsorted([0.76, 0.96, 0.995], rng.random(n), side='right')]
+    decommisioned = rng.random(n) < 0.012
+    standard = (zip_type == 'STANDARD') & ~decommisioned
+    population = np.round(rng.lognormal(8.5, 1.3, n))
+    returns = np.round(population * rng.uniform(0.35, 0.5, n))
+
+    df = pd.DataFrame({'Zipcode': zipcodes,
+                        'ZipCodeType': zip_type,
+                        'City': city_names[city],
+                        'State': city_states[city],
+                        'LocationType': 'PRIMARY',
+                        'Lat': np.where(decommisioned, np.nan, rng.uniform(19, 64, n).round(2)),
+                        'Long': np.where(decommisioned, np.nan, rng.uniform(-160, -67, n).round(2)),
+                        'Location': 'NA-US-' + city_states[city] + '-' + city_names[city],
+                        'Decommisioned': decommisioned,
+                        'TaxReturnsFiled': np.where(standard, returns, np.nan),
+                        'EstimatedPopulation': np.where(standard, population, np.nan),
+                        'TotalWages': np.where(standard, np.round(returns * rng.uniform(25000, 90000, n)), np.nan)})
+    return df
+
+
+def make_utilities(rng, scale, zip_df):
+    """
+    Makes the utilities shared by the EIA zipcode files, the EIA-861 workbook and the
+    LBNL utility column.  The first IOU_SHARE of utilities are investor-owned.
+    """
+    n = scaled(N_UTILITIES, scale)
+    n_iou = max(int(n * IOU_SHARE), 1)
+    ownership = np.concatenate([np.full(n_iou, 'Investor Owned', dtype='object'),
+                                np.array(NONIOU_OWNERSHIP, dtype='object')[
+                                    zipf_sample(rng, zipf_cdf(len(NONIOU_OWNERSHIP), 1.0), n - n_iou)]])
+    kind = np.where(ownership == 'Investor Owned', ' Power & Light Co',
+                    np.where(ownership == 'Cooperative', ' Electric Coop Inc', ' Municipal Utilities'))
+    return pd.DataFrame({'eiaid': np.sort(rng.choice(np.arange(100, max(60000, 2 * n)), n, replace=False)),
+                        'utility_name': place_names(n, rng) + kind,
+                        'state': zip_df['State'].values[rng.integers(0, len(zip_df), n)],
+                        'ownership': ownership,
+                        'service_type': np.array(['Bundled', 'Delivery', 'Energy'], dtype='object')[
+                            np.searchsorted([0.85, 0.95], rng.random(n), side='right')]})
+
+
+def lbnl_zipcode_labels(zipcodes):
+    """
+    Makes the zipcode strings as they appear in the LBNL data: 5-digit, 4-digit
+    (leading zero dropped) and ZIP+4 versions of each zipcode.
+    """
+    five = np.array(['{:05d}'.format(z) for z in zipcodes], dtype='object')
+    four = zipcodes.astype('str').astype('object')
+    return five, four
+
+
+def lbnl_chunk(seed, start, n, universe):
+    """
+    Makes one chunk of LBNL rows.
+
+    seed - numpy SeedSequence for this chunk
+    start - int; system ID of the first row
+    n - int; number of rows
+    universe - dict of arrays shared by all chunks (see write_lbnl)
+    """
+    rng = np.random.default_rng(seed)
+    zip_rank = zipf_sample(rng, universe['zip_cdf'], n)
+    zip_index = universe['zip_order'][zip_rank]
+    zipcodes = universe['zip_five'][zip_index]
+
+    # Excel-mangled 4-digit zipcodes, ZIP+4, invalid zipcodes and placeholders
+    kind = rng.random(n)
+    short = (kind < 0.3) & (universe['zipcodes'][zip_index] < 10000)
+    zipcodes = np.where(short, universe['zip_four'][zip_index], zipcodes)
+    plus_four = (kind > 0.97) & ~short
+    zipcodes[plus_four] = zipcodes[plus_four] + '-' + rng.integers(1000, 10000, plus_four.sum()).astype('str').astype('object')
+    invalid = rng.random(n) < 0.005
+    zipcodes[invalid] = rng.integers(MAX_ZIPCODE, 100000, invalid.sum()).astype('str').astype('object')
+    zipcodes[rng.random(n) < 0.003] = '-9999'
+
+    installer = universe['installers'][zipf_sample(rng, universe['installer_cdf'], n)]
+    installer[rng.random(n) < 0.08] = '-9999'
+    manufacturer = universe['manufacturers'][zipf_sample(rng, universe['manufacturer_cdf'], n)]
+    manufacturer[rng.random(n) < 0.05] = '-9999'
+    inverter = universe['inverters'][zipf_sample(rng, universe['inverter_cdf'], n)]
+    inverter[rng.random(n) < 0.1] = '-9999'
+    utility = universe['utility_names'][zipf_sample(rng, universe['utility_cdf'], n)]
+    utility[rng.random(n) < 0.2] = '-9999'
+    city = universe['zip_cities'][zip_index].copy()
+    city[rng.random(n) < 0.3] = '-9999'
+
+    size = np.round(rng.lognormal(1.7, 0.55, n), 3)
+    system_id = np.arange(start, start + n)
+    return pd.DataFrame({'Data Provider': universe['providers'][zipf_sample(rng, universe['provider_cdf'], n)],
+                        'System ID (From Data Provider)': with_sentinels(rng, system_id, 0.1),
+                        'System ID (Tracking the Sun)': system_id,
+                        'Installation Date': universe['dates'][rng.integers(0, len(universe['dates']), n)],
+                        'System Size': size,
+                        'Total Installed Price': with_sentinels(rng, np.round(size * rng.uniform(2500, 6000, n)), 0.12),
+                        'Appraised Value Flag': rng.random(n) < 0.04,
+                        'Sales Tax Cost': with_sentinels(rng, np.round(size * rng.uniform(0, 200, n)), 0.75),
+                        'Rebate or Grant': with_sentinels(rng, np.round(size * rng.uniform(0, 1500, n)), 0.45),
+                        'Performance-Based Incentive (Annual Payment)': with_sentinels(rng, np.round(rng.uniform(50, 900, n), 2), 0.95),
+                        'Feed-in Tariff (Annual Payment)': with_sentinels(rng, np.round(rng.uniform(100, 2500, n), 2), 0.97),
+                        'Customer Segment': universe['segments'][np.searchsorted([0.9, 0.96, 0.98], rng.random(n), side='right')],
+                        'New Construction': with_sentinels(rng, (rng.random(n) < 0.05).astype('int'), 0.5),
+                        'Tracking': with_sentinels(rng, (rng.random(n) < 0.01).astype('int'), 0.3),
+                        'Ground Mounted': with_sentinels(rng, (rng.random(n) < 0.06).astype('int'), 0.4),
+                        'Battery System': with_sentinels(rng, (rng.random(n) < 0.03).astype('int'), 0.1),
+                        'Zip Code': zipcodes,
+                        'City': city,
+                        'State': universe['zip_states'][zip_index],
+                        'Utility Service Territory': utility,
+                        'Third-Party Owned': with_sentinels(rng, (rng.random(n) < 0.4).astype('int'), 0.15),
+                        'Installer Name': installer,
+                        'Self-Installed': (rng.random(n) < 0.02).astype('int'),
+                        'Azimuth #1': with_sentinels(rng, rng.integers(90, 271, n), 0.35),
+                        'Tilt #1': with_sentinels(rng, rng.integers(5, 45, n), 0.35),
+                        'Module Manufacturer #1': manufacturer,
+                        'Module Quantity #1': with_sentinels(rng, np.maximum(np.round(size * 1000 / 300), 1).astype('int'), 0.05),
+                        'Inverter Manufacturer #1': inverter})
+
+
+def write_lbnl_chunk(args):
+    seed, start, n, universe, path = args
+    write_csv(lbnl_chunk(seed, start, n, universe), path, header=False)
+    return path
+
+
+def write_lbnl(paths, seed, scale, zip_df, utilities, chunksize=500000, workers=None):
+    """
+    Writes the LBNL Tracking the Sun csv files.  Chunks are generated in parallel
+    processes and concatenated in order.
+
+    paths - list of strings; output files (rows are split evenly between them)
+    seed - numpy SeedSequence
+    scale - float; size relative to the real data
+    zip_df - pandas dataframe from make_zipcodes
+    utilities - pandas dataframe from make_utilities
+    chunksize - int; rows per chunk
+    workers - int or None; number of processes (None for one per CPU)
+    """
+    universe_seed, chunk_seed = seed.spawn(2)
+    rng = np.random.default_rng(universe_seed)
+    zipcodes = zip_df['Zipcode'].values
+    zip_five, zip_four = lbnl_zipcode_labels(zipcodes)
+    n_installers = scaled(N_INSTALLERS, scale)
+    n_manufacturers = scaled(N_MANUFACTURERS, min(scale, 1) ** 0.5)
+    universe = {'zipcodes': zipcodes,
+                'zip_five': zip_five,
+                'zip_four': zip_four,
+                'zip_cities': zip_df['City'].values,
+                'zip_states': zip_df['State'].values,
+                # installs are concentrated in a small share of zipcodes
+                'zip_order': rng.permutation(len(zipcodes)),
+                'zip_cdf': zipf_cdf(len(zipcodes), 0.7),
+                'installers': np.array(['{} SOLAR {}'.format(name, i) for i, name in
+                                        enumerate(place_names(n_installers, rng))], dtype='object'),
+                'installer_cdf': zipf_cdf(n_installers, 1.1),
+                'manufacturers': np.array(['{} Solar Modules'.format(name.title()) for name in
+                                            place_names(n_manufacturers, rng)], dtype='object'),
+                'manufacturer_cdf': zipf_cdf(n_manufacturers, 1.0),
+                'inverters': np.array(['{} Inverters'.format(name.title()) for name in
+                                        place_names(N_INVERTER_MANUFACTURERS, rng)], dtype='object'),
+                'inverter_cdf': zipf_cdf(N_INVERTER_MANUFACTURERS, 1.4),
+                'utility_names': utilities['utility_name'].values[rng.permutation(len(utilities))],
+                'utility_cdf': zipf_cdf(len(utilities), 1.2),
+                'providers': np.array(DATA_PROVIDERS, dtype='object'),
+                'provider_cdf': zipf_cdf(len(DATA_PROVIDERS), 1.0),
+                'segments': np.array(['RES', 'COM', 'NON-RES', 'GOV'], dtype='object'),
+                'dates': pd.date_range('1998-01-01', '2018-12-31').strftime('%d-%b-%Y').values.astype('object')}
+
+    n_rows = scaled(N_LBNL_ROWS, scale)
+    bounds = np.linspace(0, n_rows, len(paths) + 1).astype('int')
+    jobs = []
+    for path, start, end in zip(paths, bounds[:-1], bounds[1:]):
+        for chunk_start in range(start, end, chunksize):
+            jobs.append((chunk_start, min(chunksize, end - chunk_start), path))
+
+    seeds = chunk_seed.spawn(len(jobs))
+    args = [(s, start, n, universe, '{}.{:06d}.tmp'.format(path, start)) for s, (start, n, path) in zip(seeds, jobs)]
+    if workers == 1:
+        chunk_files = list(map(write_lbnl_chunk, args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunk_files = list(executor.map(write_lbnl_chunk, args))
+
+    for path in paths:
+        with open(path, 'wb') as f:
+            f.write((','.join('"{}"'.format(c) for c in LBNL_COLUMNS) + '\n').encode('latin-1'))
+            for (_, _, chunk_path), chunk_file in zip(jobs, chunk_files):
+                if chunk_path != path:
+                    continue
+                with open(chunk_file, 'rb') as chunk:
+                    shutil.copyfileobj(chunk, f)
+                os.remove(chunk_file)
+
+
+def make_eia_zipcodes(rng, n_rows, zip_df, utilities, a):
+    """
+    Makes one of the EIA zipcode to utility files.  Utilities serve Zipf-distributed
+    numbers of zipcodes, and some zipcodes are served by several utilities.
+
+    n_rows - int; number of rows before removing duplicate zipcode/utility pairs
+    utilities - pandas dataframe with the utilities in this file
+    a - float; Zipf exponent of the number of zipcodes per utility
+    """
+    utility = utilities.iloc[rng.permutation(len(utilities))[zipf_sample(rng, zipf_cdf(len(utilities), a), n_rows)]]
+    zipcodes = zip_df['Zipcode'].values[rng.integers(0, len(zip_df), n_rows)]
+    # a few zipcodes which aren't in the zipcode database
+    invalid = rng.random(n_rows) < 0.003
+    zipcodes[invalid] = rng.integers(MAX_ZIPCODE, 100000, invalid.sum())
+    rates = rng.uniform(0.06, 0.3, (n_rows, 3)).round(6)
+    rates[rng.random(n_rows) < 0.05] = 0
+
+    df = pd.DataFrame({'zip': zipcodes,
+                        'eiaid': utility['eiaid'].values,
+                        'utility_name': utility['utility_name'].values,
+                        'state': utility['state'].values,
+                        'service_type': utility['service_type'].values,
+                        'ownership': utility['ownership'].values,
+                        'comm_rate': rates[:, 0],
+                        'ind_rate': rates[:, 1],
+                        'res_rate': rates[:, 2]})
+    return df.drop_duplicates(['zip', 'eiaid'])
+
+
+def write_eia861(path, rng, utilities):
+    """
+    Writes the EIA-861 Sales_Ult_Cust workbook, with its 3-level header.  Some utilities
+    have rows for several states, some are missing, and missing values are periods.
+    """
+    from openpyxl import Workbook
+
+    # utilities missing from the workbook, and extra rows for utilities in several states
+    rows = utilities[rng.random(len(utilities)) > 0.02]
+    extra = rows.iloc[rng.choice(len(rows), len(rows) // 20, replace=False)]
+    rows = pd.concat([rows, extra])
+    n = len(rows)
+    states = rows['state'].values.copy()
+    states[n - len(extra):] = np.array(STATES, dtype='object')[rng.integers(0, len(STATES), len(extra))]
+    customers = np.maximum(np.round(rng.pareto(1.2, n) * 2000), 1)
+
+    columns = {'Data Year': np.full(n, 2018),
+                'Utility Number': rows['eiaid'].values,
+                'Utility Name': rows['utility_name'].values,
+                'Part': np.array(['A', 'B', 'C', 'D'], dtype='object')[np.searchsorted([0.9, 0.95, 0.98], rng.random(n), side='right')],
+                'Service Type': rows['service_type'].values,
+                'Data Type': np.where(rng.random(n) < 0.85, 'O', 'I'),
+                'State': states,
+                'Ownership': rows['ownership'].values,
+                'BA Code': np.array(['CISO', 'PJM', 'ERCO', 'MISO', 'NYIS', 'ISNE', 'SWPP'], dtype='object')[rng.integers(0, 7, n)]}
+    sector_customers = {'RESIDENTIAL': customers,
+                        'COMMERCIAL': np.round(customers * rng.uniform(0.08, 0.15, n)),
+                        'INDUSTRIAL': np.round(customers * rng.uniform(0, 0.01, n)),
+                        'TRANSPORTATION': np.where(rng.random(n) < 0.01, 1, 0)}
+    sector_customers['TOTAL'] = sum(sector_customers.values())
+    values = []
+    for sector in EIA861_SECTORS:
+        count = sector_customers[sector]
+        mwh = np.round(count * rng.uniform(6, 14, n), 1)
+        revenue = np.round(mwh * rng.uniform(0.08, 0.25, n), 1)
+        block = pd.DataFrame({'revenue': revenue, 'mwh': mwh, 'count': count}).astype('object')
+        # missing data is a period
+        block.loc[(rng.random(n) < 0.03) | (count == 0)] = '.'
+        values.append(block)
+
+    data = pd.concat([pd.DataFrame(columns)] + values, axis=1)
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('States')
+    # top labels are merged cells in the real workbook, so only the first column of each group has a value
+    n_utility_columns = len(EIA861_UTILITY_COLUMNS)
+    sheet.append(['Utility Characteristics'] + [None] * (n_utility_columns - 1)
+                + [label for sector in EIA861_SECTORS for label in [sector, None, None]])
+    sheet.append([None] * n_utility_columns + ['Revenues', 'Sales', 'Customers'] * len(EIA861_SECTORS))
+    sheet.append(EIA861_UTILITY_COLUMNS + ['Thousand Dollars', 'Megawatthours', 'Count'] * len(EIA861_SECTORS))
+    for row in data.astype('object').itertuples(index=False, name=None):
+        sheet.append([v.item() if isinstance(v, np.generic) else v for v in row])
+
+    workbook.save(path)
+
+
+def make_acs(rng, zip_df):
+    """
+    Makes the ACS census data for most valid zipcodes, like the csv saved by etl.extract_acs_data.
+    """
+    zipcodes = zip_df['Zipcode'].values
+    zipcodes = zipcodes[rng.random(len(zipcodes)) < ACS_COVERAGE]
+    n = len(zipcodes)
+
+    housing = np.round(rng.lognormal(7.5, 1.2, n))
+    occupied = np.round(housing * rng.uniform(0.75, 0.97, n))
+    income = np.round(rng.lognormal(10.9, 0.35, n))
+    income[rng.random(n) < 0.02] = np.nan
+    return pd.DataFrame({'geo_id': np.array(['{:05d}'.format(z) for z in zipcodes]),
+                        'median_age': np.round(rng.normal(41, 7, n).clip(18, 80), 1),
+                        'housing_units': housing,
+                        'median_income': income,
+                        'owner_occupied_housing_units': np.round(occupied * rng.uniform(0.35, 0.9, n)),
+                        'occupied_housing_units': occupied,
+                        'family_homes': np.round(housing * rng.uniform(0.5, 0.95, n)),
+                        'bachelors_degree_2': np.round(housing * rng.uniform(0.05, 0.6, n)),
+                        'moved_recently': np.round(housing * rng.uniform(0.02, 0.2, n))})
+
+
+def make_psr(rng, zip_df):
+    """
+    Makes the project sunroof data for some valid zipcodes, like the csv saved by etl.extract_psr_data.
+    About 1% of zipcodes have a duplicate region_name row, mostly with a small percent_covered
+    (etl only drops those when querying BigQuery).
+    """
+    zipcodes = zip_df['Zipcode'].values
+    zipcodes = zipcodes[rng.random(len(zipcodes)) < PSR_COVERAGE]
+    duplicates = zipcodes[rng.random(len(zipcodes)) < 0.01]
+    zipcodes = np.concatenate([zipcodes, duplicates])
+    n = len(zipcodes)
+
+    covered = rng.beta(5, 1.2, n) * 100
+    small = np.arange(n) >= n - len(duplicates)
+    small &= rng.random(n) < 0.8
+    covered[small] = rng.uniform(0, 5, small.sum())
+    panels = np.round(rng.lognormal(9, 1.3, n) * covered / 100)
+    qualified = rng.uniform(60, 98, n)
+    df = pd.DataFrame({'region_name': np.array(['{:05d}'.format(z) for z in zipcodes]),
+                        'percent_covered': covered,
+                        'percent_qualified': qualified,
+                        'number_of_panels_total': panels,
+                        'kw_median': np.round(rng.normal(8, 2, n).clip(2, 40), 2),
+                        'potential_installs': np.round(panels / rng.uniform(15, 30, n) * qualified / 100
+                                                        - rng.integers(0, 50, n))})
+    return df.iloc[rng.permutation(n)]
+
+
+def generate(data_dir, scale=1.0, seed=0, chunksize=500000, workers=None):
+    """
+    Writes all synthetic input files into a directory, named like the downloaded files.
+
+    data_dir - string; output directory
+    scale - float; size relative to the real data
+    seed - int; random seed
+    chunksize - int; LBNL rows generated per chunk
+    workers - int or None; number of processes for the LBNL data (None for one per CPU)
+
+    Returns dict of file paths, like etl.input_paths.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    paths = input_paths(data_dir)
+    zip_seed, utility_seed, lbnl_seed, eia_seed, eia861_seed, acs_seed, psr_seed = np.random.SeedSequence(seed).spawn(7)
+
+    zip_df = make_zipcodes(np.random.default_rng(zip_seed), scale)
+    zip_df.to_csv(paths['ZIPCODE_FILE'], index=False)
+    valid_zip_df = zip_df[~zip_df['Decommisioned']]
+    utilities = make_utilities(np.random.default_rng(utility_seed), scale, valid_zip_df)
+
+    write_lbnl(paths['LBNL_FILES'], lbnl_seed, scale, valid_zip_df, utilities, chunksize=chunksize, workers=workers)
+
+    rng = np.random.default_rng(eia_seed)
+    iou = utilities['ownership'] == 'Investor Owned'
+    iou_path, noniou_path = paths['EIA_ZIPCODE_FILES']
+    # a few large investor-owned utilities serve many zipcodes; the other utilities are small
+    write_csv(make_eia_zipcodes(rng, scaled(N_IOU_ROWS, scale), valid_zip_df, utilities[iou], 0.8), iou_path)
+    write_csv(make_eia_zipcodes(rng, scaled(N_NONIOU_ROWS, scale), valid_zip_df, utilities[~iou], 1.1), noniou_path)
+
+    write_eia861(paths['EIA861_FILE'], np.random.default_rng(eia861_seed), utilities)
+    make_acs(np.random.default_rng(acs_seed), valid_zip_df).to_csv(paths['ACS_CSV'], index=False)
+    make_psr(np.random.default_rng(psr_seed), valid_zip_df).to_csv(paths['PSR_CSV'], index=False)
+
+    # merged data from an earlier etl run on other inputs would be read instead of recomputed
+    if os.path.exists(paths['SOLAR_METRICS_CSV']):
+        os.remove(paths['SOLAR_METRICS_CSV'])
+
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes synthetic versions of the input datasets')
+    parser.add_argument('--scale', type=float, default=1.0, help='size relative to the real data')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--out', default=None, help='output directory (default ../data/synthetic/scale-<scale>-seed-<seed>)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for the LBNL data')
+    args = parser.parse_args()
+
+    out = args.out or '../data/synthetic/scale-{}-seed-{}'.format(args.scale, args.seed)
+    generate(out, scale=args.scale, seed=args.seed, workers=args.workers)
+    print('wrote synthetic data to {}'.format(out))
@@ -0,0 +1,373 @@
+"""
+Streaming extraction of BigQuery tables as Arrow record batches.
+
+pd.read_gbq runs a query, pages the whole result through the REST API, and only then
+returns a dataframe.  Here the BigQuery Storage Read API reads the table directly in
+several parallel streams of Arrow record batches, with only the needed columns and
+rows (column projection and row filters are done by the server).  Zipcodes are
+validated batch by batch while the other streams are still downloading, and columns
+the old queries computed in SQL (e.g. ACS family_homes) are computed on each batch.
+
+Sources share the TableSource interface.  FileSource is a stand-in reading local CSV
+files (e.g. the saved ACS/PSR csvs or synthetic data from synthetic_data.py), so the
+extraction can be tested and benchmarked without GCP credentials or network access.
+"""
+import os
+import csv
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+from zipcode_utils import normalize_zipcodes
+from lazy_imports import lazy_module
+
+pd = lazy_module('pandas')
+
+
+# set SOLAR_TABLE_SOURCE=files to read the BigQuery tables from local files instead
+DEFAULT_SOURCE = os.environ.get('SOLAR_TABLE_SOURCE', 'bigquery')
+MAX_STREAMS = 4
+
+# comparison operators for row filters, and the pyarrow.compute function for each
+FILTER_OPERATORS = {'=': 'equal',
+                    '!=': 'not_equal',
+                    '<': 'less',
+                    '<=': 'less_equal',
+                    '>': 'greater',
+                    '>=': 'greater_equal'}
+
+
+class TableSpec:
+    """
+    What to read from a table: its columns, the zipcode key, and columns derived from others.
+    """
+    def __init__(self, table, key, columns, derived=None):
+        """
+        table - string; table id, 'project.dataset.table'
+        key - string; zipcode column
+        columns - list of strings; output columns in order, including derived columns
+        derived - dict of derived column name to ('sum' or 'difference', list of source columns)
+        """
+        self.table = table
+        self.key = key
+        self.columns = columns
+        self.derived = derived or {}
+
+
+ACS_SPEC = TableSpec('bigquery-public-data.census_bureau_acs.zip_codes_2017_5yr',
+                        'geo_id',
+                        ['geo_id',
+                        'median_age',
+                        'housing_units',
+                        'median_income',
+                        'owner_occupied_housing_units',
+                        'occupied_housing_units',
+                        'family_homes',
+                        'bachelors_degree_2',
+                        'moved_recently'],
+                        derived={'family_homes': ('sum', ['dwellings_1_units_detached',
+                                                        'dwellings_1_units_attached',
+                                                        'dwellings_2_units',
+                                                        'dwellings_3_to_4_units']),
+                                'moved_recently': ('sum', ['different_house_year_ago_different_city',
+                                                            'different_house_year_ago_same_city'])})
+
+PSR_SPEC = TableSpec('bigquery-public-data.sunroof_solar.solar_potential_by_postal_code',
+                        'region_name',
+                        ['region_name',
+                        'percent_covered',
+                        'percent_qualified',
+                        'number_of_panels_total',
+                        'kw_median',
+                        'potential_installs'],
+                        derived={'potential_installs': ('difference', ['count_qualified', 'existing_installs_count'])})
+
+
+def sql_literal(value):
+    if isinstance(value, str):
+        return "'{}'".format(value.replace("'", "\\'"))
+    return repr(value)
+
+
+def filter_sql(row_filter):
+    """
+    Converts a row filter to a BigQuery row restriction, e.g. "geo_id >= '00501' AND geo_id <= '99950'".
+
+    row_filter - list of (column, operator, value) tuples, all of which must hold; operators are in FILTER_OPERATORS
+    """
+    return ' AND '.join('{} {} {}'.format(col, op, sql_literal(value)) for col, op, value in row_filter)
+
+
+def filter_mask(batch, row_filter):
+    """
+    Gets a boolean mask of the rows of a record batch passing a row filter (rows with nulls don't pass).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    mask = None
+    for col, op, value in row_filter:
+        column = batch.column(batch.schema.get_field_index(col))
+        condition = getattr(pc, FILTER_OPERATORS[op])(column, pa.scalar(value, type=column.type))
+        mask = condition if mask is None else pc.and_(mask, condition)
+
+    return mask
+
+
+def parallel_batches(streams, max_queued=8):
+    """
+    Runs each stream in its own thread and yields record batches in the order they arrive.
+    At most max_queued batches wait to be consumed, so fast streams can't fill memory.
+
+    streams - list of functions with no arguments, each returning an iterator of record batches
+    max_queued - int; most batches waiting at a time
+    """
+    batches = queue.Queue(maxsize=max_queued)
+    done = object()
+    stop = threading.Event()
+
+    def run(stream):
+        try:
+            for batch in stream():
+                if stop.is_set():
+                    return
+                batches.put(batch)
+        except Exception as e:
+            batches.put(e)
+        finally:
+            batches.put(done)
+
+    with ThreadPoolExecutor(max_workers=max(len(streams), 1)) as pool:
+        for stream in streams:
+            pool.submit(run, stream)
+
+        remaining = len(streams)
+        try:
+            while remaining:
+                item = batches.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # unblock streams waiting on a full queue if the consumer stopped early
+            stop.set()
+            while remaining:
+                if batches.get() is done:
+                    remaining -= 1
+
+
+class TableSource:
+    """
+    Base class for sources of tables as Arrow record batches.  Subclasses implement schema and read_batches.
+    """
+    def schema(self, table):
+        """
+        Gets the column names of a table.
+
+        table - string; table id
+        """
+        raise NotImplementedError
+
+
+    def read_batches(self, table, columns, row_filter=None, max_streams=MAX_STREAMS):
+        """
+        Reads a table as Arrow record batches, from several streams in parallel.
+        Batches come in no particular order.
+
+        table - string; table id
+        columns - list of strings; columns to read
+        row_filter - list of (column, operator, value) tuples or None; only rows passing all of them are read
+        max_streams - int; most streams to read at once
+        """
+        raise NotImplementedError
+
+
+class BigQueryStorageSource(TableSource):
+    """
+    Tables in BigQuery, read with the BigQuery Storage Read API.
+    """
+    def __init__(self, project=None, read_client=None, bigquery_client=None):
+        """
+        project - string or None; project billed for the reads (default from the credentials)
+        read_client - bigquery_storage.BigQueryReadClient or None; made when first needed
+        bigquery_client - bigquery.Client or None; for table schemas, made when first needed
+        """
+        self.project = project
+        self._read_client = read_client
+        self._bigquery_client = bigquery_client
+
+
+    @property
+    def read_client(self):
+        if self._read_client is None:
+            from google.cloud import bigquery_storage
+
+            self._read_client = bigquery_storage.BigQueryReadClient()
+        return self._read_client
+
+
+    @property
+    def bigquery_client(self):
+        if self._bigquery_client is None:
+            from google.cloud import bigquery
+
+            self._bigquery_client = bigquery.Client(project=self.project)
+        return self._bigquery_client
+
+
+    def schema(self, table):
+        return [field.name for field in self.bigquery_client.get_table(table).schema]
+
+
+    def read_batches(self, table, columns, row_filter=None, max_streams=MAX_STREAMS):
+        from google.cloud.bigquery_storage import types
+
+        project, dataset, table_name = table.split('.')
+        read_options = types.ReadSession.TableReadOptions(selected_fields=columns,
+                                                            row_restriction=filter_sql(row_filter or []))
+        requested = types.ReadSession(table='projects/{}/datasets/{}/tables/{}'.format(project, dataset, table_name),
+                                        data_format=types.DataFormat.ARROW,
+                                        read_options=read_options)
+        billing_project = self.project or self.bigquery_client.project
+        session = self.read_client.create_read_session(parent='projects/{}'.format(billing_project),
+                                                        read_session=requested,
+                                                        max_stream_count=max_streams)
+
+        def stream_reader(stream):
+            def read():
+                for page in self.read_client.read_rows(stream.name).rows(session).pages:
+                    yield from page.to_arrow().to_batches()
+            return read
+
+        return parallel_batches([stream_reader(s) for s in session.streams])
+
+
+class FileSource(TableSource):
+    """
+    Stand-in for BigQuery reading tables from local CSV files, one stream per file.
+    Projection and row filters are applied while reading, batch by batch.
+    """
+    def __init__(self, files, column_types=None, block_size=1 << 20):
+        """
+        files - dict of table id to list of csv file paths
+        column_types - dict of column name to pyarrow type or None; e.g. zipcodes as strings
+        block_size - int; bytes of csv per record batch
+        """
+        self.files = files
+        self.column_types = column_types or {}
+        self.block_size = block_size
+
+
+    def schema(self, table):
+        with open(self.files[table][0], newline='') as f:
+            return next(csv.reader(f))
+
+
+    def read_batches(self, table, columns, row_filter=None, max_streams=MAX_STREAMS):
+        import pyarrow.csv as pacsv
+
+        read_options = pacsv.ReadOptions(block_size=self.block_size)
+        convert_options = pacsv.ConvertOptions(include_columns=columns,
+                                                column_types={c: t for c, t in self.column_types.items() if c in columns})
+
+        def stream_reader(path):
+            def read():
+                for batch in pacsv.open_csv(path, read_options=read_options, convert_options=convert_options):
+                    yield batch.filter(filter_mask(batch, row_filter)) if row_filter else batch
+            return read
+
+        return parallel_batches([stream_reader(path) for path in self.files[table][:max_streams]])
+
+
+def file_source(acs_csv, psr_csv):
+    """
+    Makes a FileSource serving the ACS and project sunroof tables from csv files
+    (with derived columns already computed, like the saved csvs and synthetic data).
+    """
+    import pyarrow as pa
+
+    return FileSource({ACS_SPEC.table: [acs_csv], PSR_SPEC.table: [psr_csv]},
+                        column_types={ACS_SPEC.key: pa.string(), PSR_SPEC.key: pa.string()})
+
+
+def add_derived_columns(batch, derived):
+    """
+    Adds derived columns to a record batch.
+
+    batch - pyarrow RecordBatch
+    derived - dict of column name to ('sum' or 'difference', list of source columns)
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if not derived:
+        return batch
+
+    arrays, names = list(batch.columns), list(batch.schema.names)
+    for name, (operation, sources) in derived.items():
+        values = [batch.column(batch.schema.get_field_index(c)) for c in sources]
+        result = values[0]
+        for v in values[1:]:
+            result = pc.add(result, v) if operation == 'sum' else pc.subtract(result, v)
+        arrays.append(result)
+        names.append(name)
+
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def read_table(source, spec, valid_zips, max_streams=MAX_STREAMS):
+    """
+    Reads a table from a source into a dataframe, keeping only rows with valid zipcodes.
+    The source only sends the needed columns and rows in the valid zipcode range;
+    derived columns and exact zipcode validation are done on each batch as it arrives.
+
+    source - TableSource
+    spec - TableSpec; e.g. ACS_SPEC or PSR_SPEC
+    valid_zips - zipcode_utils.ValidZipcodes
+    max_streams - int; most parallel streams
+
+    Returns pandas dataframe with spec.columns, sorted by zipcode.
+    """
+    available = set(source.schema(spec.table))
+    # derived columns are read directly if the source already has them (e.g. saved csvs)
+    derived = {name: d for name, d in spec.derived.items() if name not in available}
+    columns = [c for c in spec.columns if c not in derived]
+    columns += [c for _, sources in derived.values() for c in sources if c not in columns]
+    # zipcodes are 5-character strings, so the valid range can be filtered by the source
+    row_filter = [(spec.key, '>=', valid_zips.index[0]), (spec.key, '<=', valid_zips.index[-1])]
+
+    frames = []
+    with instrumentation.span('read {}'.format(spec.table), kind='extract', streams=max_streams) as s:
+        for batch in source.read_batches(spec.table, columns, row_filter=row_filter, max_streams=max_streams):
+            s.add_rows_in(batch.num_rows)
+            df = add_derived_columns(batch, derived).to_pandas()
+            df[spec.key] = normalize_zipcodes(df[spec.key], truncate=False)
+            frames.append(valid_zips.filter(df, spec.key)[spec.columns])
+
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+        else:
+            df = pd.DataFrame(columns=spec.columns)
+        # streams finish in any order
+        df = df.sort_values(spec.key, kind='mergesort', ignore_index=True)
+        s.add_rows_out(df.shape[0])
+
+    return df
+
+
+def get_source(name=DEFAULT_SOURCE, **kwargs):
+    """
+    Makes a table source by name.
+
+    name - string; 'bigquery', or 'files' for a FileSource (kwargs acs_csv and psr_csv)
+    """
+    if name == 'bigquery':
+        return BigQueryStorageSource(**kwargs)
+    if name == 'files':
+        return file_source(**kwargs)
+
+    raise ValueError("unknown table source {}; should be 'bigquery' or 'files'".format(name))
@@ -0,0 +1,37 @@
+"""
+Shared fixtures for the tests.  Run from the code directory: python -m pytest tests
+"""
+import os
+import sys
+
+import pytest
+
+# spans are still measured, but not written to the metrics directory
+os.environ.setdefault('SOLAR_INSTRUMENTATION', '0')
+# the modules are imported as top-level modules, as the scripts do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """
+    Mocks AWS with moto, with fake credentials so nothing can reach a real account.
+    """
+    for variable in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(variable, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-west-2')
+    # tests which need AWS managed policies (e.g. AmazonS3ReadOnlyAccess) set MOTO_IAM_LOAD_MANAGED_POLICIES first
+
+    try:
+        from moto import mock_aws
+        mocks = [mock_aws()]
+    except ImportError:
+        # moto < 5 (the last versions for python 3.7) mocks each service separately
+        import moto
+        mocks = [moto.mock_s3(), moto.mock_iam(), moto.mock_ec2(), moto.mock_redshift()]
+
+    for mock in mocks:
+        mock.start()
+    yield
+    for mock in reversed(mocks):
+        mock.stop()
@@ -0,0 +1,70 @@
+import configparser
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+from infrastructure_as_code import redshift_creator
+
+
+def make_config():
+    config = configparser.ConfigParser()
+    config['AWS'] = {'KEY': 'testing', 'SECRET': 'testing'}
+    config['DWH'] = {'DWH_CLUSTER_TYPE': 'multi-node',
+                    'DWH_NUM_NODES': '2',
+                    'DWH_NODE_TYPE': 'dc2.large',
+                    'DWH_CLUSTER_IDENTIFIER': 'solar-test',
+                    'DWH_IAM_ROLE_NAME': 'solar-test-role'}
+    config['CLUSTER'] = {'DB_NAME': 'solar', 'DB_USER': 'solar', 'DB_PASSWORD': 'Passw0rd', 'DB_PORT': '5439'}
+    return config
+
+
+def make_creator(config_dir):
+    clients = {'ec2': boto3.resource('ec2', region_name='us-west-2'),
+                's3': boto3.resource('s3', region_name='us-west-2'),
+                'iam': boto3.client('iam', region_name='us-west-2'),
+                'redshift': boto3.client('redshift', region_name='us-west-2')}
+    return redshift_creator(config_location=str(config_dir),
+                            s3_access=True,
+                            config=make_config(),
+                            clients=clients,
+                            sleep=lambda seconds: None)
+
+
+@pytest.fixture
+def managed_policies(monkeypatch):
+    # moto only has AWS managed policies like AmazonS3ReadOnlyAccess when asked to
+    monkeypatch.setenv('MOTO_IAM_LOAD_MANAGED_POLICIES', 'true')
+
+
+def test_create_redshift_cluster(managed_policies, aws, tmp_path):
+    creator = make_creator(tmp_path)
+
+    timings = creator.create_redshift_cluster()
+
+    assert set(timings) == {'enable_connections', 'create_s3_role', 'create_cluster', 'wait_until_available'}
+    config = configparser.ConfigParser()
+    config.read(str(tmp_path / 'solar_cluster.cfg'))
+    assert config['CLUSTER']['HOST'] == creator.describe_cluster()['Endpoint']['Address']
+    assert config['IAM_ROLE']['ARN'].endswith('role/solar-test-role')
+
+
+def test_create_redshift_cluster_twice_keeps_port_open(managed_policies, aws, tmp_path):
+    creator = make_creator(tmp_path)
+    creator.create_redshift_cluster()
+    creator.delete_cluster()
+
+    # the security group rule from the first cluster is already there
+    creator.create_redshift_cluster()
+    assert (tmp_path / 'solar_cluster.cfg').exists()
+
+
+def test_create_redshift_cluster_failure_raises(aws, tmp_path):
+    creator = make_creator(tmp_path)
+
+    # without managed policies, attaching the S3 read policy fails
+    with pytest.raises(ClientError):
+        creator.create_redshift_cluster()
+
+    assert 'create_cluster' not in creator.timings
+    assert not (tmp_path / 'solar_cluster.cfg').exists()
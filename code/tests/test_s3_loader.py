@@ -0,0 +1,41 @@
+import gzip
+import json
+
+import boto3
+import pandas as pd
+
+import s3_loader
+
+
+def make_frame(n_rows=100):
+    return pd.DataFrame({'zip_code': pd.Series(['{:05d}'.format(i) for i in range(n_rows)], dtype='category'),
+                        'kw_median': pd.Series([i / 10 for i in range(n_rows)], dtype='float32')})
+
+
+def test_stage_table_keys(aws):
+    s3 = boto3.client('s3', region_name='us-west-2')
+    s3.create_bucket(Bucket='bucket', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+
+    manifest_url = s3_loader.stage_table(make_frame(), 'solar_metrics', 'bucket', 4, s3)
+
+    assert manifest_url == 's3://bucket/staging/solar_metrics.manifest'
+    keys = sorted(o['Key'] for o in s3.list_objects_v2(Bucket='bucket')['Contents'])
+    assert keys == ['staging/solar_metrics.manifest'] + ['staging/solar_metrics/part_{:04d}.csv.gz'.format(i)
+                                                        for i in range(4)]
+
+    manifest = json.loads(s3.get_object(Bucket='bucket', Key='staging/solar_metrics.manifest')['Body'].read())
+    assert [e['url'] for e in manifest['entries']] == ['s3://bucket/' + k for k in keys[1:]]
+
+
+def test_stage_table_rows(aws):
+    s3 = boto3.client('s3', region_name='us-west-2')
+    s3.create_bucket(Bucket='bucket', CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+
+    s3_loader.stage_table(make_frame(10), 'installer', 'bucket', 3, s3)
+
+    lines = []
+    for i in range(3):
+        body = s3.get_object(Bucket='bucket', Key='staging/installer/part_{:04d}.csv.gz'.format(i))['Body'].read()
+        lines += gzip.decompress(body).decode().splitlines()
+    assert lines[:2] == ['"00000",0', '"00001",0.1']
+    assert len(lines) == 10
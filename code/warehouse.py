@@ -0,0 +1,216 @@
+"""
+Pooled connections and a parameterized query executor for the Redshift warehouse.
+
+The connection config is read once, connections are reused from a thread-safe pool,
+and query results are fetched straight into typed pandas dataframes.
+"""
+import os
+import uuid
+import threading
+import configparser
+from functools import lru_cache
+from contextlib import contextmanager
+
+import sql_utils
+import instrumentation
+from lazy_imports import lazy_module
+
+pd = lazy_module('pandas')
+
+
+# should be connection_filename from infrastructure_as_code.py
+CONNECTION_CONFIG = os.path.expanduser('~/.aws_config/solar_cluster.cfg')
+
+# postgres type OIDs to pandas dtypes for query results
+OID_DTYPES = {16: 'boolean',    # bool
+            20: 'Int64',        # bigint
+            21: 'Int64',        # smallint
+            23: 'Int64',        # int
+            700: 'float64',     # real
+            701: 'float64',     # double precision
+            1700: 'float64'}    # numeric
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def read_connection_config(config_file=CONNECTION_CONFIG):
+    """
+    Reads connection details for the cluster (only once per config file).
+
+    config_file - string; path to config file written by redshift_creator
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    cluster = config['CLUSTER']
+    return {'host': cluster['HOST'],
+            'dbname': cluster['DB_NAME'],
+            'user': cluster['DB_USER'],
+            'password': cluster['DB_PASSWORD'],
+            'port': cluster['DB_PORT']}
+
+
+@lru_cache(maxsize=None)
+def numeric_as_float():
+    """
+    Gets the psycopg2 type that makes numeric columns come back as floats instead of
+    Decimal objects (made once, and only when needed, so psycopg2 isn't imported with this module).
+    """
+    import psycopg2.extensions
+
+    return psycopg2.extensions.new_type(psycopg2.extensions.DECIMAL.values,
+                                        'NUMERIC_AS_FLOAT',
+                                        lambda value, cur: float(value) if value is not None else None)
+
+
+def connect(config_file=CONNECTION_CONFIG):
+    """
+    Opens a new (unpooled) connection to the cluster.
+
+    config_file - string; path to config file written by redshift_creator
+    """
+    import psycopg2
+
+    return psycopg2.connect(**read_connection_config(config_file))
+
+
+def get_pool(minconn=1, maxconn=8):
+    """
+    Gets the shared connection pool, creating it on first use.
+
+    minconn - int; connections to open up front
+    maxconn - int; maximum number of connections
+    """
+    import psycopg2.pool
+
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **read_connection_config())
+        return _pool
+
+
+def close_pool():
+    """
+    Closes all pooled connections.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+
+@contextmanager
+def connection():
+    """
+    Context manager that borrows a pooled connection.
+    Commits if the block succeeds and rolls back if it raises.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def execute(sql, params=None):
+    """
+    Runs a statement with parameters (e.g. %(name)s or %s placeholders) and commits.
+
+    sql - string; SQL statement
+    params - dict, tuple or None; query parameters
+    """
+    with connection() as conn:
+        with conn.cursor() as cur:
+            sql_utils.execute(cur, sql, params)
+            return cur.rowcount
+
+
+def result_frame(rows, description, dtypes=None):
+    """
+    Makes a typed dataframe from fetched rows.
+
+    rows - list of tuples
+    description - cursor description
+    dtypes - dict or None; column name to dtype, overriding the types from the database
+    """
+    columns = [d[0] for d in description]
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    types = {d[0]: OID_DTYPES[d[1]] for d in description if d[1] in OID_DTYPES}
+    types.update(dtypes or {})
+    return df.astype(types) if types else df
+
+
+def read_sql(sql, params=None, dtypes=None, server_side=False, itersize=50000):
+    """
+    Runs a query and returns the results as a typed dataframe.
+
+    sql - string; SQL query with %(name)s or %s placeholders
+    params - dict, tuple or None; query parameters.  Tuples of tuples work with IN, e.g.
+        "WHERE (city_name, state_name) IN %(cities)s" with {'cities': (('Houston', 'TX'),)}
+    dtypes - dict or None; column name to dtype, overriding the types from the database
+    server_side - boolean; if True, uses a server-side cursor so large results are
+        fetched itersize rows at a time instead of all at once
+    itersize - int; rows per fetch with a server-side cursor
+    """
+    with instrumentation.span(instrumentation.statement_name(sql), kind='query', server_side=server_side) as s:
+        df = _read_sql(sql, params, dtypes, server_side, itersize)
+        s.add_rows_out(df.shape[0])
+
+    return df
+
+
+def _read_sql(sql, params, dtypes, server_side, itersize):
+    import psycopg2.extensions
+
+    with connection() as conn:
+        if not server_side:
+            with conn.cursor() as cur:
+                psycopg2.extensions.register_type(numeric_as_float(), cur)
+                cur.execute(sql, params)
+                return result_frame(cur.fetchall(), cur.description, dtypes)
+
+        with conn.cursor(name='solar_{}'.format(uuid.uuid4().hex)) as cur:
+            cur.itersize = itersize
+            psycopg2.extensions.register_type(numeric_as_float(), cur)
+            cur.execute(sql, params)
+            chunks = []
+            rows = cur.fetchmany(itersize)
+            description = cur.description
+            while rows:
+                chunks.append(result_frame(rows, description, dtypes))
+                rows = cur.fetchmany(itersize)
+
+        if not chunks:
+            return result_frame([], description, dtypes)
+
+        return pd.concat(chunks, ignore_index=True)
+
+
+class Query:
+    """
+    A reusable parameterized query with known result dtypes.
+    """
+    def __init__(self, sql, dtypes=None, server_side=False):
+        """
+        sql - string; SQL query with %(name)s placeholders
+        dtypes - dict or None; column name to dtype for results
+        server_side - boolean; if True, fetches results with a server-side cursor
+        """
+        self.sql = sql
+        self.dtypes = dtypes
+        self.server_side = server_side
+
+
+    def __call__(self, **params):
+        """
+        Runs the query with keyword parameters and returns a dataframe.
+        """
+        return read_sql(self.sql, params or None, dtypes=self.dtypes, server_side=self.server_side)
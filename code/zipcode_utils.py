@@ -0,0 +1,176 @@
+"""
+Vectorized zipcode normalization and validation shared by all the extract steps.
+"""
+import weakref
+
+from lazy_imports import lazy_module
+
+pd = lazy_module('pandas')
+
+
+# valid zipcode indexes keyed by id() of the zipcode dataframe they were built from
+_valid_zip_cache = {}
+
+
+def normalize_zipcodes(zips, truncate=True, categories=None):
+    """
+    Converts zipcodes to 0-padded 5-character strings without calling python per row.
+
+    zips - pandas series with zipcodes as ints, floats or strings (e.g. ZIP+4 like '12345-6789')
+    truncate - boolean; if True, strips whitespace and keeps only the first 5 characters
+    categories - pandas Index or None; if given, returns a categorical with these categories
+        (values not in categories become NaN)
+    """
+    if pd.api.types.is_float_dtype(zips):
+        # floats come from int columns with missing values; avoid the '.0' suffix
+        zips = zips.astype('Int64')
+
+    missing = zips.isna()
+    zips = zips.astype('str')
+    if truncate:
+        zips = zips.str.strip().str[:5]
+
+    # a few zip codes with only 4 digits
+    zips = zips.str.zfill(5)
+    if missing.any():
+        zips = zips.mask(missing)
+
+    if categories is not None:
+        zips = pd.Series(pd.Categorical(zips, categories=categories), index=zips.index, name=zips.name)
+
+    return zips
+
+
+class ValidZipcodes:
+    """
+    Index of valid US zipcodes, built once from the zipcode dataset and reused
+    for cleaning every other dataset.
+    """
+    def __init__(self, zipcodes):
+        """
+        zipcodes - iterable of valid 5-character zipcode strings
+        """
+        self.index = pd.Index(pd.unique(pd.Series(zipcodes, dtype='object').dropna())).sort_values()
+        self.dtype = pd.CategoricalDtype(self.index)
+
+
+    @classmethod
+    def from_zip_df(cls, zip_df, col='Zipcode'):
+        """
+        Gets the (cached) index of valid zipcodes for a zipcode dataframe.
+
+        zip_df - pandas dataframe with valid US zipcodes
+        col - string; name of column with zipcodes
+        """
+        key = id(zip_df)
+        cached = _valid_zip_cache.get(key)
+        if cached is not None:
+            return cached
+
+        valid = cls(zip_df[col])
+        _valid_zip_cache[key] = valid
+        # drop the cached index when the dataframe is garbage collected so ids can't be reused
+        weakref.finalize(zip_df, _valid_zip_cache.pop, key, None)
+        return valid
+
+
+    def mask(self, zips):
+        """
+        Boolean array of which zipcodes are valid.
+
+        zips - pandas series of normalized zipcode strings
+        """
+        return self.index.get_indexer(zips) >= 0
+
+
+    def filter(self, df, col):
+        """
+        Keeps only rows of df with a valid zipcode.
+
+        df - pandas dataframe to be cleaned
+        col - string; column name of zipcode column in df
+        """
+        return df[self.mask(df[col])]
+
+
+    def to_categorical(self, zips):
+        """
+        Converts normalized zipcode strings to a categorical over all valid zipcodes.
+        Categoricals store a small integer code per row instead of a python string.
+
+        zips - pandas series of normalized zipcode strings
+        """
+        return zips.astype(self.dtype)
+
+
+def clean_zipcode_column(zip_df, df, col, truncate=True, categorical=False):
+    """
+    Normalizes a zipcode column in place and removes rows with invalid zipcodes.
+
+    zip_df - pandas dataframe with valid US zipcodes
+    df - pandas dataframe to be cleaned
+    col - string; column name of zipcode column in df
+    truncate - boolean; if True, strips whitespace and keeps only the first 5 characters
+    categorical - boolean; if True, zipcode column is returned as a categorical
+    """
+    valid = ValidZipcodes.from_zip_df(zip_df)
+    df[col] = normalize_zipcodes(df[col], truncate=truncate)
+    df = valid.filter(df, col)
+    if categorical:
+        df = df.assign(**{col: valid.to_categorical(df[col])})
+
+    return df
+
+
+def join_on_zipcode(frames, how='outer', key_name='full_zip'):
+    """
+    Joins several dataframes on their zipcode columns in one step.
+    key_name holds the zipcode from whichever dataframe has it, so it has no missing values.
+
+    frames - list of (dataframe, zipcode column name) tuples
+    how - string; type of join: 'outer', 'inner', 'left' (zipcodes in the first
+        dataframe) or 'right' (zipcodes in the last dataframe).  Unlike a chain of right
+        merges, 'right' keeps data from every dataframe for the zipcodes in the last one.
+    key_name - string; name of the combined zipcode column
+    """
+    if how not in ('outer', 'inner', 'left', 'right'):
+        raise ValueError("how must be 'outer', 'inner', 'left' or 'right', not {}".format(how))
+
+    keys = [pd.Index(normalize_zipcodes(df[col], truncate=False)) for df, col in frames]
+    columns = [c for df, _ in frames for c in df.columns]
+    aligned_join = all(k.is_unique and not k.hasnans for k in keys) and \
+                    len(set(columns)) == len(columns) and \
+                    key_name not in columns
+    if not aligned_join:
+        # duplicate zipcodes or column names; fall back to merging one at a time on the shared key
+        frames = [df.assign(**{key_name: key.values}) for (df, _), key in zip(frames, keys)]
+        if how == 'right':
+            result = frames[-1]
+            for df in frames[-2::-1]:
+                result = df.merge(result, on=key_name, how='right')
+        else:
+            result = frames[0]
+            for df in frames[1:]:
+                result = result.merge(df, on=key_name, how=how)
+
+        return result[[key_name] + [c for c in result.columns if c != key_name]]
+
+    if how == 'outer':
+        index = keys[0]
+        for k in keys[1:]:
+            index = index.union(k)
+    elif how == 'inner':
+        index = keys[0]
+        for k in keys[1:]:
+            index = index.intersection(k)
+        index = index.sort_values()
+    elif how == 'left':
+        index = keys[0]
+    else:
+        index = keys[-1]
+
+    index = pd.Index(index, name=key_name)
+    aligned = [df.set_axis(key, axis=0).reindex(index) for (df, _), key in zip(frames, keys)]
+    result = pd.concat(aligned, axis=1)
+    result.reset_index(inplace=True)
+    return result